@@ -13,7 +13,11 @@ setup(
     scripts=['bin/tote'],
     install_requires=[ 
         'requests',
-        'pycrypto'
-    ]
+        'pycryptodome'
+    ],
+    extras_require={
+        'zstd': ['zstandard'],
+        'lz4': ['lz4'],
+    },
 )
 
@@ -0,0 +1,102 @@
+import asyncio
+import io
+import os
+import threading
+
+from datetime import datetime, timezone
+
+import pytest
+
+import tote
+
+from tote.server import BlobServer, _stop
+from tote.store import FileStore
+
+
+@pytest.fixture
+def connect(tmp_path):
+    '''
+    a function that makes a workdir under tmp_path with the given config and connects to it.
+    '''
+    conns = []
+
+    def connect(config='', name='w'):
+        path = tmp_path / name
+        (path / '.tote' / 'blobs').mkdir(parents=True)
+        (path / '.tote' / 'config').write_text(config)
+        conn = tote.connect(path)
+        conns.append(conn)
+        return conn
+
+    yield connect
+    for conn in conns:
+        conn.close()
+
+
+@pytest.fixture
+def make_items():
+    '''
+    a function that makes n sorted file items, every big-th of them with many chunks.
+    '''
+    def make_items(n, big=None, chunks=200):
+        items = []
+        for i in range(n):
+            count = chunks if big and i % big == big - 1 else 1
+            items.append(tote.FileItem(
+                name='d%03d/file%06d' % (i // 1000, i),
+                type='file',
+                mtime=datetime.fromtimestamp(1500000000 + i, tz=timezone.utc),
+                size=1000 + i,
+                sha256='%064x' % i,
+                content=[
+                    tote.Chunk(size=1000, sha256='%064x' % (i * 1000 + c), lock='aes256ctr', key='%064x' % (i + 7), data='%064x' % (i + 13))
+                    for c in range(count)
+                ],
+            ))
+        return items
+
+    return make_items
+
+
+@pytest.fixture
+def blob_server(tmp_path):
+    '''
+    the url of a BlobServer on localhost serving a FileStore under tmp_path.
+    '''
+    path = tmp_path / 'served'
+    (path / 'blobs').mkdir(parents=True)
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(BlobServer(FileStore(path)).start('127.0.0.1', 0))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:%d/' % server.sockets[0].getsockname()[1]
+    finally:
+        asyncio.run_coroutine_threadsafe(_stop(server, timeout=1), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+@pytest.fixture
+def round_trip():
+    '''
+    a function that puts data through a connection, checks it comes back the same and returns the item.
+    '''
+    def round_trip(conn, data=None):
+        if data is None:
+            # text compresses, random data does not
+            data = b'some text that compresses well, ' * 30000 + os.urandom(600000)
+
+        item = conn.put_stream(io.BytesIO(data))
+
+        assert item.size == len(data)
+        assert b''.join(conn.get_chunks(item)) == data
+        out = io.BytesIO()
+        conn.get_stream(item, out)
+        assert out.getvalue() == data
+        # the same data again finds the same chunks
+        assert conn.put_stream(io.BytesIO(data)).content == item.content
+        return item
+
+    return round_trip
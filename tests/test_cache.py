@@ -0,0 +1,54 @@
+import os
+import time
+
+from tote.store import CachedStore, FileStore, file_path
+
+
+def _stores(tmp_path, size=2**20):
+    (tmp_path / 'up' / 'blobs').mkdir(parents=True)
+    upstream = FileStore(tmp_path / 'up')
+    return upstream, CachedStore(upstream, tmp_path / 'cache', size)
+
+
+def test_a_cache_that_can_not_be_written_only_warns_on_stderr(tmp_path, capsys):
+    upstream, cached = _stores(tmp_path)
+    blobs = [ os.urandom(1000) for i in range(20) ]
+    names = [ upstream.save(blob) for blob in blobs ]
+    # a file in the place of each bucket directory
+    for c in '0123456789abcdef':
+        (tmp_path / 'cache' / c).write_text('')
+
+    assert [ bytes(blob) for blob in cached.load_many(names) ] == blobs
+    out, err = capsys.readouterr()
+    assert out == ''
+    assert 'cache:' in err
+
+
+def test_the_least_recently_used_blobs_are_evicted(tmp_path):
+    upstream, cached = _stores(tmp_path, size=20000)
+    blobs = [ os.urandom(1000) for i in range(26) ]
+    names = [ upstream.save(blob) for blob in blobs ]
+
+    assert [ bytes(blob) for blob in cached.load_many(names[:20]) ] == blobs[:20]
+    assert all(map(cached._cached, names[:20]))
+    # used in order a while ago, then the first again just now
+    now = time.time()
+    for i, name in enumerate(names[:20]):
+        os.utime(file_path(cached.path, name), (now - 100 + i, now - 100 + i))
+    assert cached.load(names[0]) == blobs[0]
+
+    for name, blob in zip(names[20:], blobs[20:]):
+        assert cached.load(name) == blob
+
+    kept = [ cached._cached(name) for name in names ]
+    evicted = kept.count(False)
+    assert evicted > 0 and cached.stats.evictions == evicted
+    # the oldest went first, the one used again stayed
+    assert kept == [True] + [False] * evicted + [True] * (25 - evicted)
+
+    def cache_size():
+        return sum(os.path.getsize(file_path(cached.path, name)) for name in names if cached._cached(name))
+    # the size is checked every eighth of it added
+    assert cache_size() <= 20000 + 20000 // 8
+    cached.evict()
+    assert cache_size() <= 20000 * 7 // 8
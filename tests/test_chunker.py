@@ -0,0 +1,40 @@
+import io
+import os
+import random
+
+from tote.chunker import cdc_chunks, fixed_chunks, make_chunker
+
+
+def _cdc(data):
+    return list(cdc_chunks(io.BytesIO(data), min_size=2**12, avg_size=2**14, max_size=2**16))
+
+
+def test_cdc_chunks_cover_the_data_within_the_sizes():
+    data = os.urandom(2**20)
+    chunks = _cdc(data)
+
+    assert b''.join(chunks) == data
+    assert all(2**12 <= len(c) <= 2**16 for c in chunks[:-1])
+    assert len(chunks) > 20
+
+
+def test_cdc_boundaries_come_back_after_an_insert():
+    data = random.Random(1).randbytes(2**20)
+    before = _cdc(data)
+    after = _cdc(data[:300000] + b'inserted bytes' + data[300000:])
+
+    # only the chunks around the insert change
+    assert len(set(after) - set(before)) <= 2
+    assert len(set(before) - set(after)) <= 2
+
+
+def test_fixed_chunks():
+    data = os.urandom(10000)
+    assert list(fixed_chunks(io.BytesIO(data), size=4096)) == [ data[:4096], data[4096:8192], data[8192:] ]
+    assert make_chunker('fixed', size=4096).func is fixed_chunks
+
+
+def test_put_and_get_with_cdc(connect, round_trip):
+    conn = connect('[chunk]\nmethod = cdc\nmin_size = 64K\navg_size = 128K\nmax_size = 256K\n')
+    item = round_trip(conn)
+    assert len(item.content) > 2
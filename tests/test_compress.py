@@ -0,0 +1,55 @@
+import io
+import os
+
+import pytest
+
+from tote.compress import compress_blob, decompress_blob
+
+
+def _codec(name):
+    if name == 'zstd':
+        pytest.importorskip('zstandard')
+    if name == 'lz4':
+        pytest.importorskip('lz4.frame')
+    return name
+
+
+@pytest.mark.parametrize('codec', ['zlib', 'zstd', 'lz4'])
+def test_blob_round_trip(codec):
+    data = b'some text that compresses well, ' * 1000
+    blob = compress_blob(data, _codec(codec), check=False)
+
+    # the codec is named at the start, so any blob decompresses the same way
+    assert blob.startswith(codec.encode() + b'\n')
+    assert len(blob) < len(data)
+    assert bytes(decompress_blob(blob)) == data
+    assert bytes(decompress_blob(blob, size=len(data))) == data
+
+
+def test_data_that_does_not_compress_is_kept_as_is():
+    data = os.urandom(10000)
+    assert compress_blob(data, check=False) == data
+    assert compress_blob(b'text ' * 100, 'none') == b'text ' * 100
+    assert decompress_blob(data) == data
+
+
+@pytest.mark.parametrize('codec', ['zlib', 'none', 'zstd', 'lz4'])
+def test_put_and_get(connect, round_trip, codec):
+    conn = connect('[chunk]\nsize = 256K\n[compress]\ncodec = %s\n' % _codec(codec))
+    assert len(round_trip(conn).content) > 2
+
+
+def test_chunks_of_every_codec_read_back_from_one_store(connect, tmp_path):
+    pytest.importorskip('zstandard')
+    store = tmp_path / 'store'
+    (store / 'blobs').mkdir(parents=True)
+    config = '[store]\npath = %s\n[compress]\ncodec = %%s\n' % store
+    data = b'some text that compresses well, ' * 1000
+
+    items = [ connect(config % codec, name=codec).put_stream(io.BytesIO(data)) for codec in ('zlib', 'zstd', 'none') ]
+
+    # each codec stored a blob of its own, a workdir on any codec reads them all
+    assert len({ item.content[0].data for item in items }) == 3
+    conn = connect(config % 'zlib', name='reader')
+    for item in items:
+        assert b''.join(conn.get_chunks(item)) == data
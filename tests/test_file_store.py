@@ -0,0 +1,52 @@
+import os
+import threading
+
+import tote.main
+
+from tote.store import FileStore, read_buffer
+
+
+def test_load_many_yields_buffers_of_their_own(tmp_path):
+    (tmp_path / 'blobs').mkdir()
+    store = FileStore(tmp_path)
+    blobs = [ os.urandom(1000 + i) for i in range(5) ]
+    names = [ store.save(blob) for blob in blobs ]
+
+    loaded = list(store.load_many(names + names[:1]))
+    assert loaded == blobs + blobs[:1]
+    assert all(isinstance(blob, bytearray) for blob in loaded)
+    loaded[0][:4] = b'\0\0\0\0'
+    assert loaded[-1] == blobs[0]
+    assert store.load(names[0]) == blobs[0]
+
+
+def test_read_buffer(tmp_path):
+    (tmp_path / 'empty').write_bytes(b'')
+    (tmp_path / 'data').write_bytes(b'x' * 100000)
+    assert read_buffer(tmp_path / 'empty') == bytearray()
+    assert read_buffer(tmp_path / 'data') == b'x' * 100000
+
+
+def test_blob_cat(connect, tmp_path, monkeypatch):
+    conn = connect()
+    blob = os.urandom(300000)
+    name = conn.store.save(blob)
+    conn.close()
+    monkeypatch.chdir(conn.workdir_path)
+
+    # copied both to a file and to a pipe
+    with open(tmp_path / 'out', 'w') as out:
+        monkeypatch.setattr('sys.stdout', out)
+        tote.main.main(['blob-cat', name])
+    assert (tmp_path / 'out').read_bytes() == blob
+
+    r, w = os.pipe()
+    with open(r, 'rb') as reader, open(w, 'w') as out:
+        monkeypatch.setattr('sys.stdout', out)
+        data = []
+        thread = threading.Thread(target=lambda: data.append(reader.read()))
+        thread.start()
+        tote.main.main(['blob-cat', name])
+        out.close()
+        thread.join()
+    assert data == [blob]
@@ -0,0 +1,88 @@
+from functools import partial
+
+import pytest
+
+import tote
+
+
+@pytest.mark.parametrize('format', ['text', 'binary'])
+def test_fold_unfold_round_trip(connect, make_items, format):
+    conn = connect('[fold]\nformat = %s\n' % format)
+    # the items with many chunks do not fit a page, so pages also end on the size limit
+    items = make_items(5000, big=500)
+
+    folds = list(conn.fold(items, fold_size=2**14))
+
+    assert len(folds) > 10
+    for fold in folds:
+        assert len(conn._fold_items(fold)) == fold.count
+    assert sum(fold.count for fold in folds) == len(items)
+    assert list(conn.unfold(folds)) == items
+
+
+@pytest.mark.parametrize('format', ['text', 'binary'])
+def test_size_of_leaves_the_page_alone(format):
+    a, b, c = [ tote.FileItem(name='dir/%s' % name, type='file', size=1) for name in 'abc' ]
+    page = tote._page_writer(format)
+    page.write(a, page.size_of(a))
+    size = page.size
+    page.size_of(b)
+    assert page.size == size
+    # an item measured and then not written leaves nothing behind
+    page.write(c, page.size_of(c))
+    assert list(tote.decode_items_bytes(page.getvalue())) == [a, c]
+
+
+@pytest.mark.parametrize('format', ['text', 'binary'])
+def test_fold_boundaries_follow_names(connect, make_items, format):
+    conn = connect('[fold]\nformat = %s\n' % format)
+    items = make_items(5000)
+    before = [ fold.content[0].data for fold in conn.fold(items, fold_size=2**14) ]
+
+    # a file that changed size and time only changes the page it is in
+    items[2500].size += 12345
+    after = [ fold.content[0].data for fold in conn.fold(items, fold_size=2**14) ]
+
+    assert len(after) == len(before)
+    assert sum(a != b for a, b in zip(before, after)) == 1
+
+
+def test_checkin_passes_untouched_folds_through(connect, tmp_path, monkeypatch):
+    conn = connect()
+    work = conn.workdir_path
+    for d in range(3):
+        (work / ('d%d' % d)).mkdir()
+        for i in range(100):
+            (work / ('d%d' % d) / ('f%03d' % i)).write_text('data %d %d' % (d, i))
+    # small folds, so the checkin has several
+    monkeypatch.setattr(conn, 'fold', partial(conn.fold, fold_size=2**12))
+
+    def checkin(arc, arc_output):
+        tote.tote_update(
+            arc, [work], relative_to=work, base_path=work, arc_output=arc_output, conn=conn,
+            delete=True, history=False,
+        )
+        with conn.read_file(arc_output, unfold=False) as f:
+            return list(f)
+
+    first = checkin(None, tmp_path / 'first.tote')
+    assert len(first) > 4
+
+    # a file deleted, one changed and one added, all in the range of one fold
+    (work / 'd1' / 'f050').unlink()
+    (work / 'd1' / 'f051').write_text('changed data')
+    (work / 'd1' / 'f051a').write_text('new data')
+    second = checkin(tmp_path / 'first.tote', tmp_path / 'second.tote')
+
+    # the same as a checkin from scratch
+    scratch = checkin(None, tmp_path / 'scratch.tote')
+    assert list(conn.unfold(second)) == list(conn.unfold(scratch))
+    names = [ str(item.name) for item in conn.unfold(second) ]
+    assert 'd1/f050' not in names and 'd1/f051a' in names
+
+    # only the folds the changes fall in are written again, the others are passed through,
+    # the directory d1 changed too as its mtime moved
+    changed = [ fold for fold in first if fold not in second ]
+    assert 0 < len(changed) <= 2
+    for fold in changed:
+        assert any(str(fold.name_min) <= name <= str(fold.name_max) for name in ('d1', 'd1/f050', 'd1/f051a'))
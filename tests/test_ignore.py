@@ -0,0 +1,79 @@
+import os
+import random
+
+from fnmatch import fnmatch
+from pathlib import Path
+
+import pytest
+
+import tote
+
+
+NAMES = ['a', 'b', 'ab', 'c.py', 'd.pyc', '.tote', 'x', 'build', 'node']
+PATTERNS = [
+    'a', '*.pyc', '/b', 'b/a', '!a', '!*.py', 'x/', '/x/a', 'a/*/c.py', '?b', '[ab]', '[!a]', 'bu*', '!/build',
+    '*', 'a/b/c.py', '!.tote', 'node/x', '/a/b', '[a-c]*', '#c', '', 'b/./a', '[z-a]', '[', 'a/**/x', 'x/a/b/c',
+]
+
+
+def _rule_matches(rule, parts):
+    # a rule checked with fnmatch on the last parts of the path, the way the rules were first written
+    if rule.anchored and len(rule.pattern) != len(parts):
+        return None
+    for a, b in zip(parts[-len(rule.pattern):], rule.pattern):
+        if not fnmatch(a, b):
+            return None
+    return not rule.invert
+
+
+def _expected(path, base):
+    '''whether path is ignored, looking at the rules of each directory from the nearest up to base'''
+    name = ()
+    while path != base and path.parent != path:
+        name = (path.name,) + name
+        path = path.parent
+        for rule in tote._load_ignore_rules(path).rules:
+            ignore = _rule_matches(rule, name)
+            if ignore is not None:
+                return ignore
+    return True if name[-1:] == ('.tote',) else None
+
+
+def _expected_walk(path, base):
+    if _expected(path, base):
+        return []
+    paths = [str(path)]
+    if path.is_dir() and not path.is_symlink():
+        for name in sorted(os.listdir(path)):
+            paths.extend(_expected_walk(path / name, base))
+    return paths
+
+
+def _make_tree(rnd, path, depth=0):
+    path.mkdir(parents=True, exist_ok=True)
+    if rnd.random() < 0.4:
+        (path / '.toteignore').write_text('\n'.join(rnd.choice(PATTERNS) for _ in range(rnd.randint(1, 6))) + '\n')
+    for name in rnd.sample(NAMES, rnd.randint(1, 5)):
+        if depth < 4 and rnd.random() < 0.5:
+            _make_tree(rnd, path / name, depth + 1)
+        else:
+            (path / name).write_text('x')
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_ignore_rules_match_fnmatch(tmp_path, seed):
+    rnd = random.Random(seed)
+    root = tmp_path / 'w'
+    _make_tree(rnd, root)
+    if rnd.random() < 0.5:
+        # rules above the base only count without a base
+        (tmp_path / '.toteignore').write_text('\n'.join(rnd.choice(PATTERNS) for _ in range(3)) + '\n')
+
+    for base in (None, root):
+        expected = _expected_walk(root, base or Path(root.anchor))
+        assert [ str(p) for p in tote.list_trees([root], base_path=base) ] == expected
+        assert [ str(p) for p in tote.list_trees([root], base_path=base, threads=4) ] == expected
+
+        manager = tote._Ignore_Manager(base_path=base)
+        for path in root.rglob('*'):
+            assert manager.matches(path) == _expected(path, base or Path(root.anchor)), path
@@ -0,0 +1,99 @@
+import io
+import os
+
+import tote
+import tote.store
+
+from tote.index import CheckinIndex
+
+
+def test_passed_through_fold_gets_an_index_page(connect, tmp_path):
+    conn = connect()
+    work = conn.workdir_path
+    for i in range(20):
+        (work / ('file%02d' % i)).write_text('data %d' % i)
+    first = tmp_path / 'first.tote'
+    second = tmp_path / 'second.tote'
+
+    def update(arc, arc_output, write_index):
+        tote.tote_update(
+            arc, [work], relative_to=work, base_path=work, arc_output=arc_output, conn=conn,
+            history=False, write_index=write_index,
+        )
+
+    # the first checkin has no index, nothing changes in the second so its fold is passed through
+    update(None, first, False)
+    update(first, second, True)
+
+    with conn.read_file(first, unfold=False) as f:
+        folds = [ item for item in f if item.type == 'fold' ]
+    with conn.read_file(second, unfold=False) as f:
+        assert [ item for item in f if item.type == 'fold' ] == folds
+
+    index = CheckinIndex(second.with_name(second.name + '.index'))
+    try:
+        for fold in folds:
+            page = index.get(tote._fold_id(fold))
+            assert page is not None
+            names = [ item.name for item in conn._fold_items(fold) ]
+            assert [ item.name for item in tote.decode_items_bytes(page) ] == names
+    finally:
+        index.close()
+
+
+def _count_saves(conn, monkeypatch):
+    saved = []
+    save_stream = conn.store.save_stream
+    def saving(name, f):
+        saved.append(name)
+        return save_stream(name, f)
+    monkeypatch.setattr(conn.store, 'save_stream', saving)
+    return saved
+
+
+def test_a_known_chunk_is_not_stored_again(connect, monkeypatch):
+    conn = connect('[chunk]\nsize = 64K\n')
+    data = os.urandom(300000)
+    item = conn.put_stream(io.BytesIO(data))
+    assert len(conn.chunk_index) == len(item.content)
+    conn.close()
+
+    # the index outlives the connection
+    with tote.connect(conn.workdir_path) as conn:
+        saved = _count_saves(conn, monkeypatch)
+        assert conn.put_stream(io.BytesIO(data)).content == item.content
+        assert saved == []
+        # a new chunk is stored
+        conn.put_stream(io.BytesIO(data + b'more'))
+        assert len(saved) == 1
+
+
+def test_rebuild_keeps_only_chunks_in_the_store(connect, tmp_path, monkeypatch):
+    conn = connect('[chunk]\nsize = 64K\n')
+    work = conn.workdir_path
+    for i in range(3):
+        (work / ('file%d' % i)).write_bytes(os.urandom(100000))
+    arc = tmp_path / 'arc.tote'
+    tote.tote_update(None, [work], relative_to=work, base_path=work, arc_output=arc, conn=conn, history=False)
+    # the files' chunks and the fold's
+    known = len(conn.chunk_index)
+
+    with conn.read_file(arc) as items:
+        chunks = [ c for item in items if item.type == 'file' for c in item.content ]
+    assert len(chunks) == 6
+    missing = chunks[0]
+    blob = conn.store.load(missing.data)
+    os.unlink(tote.store.file_path(str(conn.store_path / 'blobs'), missing.data))
+
+    conn.chunk_index.clear()
+    conn.rebuild_chunk_index(archives=[arc])
+    assert len(conn.chunk_index) == known
+    conn.rebuild_chunk_index(archives=[arc], check=True)
+    assert len(conn.chunk_index) == known - 1
+    assert conn.chunk_index.get(missing.sha256, missing.lock) is None
+
+    # the chunk whose blob went missing is stored again
+    saved = _count_saves(conn, monkeypatch)
+    conn.put_stream(io.BytesIO((work / 'file0').read_bytes()))
+    assert saved == [missing.data]
+    assert conn.store.load(missing.data) == blob
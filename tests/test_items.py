@@ -0,0 +1,57 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import tote
+
+
+def _items():
+    chunk = tote.Chunk(size=5, sha256='11' * 32, lock='aes256ctr', key='22' * 32, data='33' * 32)
+    mtime = datetime(2020, 2, 29, 12, 30, 15, 123456, tzinfo=timezone(timedelta(hours=-5)))
+    items = [
+        tote.FileItem(name='a dir', type='dir', mtime=mtime),
+        tote.FileItem(name='a dir/file.txt', type='file', mtime=mtime, size=5, content=[chunk], sha256='44' * 32),
+        tote.FileItem(name='a dir/link', type='link', mtime=mtime, target='../somewhere else'),
+        tote.FileItem(name='a dir/unreadable', type='file', mtime=mtime, error='PermissionError'),
+        tote.FileItem(name='empty', type='file', mtime=mtime, size=0, content=[], sha256=tote.sha256(b'').hexdigest()),
+        tote.FileItem(name='many/chunks', type='file', size=10, content=[chunk, chunk]),
+        tote.FileItem(name='many/chunks with a longer name', type='file', size=-1),
+        tote.FileItem(name='ünïcödé/名前', type='other'),
+        tote.FoldItem(name_min='x/a', name_max='x/z', type='fold', content=[chunk], count=12),
+    ]
+    return sorted(items, key=tote._item_sort_key)
+
+
+def test_text_round_trip():
+    items = _items()
+    text = ''.join(tote.encode_item_text(item) for item in items)
+    assert list(tote.decode_items_bytes(text.encode())) == items
+
+
+def test_binary_round_trip():
+    items = _items()
+    page = tote._BinaryItemWriter()
+    for item in items:
+        page.write(item)
+    assert list(tote.decode_items_bytes(page.getvalue())) == items
+
+
+def test_binary_sorts_items_written_out_of_order():
+    items = _items()
+    page = tote._BinaryItemWriter()
+    for item in reversed(items):
+        page.write(item)
+    assert list(tote.decode_items_bytes(page.getvalue())) == items
+
+
+@pytest.mark.parametrize('format', ['text', 'binary'])
+def test_archive_round_trip(connect, tmp_path, format):
+    conn = connect('[fold]\nformat = %s\n' % format)
+    items = [ item for item in _items() if item.type != 'fold' ]
+    arc = tmp_path / 'test.tote'
+    with conn.write_file(arc) as w:
+        w.writeall(conn.fold(items))
+    with conn.read_file(arc, unfold=False) as f:
+        assert [ item.type for item in f ] == ['fold']
+    with conn.read_file(arc) as f:
+        assert list(f) == items
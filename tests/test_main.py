@@ -0,0 +1,26 @@
+import tote
+import tote.main
+
+
+def test_commands_close_their_connection(connect, tmp_path, monkeypatch, capsys):
+    conn = connect()
+    (conn.workdir_path / 'file').write_text('data')
+    conn.close()
+    monkeypatch.chdir(conn.workdir_path)
+
+    opened = []
+    connect_workdir = tote.connect
+    def connecting(*args, **kwargs):
+        opened.append(connect_workdir(*args, **kwargs))
+        return opened[-1]
+    monkeypatch.setattr(tote, 'connect', connecting)
+
+    for argv in (['checkin'], ['status'], ['chunk-index']):
+        tote.main.main(argv)
+    assert 'chunks' in capsys.readouterr().out
+
+    assert len(opened) == 3
+    for conn in opened:
+        # a closed connection has let go of its chunk index and pools
+        assert conn.chunk_index is None
+        assert conn._put_pool._shutdown
@@ -0,0 +1,125 @@
+import os
+
+from hashlib import sha256
+
+import tote
+
+from tote.store import FileStore, PackStore
+
+
+def _blobs(n):
+    return [ os.urandom(1000 + i) for i in range(n) ]
+
+
+def test_save_and_load_over_several_packs(tmp_path):
+    store = PackStore(tmp_path, pack_size=2**14)
+    blobs = _blobs(50)
+    names = [ store.save(blob) for blob in blobs ]
+    store.close()
+
+    assert names == [ sha256(blob).hexdigest() for blob in blobs ]
+    packs = sorted(p.name for p in (tmp_path / 'packs').iterdir() if p.name.endswith('.pack'))
+    assert len(packs) > 3
+    # every full pack has an index, the last one is appended to
+    assert len([ p for p in (tmp_path / 'packs').iterdir() if p.name.endswith('.idx') ]) == len(packs) - 1
+
+    store = PackStore(tmp_path, pack_size=2**14)
+    try:
+        assert [ store.load(name) for name in names ] == blobs
+        assert [ bytes(blob) for blob in store.load_many(names) ] == blobs
+        assert store.exists_many(names + ['0' * 64]) == [True] * len(names) + [False]
+    finally:
+        store.close()
+
+
+def test_a_missing_index_is_rebuilt(tmp_path):
+    store = PackStore(tmp_path, pack_size=2**14)
+    blobs = _blobs(30)
+    names = [ store.save(blob) for blob in blobs ]
+    store.close()
+
+    idx = sorted((tmp_path / 'packs').glob('*.idx'))[0]
+    idx.unlink()
+    store = PackStore(tmp_path, pack_size=2**14)
+    try:
+        assert idx.exists()
+        assert [ store.load(name) for name in names ] == blobs
+    finally:
+        store.close()
+
+
+def test_blobs_saved_by_another_store_are_found(tmp_path):
+    a = PackStore(tmp_path)
+    b = PackStore(tmp_path)
+    try:
+        blob = os.urandom(1000)
+        name = a.save(blob)
+        assert b.exists(name)
+        assert b.load(name) == blob
+        # both append to the same pack without overwriting each other
+        other = os.urandom(1000)
+        assert a.load(b.save(other)) == other
+        assert b.load(name) == blob
+    finally:
+        a.close()
+        b.close()
+
+
+def test_repack_moves_loose_blobs_and_drops_the_others(tmp_path):
+    (tmp_path / 'blobs').mkdir()
+    loose = FileStore(tmp_path)
+    kept_loose, dropped_loose = _blobs(2)
+    loose_names = [ loose.save(kept_loose), loose.save(dropped_loose) ]
+    store = PackStore(tmp_path)
+    try:
+        blobs = _blobs(10)
+        names = [ store.save(blob) for blob in blobs ]
+        # loose blobs are read too
+        assert store.load(loose_names[0]) == kept_loose
+
+        keep = set(names[:5]) | { loose_names[0] }
+        kept, removed = store.repack(keep=keep)
+        assert kept == (6, sum(map(len, blobs[:5])) + len(kept_loose))
+        assert removed == (6, sum(map(len, blobs[5:])) + len(dropped_loose))
+
+        assert [ store.exists(name) for name in names ] == [True] * 5 + [False] * 5
+        assert store.load(loose_names[0]) == kept_loose
+        assert not store.exists(loose_names[1])
+        assert [ p for p in (tmp_path / 'blobs').rglob('*') if p.is_file() ] == []
+    finally:
+        store.close()
+
+
+def test_put_and_get(connect, round_trip):
+    conn = connect('[chunk]\nsize = 256K\n[store]\ntype = pack\npack_size = 1M\n')
+    assert len(round_trip(conn).content) > 2
+
+
+def test_prune_keeps_the_history_of_an_archive(connect, tmp_path):
+    conn = connect('[store]\ntype = pack\n')
+    work = conn.workdir_path
+    arc = tmp_path / 'a.tote'
+
+    def update(data, mtime):
+        (work / 'file').write_bytes(data)
+        os.utime(work / 'file', (mtime, mtime))
+        tote.tote_update(arc if arc.exists() else None, [work], relative_to=work, base_path=work, arc_output=arc, conn=conn)
+
+    first = os.urandom(5000)
+    update(first, 1500000000)
+    update(os.urandom(5000), 1600000000)
+
+    store = conn.local_store()
+    try:
+        store.repack(keep=conn.referenced_blobs([arc]))
+    finally:
+        store.close()
+
+    # the version of the archive before is in its history and can still be read back, through a
+    # new connection as the old one still has the packs removed open
+    with tote.connect(work) as conn:
+        with conn.read_file(str(arc) + '.history') as f:
+            [version] = list(f)
+        items = tote.decode_items_bytes(b''.join(conn.get_chunks(version)))
+        [item] = [ item for item in conn.unfold(items) if str(item.name) == 'file' ]
+        assert b''.join(conn.get_chunks(item)) == first
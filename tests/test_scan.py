@@ -0,0 +1,41 @@
+import random
+
+from pathlib import PurePosixPath
+
+import pytest
+
+import tote
+
+
+# names that sort differently by parts than as whole paths
+NAMES = ['a', 'a b', 'a-b', 'a.b', 'ab', 'B', 'z', 'é']
+
+
+def _make_tree(root, depth, rng):
+    for name in rng.sample(NAMES, rng.randint(1, len(NAMES))):
+        path = root / name
+        if depth and rng.random() < 0.6:
+            path.mkdir()
+            _make_tree(path, depth - 1, rng)
+        elif rng.random() < 0.1:
+            path.symlink_to('a')
+        else:
+            path.write_text(name)
+
+
+@pytest.mark.parametrize('threads', [1, 2, 4, 8])
+def test_threaded_scan_order_matches_the_serial_walk(tmp_path, threads):
+    _make_tree(tmp_path, 4, random.Random(threads))
+    # an empty directory and several roots, one of them under another
+    (tmp_path / 'empty').mkdir()
+    roots = [tmp_path / 'z', tmp_path, tmp_path / 'a']
+    roots = [ root for root in roots if root.exists() ]
+
+    serial = [ str(p) for p in tote.list_trees(roots, base_path=tmp_path) ]
+    assert serial == sorted(set(serial), key=lambda p: PurePosixPath(p).parts)
+    assert len(serial) > 50
+    assert [ str(p) for p in tote.list_trees(roots, base_path=tmp_path, threads=threads) ] == serial
+
+    items = list(tote.scan_trees([tmp_path], relative_to=tmp_path, base_path=tmp_path))
+    threaded = list(tote.scan_trees([tmp_path], relative_to=tmp_path, base_path=tmp_path, threads=threads))
+    assert threaded == items
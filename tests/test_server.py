@@ -0,0 +1,106 @@
+import asyncio
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+from hashlib import sha256
+
+import pytest
+import requests
+
+from tote.server import BlobServer, _stop
+from tote.store import FileStore, PackStore
+
+
+@contextmanager
+def _serving(server):
+    '''
+    run the BlobServer on a loop in a thread, yields its url.
+    '''
+    loop = asyncio.new_event_loop()
+    started = loop.run_until_complete(server.start('127.0.0.1', 0))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:%d/' % started.sockets[0].getsockname()[1]
+    finally:
+        asyncio.run_coroutine_threadsafe(_stop(started, timeout=1), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+class _SlowStore(FileStore):
+    '''
+    a store that holds a lock for a while to save a blob and takes it to look one up, as a pack store does.
+    '''
+    def __init__(self, path):
+        super().__init__(path)
+        self.lock = threading.Lock()
+        self.saving = threading.Event()
+
+    def save_file(self, name, path):
+        with self.lock:
+            self.saving.set()
+            time.sleep(1)
+            super().save_file(name, path)
+
+    def locate(self, name):
+        with self.lock:
+            return super().locate(name)
+
+    def exists(self, name):
+        with self.lock:
+            return super().exists(name)
+
+
+def test_lookups_do_not_hold_up_the_loop(tmp_path):
+    (tmp_path / 'blobs').mkdir()
+    store = _SlowStore(tmp_path)
+    with _serving(BlobServer(store)) as url:
+        blob = os.urandom(1000)
+        name = sha256(blob).hexdigest()
+        put = threading.Thread(target=requests.put, args=(url + name, blob))
+        put.start()
+        assert store.saving.wait(5)
+        # a lookup waits for the save, the server answers others meanwhile
+        head = threading.Thread(target=requests.head, args=(url + sha256(b'other').hexdigest(),))
+        head.start()
+        time.sleep(0.1)
+        start = time.perf_counter()
+        assert requests.get(url + 'not-a-blob').status_code == 404
+        assert time.perf_counter() - start < 0.5
+        put.join()
+        head.join()
+        assert requests.get(url + name).content == blob
+
+
+@pytest.mark.parametrize('store_type', [FileStore, PackStore])
+def test_put_head_and_get(tmp_path, store_type):
+    (tmp_path / 'blobs').mkdir()
+    with _serving(BlobServer(store_type(tmp_path))) as url:
+        blob = os.urandom(5000)
+        name = sha256(blob).hexdigest()
+
+        assert requests.head(url + name).status_code == 404
+        # a body that does not hash to the name is refused
+        assert requests.put(url + name, data=blob[1:]).status_code == 400
+        assert requests.put(url + name, data=blob).status_code == 201
+        assert requests.put(url + name, data=blob).status_code == 204
+        head = requests.head(url + name)
+        assert head.status_code == 200
+        assert int(head.headers['content-length']) == len(blob)
+        assert requests.get(url + name).content == blob
+        assert requests.get(url + 'not-a-blob').status_code == 404
+        assert requests.delete(url + name).status_code == 405
+
+
+def test_basic_auth(tmp_path):
+    (tmp_path / 'blobs').mkdir()
+    blob = b'a blob'
+    name = FileStore(tmp_path).save(blob)
+    with _serving(BlobServer(FileStore(tmp_path), auth=('me', 'secret'))) as url:
+        assert requests.get(url + name).status_code == 401
+        assert requests.get(url + name, auth=('me', 'wrong')).status_code == 401
+        assert requests.get(url + name, auth=('me', 'secret')).content == blob
@@ -0,0 +1,78 @@
+import os
+import threading
+
+from hashlib import sha256
+from os.path import isfile
+
+from tote.store import FileStore, StagedStore, UrlStore
+
+
+def test_flush_while_staging(tmp_path, blob_server):
+    upstream = UrlStore(blob_server, None, retries=0)
+    staged = StagedStore(upstream, tmp_path / 'staging', workers=4)
+    blobs = [ os.urandom(100 + i) for i in range(60) ]
+    done = threading.Event()
+
+    def stage():
+        try:
+            for blob in blobs:
+                staged.save(blob)
+        finally:
+            done.set()
+
+    # flushes run while blobs are staged, none of them may be dropped
+    thread = threading.Thread(target=stage)
+    thread.start()
+    while not done.is_set():
+        staged.flush()
+    thread.join()
+    staged.flush()
+
+    try:
+        assert staged.pending() == []
+        names = [ sha256(blob).hexdigest() for blob in blobs ]
+        assert upstream.exists_many(names) == [True] * len(names)
+        assert list(os.walk(tmp_path / 'staging' / 'blobs'))[0][2] == []
+    finally:
+        upstream.close()
+
+
+def test_flush_picks_up_a_blob_staged_without_its_line(tmp_path):
+    (tmp_path / 'up' / 'blobs').mkdir(parents=True)
+    upstream = FileStore(tmp_path / 'up')
+    staged = StagedStore(upstream, tmp_path / 'staging')
+    blob = os.urandom(1000)
+    name = staged.save(blob)
+    # a crash after the blob was written and before its line
+    staged.journal_path.unlink()
+
+    assert staged.flush() == (1, len(blob))
+    assert bytes(upstream.load(name)) == blob
+
+
+def test_a_failed_upload_is_left_for_the_next_flush(tmp_path, capsys):
+    (tmp_path / 'up' / 'blobs').mkdir(parents=True)
+    failing = set()
+
+    class FailingStore(FileStore):
+        def save(self, blob):
+            if sha256(blob).hexdigest() in failing:
+                raise IOError('no space left')
+            return super().save(blob)
+
+    upstream = FailingStore(tmp_path / 'up')
+    staged = StagedStore(upstream, tmp_path / 'staging', workers=2)
+    blobs = [ os.urandom(1000) for i in range(10) ]
+    names = [ staged.save(blob) for blob in blobs ]
+    failing.add(names[3])
+
+    # the others are uploaded and their staged copies removed, the failed one stays pending
+    assert staged.flush() == (9, 9000)
+    assert staged.pending() == [names[3]]
+    assert [ isfile(staged._staged_path(name)) for name in names ] == [ i == 3 for i in range(10) ]
+    assert 'no space left' in capsys.readouterr().err
+
+    failing.clear()
+    assert staged.flush() == (1, 1000)
+    assert staged.pending() == []
+    assert upstream.exists_many(names) == [True] * 10
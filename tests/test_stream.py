@@ -0,0 +1,77 @@
+import io
+import os
+
+from hashlib import sha256
+
+import pytest
+
+from tote.compress import BufferReader
+from tote.store import FileStore, PackStore, StagedStore, UrlStore
+
+
+@pytest.fixture(params=['file', 'pack', 'url', 'staged'])
+def store(request, tmp_path):
+    if request.param == 'file':
+        (tmp_path / 'blobs').mkdir()
+        yield FileStore(tmp_path)
+    elif request.param == 'pack':
+        store = PackStore(tmp_path, pack_size=2**16)
+        yield store
+        store.close()
+    elif request.param == 'url':
+        store = UrlStore(request.getfixturevalue('blob_server'), None, retries=0)
+        yield store
+        store.close()
+    else:
+        (tmp_path / 'blobs').mkdir()
+        yield StagedStore(FileStore(tmp_path), tmp_path / 'staging')
+
+
+def test_buffer_reader():
+    f = BufferReader(b'abc', b'', b'defg')
+    assert len(f) == 7
+    # a read inside one buffer is a view of it
+    assert isinstance(f.read(2), memoryview)
+    assert bytes(f.read(3)) == b'cde'
+    assert f.tell() == 5
+    assert bytes(f.read()) == b'fg'
+    assert bytes(f.read(10)) == b''
+    assert f[1:6] == b'bcdef'
+    f.seek(-1, 2)
+    assert bytes(f.read()) == b'g'
+
+
+def test_save_stream(store):
+    blob = os.urandom(3 * 2**20 + 17)
+    name = sha256(blob).hexdigest()
+
+    assert store.save_stream(name, BufferReader(blob[:5], blob[5:])) == name
+    assert bytes(store.load(name)) == blob
+    assert [ bytes(b) for b in store.load_many([name]) ] == [blob]
+
+
+class _Writes(io.BytesIO):
+    '''
+    a file that keeps the length of the largest write.
+    '''
+    largest = 0
+
+    def write(self, data):
+        self.largest = max(self.largest, len(data))
+        return super().write(data)
+
+
+@pytest.mark.parametrize('config', ['', '[compress]\ncodec = none\n', 'url'], ids=['file', 'none', 'url'])
+def test_get_stream_decodes_a_piece_at_a_time(request, connect, config):
+    if config == 'url':
+        config = '[store]\nurl = %s\n' % request.getfixturevalue('blob_server')
+    conn = connect('[chunk]\nsize = 4M\n' + config)
+    data = os.urandom(5 * 2**20) + b'text' * 2**18
+
+    item = conn.put_stream(io.BytesIO(data))
+    assert len(item.content) == 2
+
+    out = _Writes()
+    conn.get_stream(item, out, piece_size=2**16)
+    assert out.getvalue() == data
+    assert out.largest <= 2**16
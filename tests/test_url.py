@@ -0,0 +1,93 @@
+import os
+import threading
+import time
+
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from tote.store import UrlStore
+
+
+@pytest.fixture
+def busy_server():
+    '''
+    a server that answers 503 to the first GET of each blob and takes a while over the others,
+    yields its url and its state.
+    '''
+    state = { 'blobs': {}, 'busy': set(), 'active': 0, 'most': 0 }
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            name = self.path.rpartition('/')[2]
+            with lock:
+                if name not in state['busy']:
+                    state['busy'].add(name)
+                    self.send_response(503)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                state['active'] += 1
+                state['most'] = max(state['most'], state['active'])
+            time.sleep(0.05)
+            blob = state['blobs'][name]
+            with lock:
+                state['active'] -= 1
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(blob)))
+            self.end_headers()
+            self.wfile.write(blob)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:%d/' % server.server_address[1], state
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def test_save_and_load(blob_server):
+    store = UrlStore(blob_server, None, retries=0)
+    try:
+        blobs = [ os.urandom(n) for n in [0, 1, 1000] + [ 100 + i for i in range(40) ] ]
+        names = [ store.save(blob) for blob in blobs ]
+
+        assert names == [ sha256(blob).hexdigest() for blob in blobs ]
+        assert bytes(store.load(names[2])) == blobs[2]
+        # loaded several at once, yielded in order
+        assert [ bytes(blob) for blob in store.load_many(names) ] == blobs
+        assert store.exists_many(names + ['0' * 64]) == [True] * len(names) + [False]
+        with pytest.raises(IOError):
+            store.load('0' * 64)
+    finally:
+        store.close()
+
+
+def test_a_busy_server_is_retried_over_several_connections(busy_server):
+    url, state = busy_server
+    blobs = [ os.urandom(100 + i) for i in range(16) ]
+    names = [ sha256(blob).hexdigest() for blob in blobs ]
+    state['blobs'].update(zip(names, blobs))
+
+    store = UrlStore(url, None, connections=4, retries=2, backoff=0)
+    try:
+        assert list(store.load_many(names)) == blobs
+    finally:
+        store.close()
+    assert state['busy'] == set(names)
+    assert 1 < state['most'] <= 4
+
+
+def test_put_and_get(blob_server, connect, round_trip):
+    conn = connect('[chunk]\nsize = 256K\n[store]\nurl = %s\n' % blob_server)
+    assert len(round_trip(conn).content) > 2
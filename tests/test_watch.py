@@ -0,0 +1,62 @@
+import tote
+import tote.main
+
+from tote.watch import Journal
+
+
+def test_advance_keeps_the_changes_after_the_read(tmp_path):
+    journal = Journal(tmp_path)
+    session = journal.start()
+    journal.append(['ready', 'r "a"'])
+    with journal.watcher_lock():
+        state = journal.read()
+        assert state.session == session and state.ready and state.trees == {'a'}
+        # not tied to a checkin yet
+        assert state.dirty_regions(tmp_path / 'c1.tote') is None
+
+        journal.append(['r "b"', 'd "c"'])
+        journal.advance(state, tmp_path / 'c1.tote')
+        state = journal.read()
+        assert state.checkin == 'c1.tote'
+        assert (state.trees, state.entries) == ({'b'}, {'c'})
+        assert state.dirty_regions(tmp_path / 'c1.tote') is not None
+        assert state.dirty_regions(tmp_path / 'c0.tote') is None
+
+    # nobody is watching
+    assert journal.read().dirty_regions(tmp_path / 'c1.tote') is None
+
+
+def test_checkin_scans_the_journal_regions_and_everything_after_an_overflow(connect, monkeypatch):
+    conn = connect()
+    work = conn.workdir_path
+    for name in 'ab':
+        (work / name).mkdir()
+        (work / name / 'old').write_text('old')
+    conn.close()
+    monkeypatch.chdir(work)
+
+    def checked_in():
+        with tote.connect(work) as conn:
+            with conn.read_file(conn._most_recent_checkin()) as items:
+                return { str(item.name) for item in items }
+
+    journal = Journal(work / '.tote')
+    journal.start()
+    journal.append(['ready'])
+    with journal.watcher_lock():
+        tote.main.main(['checkin'])
+        assert checked_in() == {'.', 'a', 'a/old', 'b', 'b/old'}
+        assert journal.read().checkin is not None
+
+        # only a is in the journal, so b is not looked at
+        (work / 'a' / 'new').write_text('new')
+        (work / 'b' / 'new').write_text('new')
+        journal.append(['r "a"'])
+        tote.main.main(['checkin'])
+        assert checked_in() == {'.', 'a', 'a/old', 'a/new', 'b', 'b/old'}
+
+        # changes were lost, the whole workdir is scanned
+        journal.append(['!overflow'])
+        assert journal.read().overflow
+        tote.main.main(['checkin'])
+        assert checked_in() == {'.', 'a', 'a/old', 'a/new', 'b', 'b/old', 'b/new'}
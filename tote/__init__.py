@@ -2,25 +2,33 @@ import configparser
 import sys
 import json
 import os
+import queue
+import re
+import threading
 import time
-import zlib
 
 from Crypto.Cipher import AES
 from Crypto.Util import Counter
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from dataclasses import dataclass, field
 from fnmatch import fnmatch
 from functools import lru_cache
 from hashlib import sha256
-from heapq import heapify, heappop, heappush
-from itertools import chain, groupby
+from bisect import bisect_right
+from heapq import heapify, heappop, heappush, merge as heapq_merge
+from itertools import chain, count, islice
 from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from functools import partial
-from os.path import expanduser, expandvars, ismount
-from pathlib import Path, PurePosixPath
+from os.path import expanduser, expandvars
+from pathlib import Path, PurePath, PurePosixPath
+from stat import S_ISDIR, S_ISLNK, S_ISREG
 
-from .store import FileStore, UrlStore 
+from .chunker import make_chunker
+from .compress import BufferReader, compress_blob, compress_stream, decompress_blob, decompress_reader, get_codec
+from .index import CheckinIndex, CheckinIndexWriter, ChunkIndex
+from .store import CachedStore, FileStore, PackStore, StagedStore, UrlStore 
 
 
 def connect(path=None):
@@ -65,6 +73,33 @@ def _load_config(config_path):
     c.read([ config_path ])
     return c
 
+
+def _parse_size(text):
+    '''
+    parse a size like 4096, 512K, 16M or 1G into a number of bytes.
+    '''
+    text = str(text).strip().upper().rstrip('B')
+    units = { 'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40 }
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def _load_chunker(config):
+    '''
+    make the chunker from the [chunk] section of the config.
+    '''
+    def size(name, default):
+        return _parse_size(config.get('chunk', name, fallback=default))
+
+    return make_chunker(
+        method=config.get('chunk', 'method', fallback='fixed'),
+        size=size('size', '16M'),
+        min_size=size('min_size', '512K'),
+        avg_size=size('avg_size', '2M'),
+        max_size=size('max_size', '8M'),
+    )
+
         
 class _ToteConnection:
     def __init__(self, workdir_path):
@@ -85,10 +120,15 @@ class _ToteConnection:
             store_path = workdir_path / '.tote'
         
         self.store_path = store_path
-        self.store = FileStore(self.store_path)
+        self.store_type = self.config.get('store', 'type', fallback='file')
+        if self.store_type not in ('file', 'pack'):
+            raise ValueError('unknown store type', self.store_type)
+        self.pack_size = _parse_size(self.config.get('store', 'pack_size', fallback='1G'))
 
         store_url = self.config.get('store', 'url', fallback=None)
-        if store_url is not None:
+        if store_url is None:
+            self.store = self.local_store()
+        else:
             store_username = self.config.get('store', 'username', fallback=None)
             if store_username is not None:
                 store_password = self.config.get('store', 'password', fallback=None)
@@ -96,7 +136,102 @@ class _ToteConnection:
             else:
                 store_auth = None
             
-            self.store = UrlStore(url=store_url, auth=store_auth)
+            self.store = UrlStore(
+                url=store_url,
+                auth=store_auth,
+                connections=self.config.getint('store', 'connections', fallback=8),
+                retries=self.config.getint('store', 'retries', fallback=3),
+            )
+
+        self.store_id = store_url if store_url is not None else str(self.store_path)
+
+        self.staging = None
+        self.staging_flush = self.config.get('staging', 'flush', fallback='background')
+        if store_url is not None and self.config.getboolean('staging', 'enabled', fallback=False):
+            staging_path = self.config.get('staging', 'path', fallback=None)
+            if staging_path is not None:
+                staging_path = Path(expanduser(expandvars(staging_path)))
+                if not staging_path.is_absolute():
+                    staging_path = self.workdir_path / staging_path
+            else:
+                staging_path = self.tote_path / 'staging'
+            self.staging = StagedStore(self.store, staging_path, workers=self.store.connections)
+            self.store = self.staging
+
+        cache_size = self.config.get('cache', 'size', fallback=None)
+        if cache_size is not None:
+            cache_path = self.config.get('cache', 'path', fallback=None)
+            if cache_path is not None:
+                cache_path = Path(expanduser(expandvars(cache_path)))
+                if not cache_path.is_absolute():
+                    cache_path = self.workdir_path / cache_path
+            else:
+                cache_path = self.tote_path / 'cache'
+            self.store = CachedStore(self.store, cache_path, _parse_size(cache_size))
+
+        self.chunker = _load_chunker(self.config)
+
+        self.codec = self.config.get('compress', 'codec', fallback='zlib')
+        self.level = self.config.getint('compress', 'level', fallback=None)
+        self.compress_check = self.config.getboolean('compress', 'check', fallback=True)
+
+        self.fold_format = self.config.get('fold', 'format', fallback='text')
+        if self.fold_format not in ('text', 'binary'):
+            raise ValueError('unknown fold format', self.fold_format)
+        get_codec(self.codec)
+
+        # chunks are compressed, encrypted and stored on a pool, zlib, hashlib and the cipher release the GIL
+        self.put_workers = self.config.getint('put', 'workers', fallback=os.cpu_count() or 1)
+        self._put_pool = ThreadPoolExecutor(max_workers=max(self.put_workers, 1), thread_name_prefix='tote-put')
+        # chunks in flight across all the files being put at once
+        self._put_slots = threading.BoundedSemaphore(2 * max(self.put_workers, 1))
+
+        # files read at once by put_files and checkin
+        self.put_files_workers = self.config.getint('put', 'files', fallback=4)
+        self._file_pool = ThreadPoolExecutor(max_workers=max(self.put_files_workers, 1), thread_name_prefix='tote-file')
+
+        # folds loaded and decoded ahead of unfold
+        self.unfold_prefetch = self.config.getint('unfold', 'prefetch', fallback=4)
+        self._fold_pool = ThreadPoolExecutor(max_workers=max(self.unfold_prefetch, 1), thread_name_prefix='tote-fold')
+        self.unfold_stats = UnfoldStats()
+
+        # directories listed at once while scanning the workdir, 0 lists them one at a time
+        self.scan_threads = self.config.getint('scan', 'threads', fallback=0)
+
+        self.chunk_index = None
+        if self.config.getboolean('index', 'chunks', fallback=True):
+            self.chunk_index = self._open_chunk_index()
+
+        # write a side index of the items next to each checkin, for status and checkin to compare against
+        self.checkin_index = self.config.getboolean('index', 'checkins', fallback=True)
+
+    def close(self):
+        '''
+        wait for the worker pools and shut them down, then close the chunk index and the store.
+        '''
+        for pool in (self._put_pool, self._file_pool, self._fold_pool):
+            pool.shutdown()
+        if self.chunk_index is not None:
+            self.chunk_index.close()
+            self.chunk_index = None
+        close = getattr(self.store, 'close', None)
+        if close is not None:
+            close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _open_chunk_index(self):
+        '''
+        open the known chunk index for the store, there is one per store since the records point into it.
+        '''
+        name = 'chunks-%s.sqlite' % sha256(self.store_id.encode()).hexdigest()[:16]
+        path = self.tote_path / 'index' / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return ChunkIndex(path)
         
     @contextmanager
     def read_file(self, file_name, unfold=True):
@@ -136,47 +271,127 @@ class _ToteConnection:
 #     items_out = conn.write_stream(stream)
 #     items_out.write(item)
 
-    def fold(self, items, fold_size=2**22):
-        page = list()
-        page_size = 0
+    def fold(self, items, fold_size=2**22, index=None):
+        '''
+        group items into fold pages of about fold_size bytes.
+
+        The pages end after items picked by a hash of their name alone, so an added or removed item,
+        or one whose size or time changed, only changes the page it is in, the pages after it stay
+        the same and dedup in the store.
+
+        Past fold_size / 4 a page ends after one item in every (fold_size - fold_size / 4) /
+        page.item_size, so pages of typical items average fold_size. No page goes past 4 * fold_size.
+
+        with index, a CheckinIndexWriter, the items of each new page are added to it.
+        '''
+        min_size = fold_size // 4
+        max_size = fold_size * 4
+        page = _page_writer(self.fold_format)
         for item in items:
-            part = encode_item_text(item).encode()
-            if len(part) + page_size > fold_size:
-                yield self._save_fold(page)
-                page.clear()
-                page_size = 0
-            page.append(item)
-            page_size += len(part)
+            if item.type == 'fold':
+                # an unchanged fold passed through by the merge is kept as it is
+                if page:
+                    yield self._save_fold(page, index)
+                    page = _page_writer(self.fold_format)
+                yield item
+                continue
+            size = page.size_of(item)
+            if page and size + page.size > max_size:
+                yield self._save_fold(page, index)
+                page = _page_writer(self.fold_format)
+                size = page.size_of(item)
+            page.write(item, size)
+            if page.size >= min_size and _fold_boundary(item, (fold_size - min_size) // page.item_size):
+                yield self._save_fold(page, index)
+                page = _page_writer(self.fold_format)
         if page:
-            yield self._save_fold(page)
+            yield self._save_fold(page, index)
 
         return
     
     
-    def _save_fold(self, items):
-        items = sorted(items, key=_item_sort_key)
-        return FoldItem(
+    def _save_fold(self, page, index=None):
+        data = page.getvalue()
+        items = page.items
+        fold = FoldItem(
             type='fold',
-            content=[ self._put_chunk(encode_items_bytes(items)) ],
+            content=[ self._put_chunk(data) ],
             count=len(items),
             name_min=items[0].name,
             name_max=items[-1].name,
         )
+        if index is not None:
+            page = _index_page(items)
+            if page is not None:
+                index.add(_fold_id(fold), page)
+        return fold
+
+    def _open_checkin_index(self, arc):
+        '''
+        the CheckinIndex next to arc, None if there is none or it is for another version of arc.
+        '''
+        try:
+            index = CheckinIndex(Path(str(arc) + '.index'))
+        except (OSError, ValueError):
+            return None
+        try:
+            arc_sha256 = sha256(Path(arc).read_bytes()).digest()
+        except OSError:
+            arc_sha256 = None
+        if index.arc_sha256 != arc_sha256:
+            index.close()
+            return None
+        return index
+
+    def _indexed_items(self, index, fold):
+        '''
+        the items of a fold from a CheckinIndex without their content, or None if it is not in it.
+        '''
+        page = index.get(_fold_id(fold))
+        if page is None:
+            return None
+        return decode_items_bytes(page)
 
 
     def unfold(self, items):
-        work = deque(sorted(items, key=_item_sort_key))
-        while work:
-            item = work.popleft()
-            if item.type == 'fold':
-                for chunk in self.get_chunks(item):
-                    lines = chunk.decode().splitlines()
-                    work.extend(decode_item_stream(lines))
-                work = deque(sorted(work, key=_item_sort_key))
-            else:
-                yield item
+        '''
+        yield items with the folds expanded, in sort order.
+
+        The top level items are sorted, then the folds are merged in with a heap as their first
+        name is reached, so only the top level items and the folds open at the current name are
+        in memory.
+        '''
+        heap = []
+        order = count()
+
+        def push(source):
+            item = next(source, None)
+            if item is not None:
+                heappush(heap, (item.sort_key, next(order), item, source))
+
+        items = sorted(items, key=_item_sort_key)
+        # the top level folds are expanded in sort order, load the next few ahead of time
+        prefetch = _FoldPrefetch(self, (item for item in items if item.type == 'fold'))
+        try:
+            push(iter(items))
+            while heap:
+                key, _, item, source = heappop(heap)
+                push(source)
+                if item.type == 'fold':
+                    push(iter(prefetch.get(item)))
+                else:
+                    yield item
+        finally:
+            prefetch.close()
         return
 
+    def _fold_items(self, fold):
+        '''
+        the items in a fold, sorted.
+        '''
+        items = chain.from_iterable(decode_items_bytes(chunk) for chunk in self.get_chunks(fold))
+        return sorted(items, key=_item_sort_key)
+
 #     get -- read item into memory
 #     get_file -- read item into file
 #     get_stream -- read item into stream
@@ -194,19 +409,58 @@ class _ToteConnection:
 
         if item.type == 'file':
             with open(name, 'wb') as f:
-                for chunk in self.get_chunks(item):
-                    f.write(chunk)
+                self.get_stream(item, f)
+
+    def get_stream(self, item, out, piece_size=2**20):
+        '''
+        write the data of item to out, each chunk decoded piece_size bytes at a time.
+
+        blobs the store has in local files are read from them a piece at a time, the others are
+        loaded whole as get_chunks does and decoded from there.
+        '''
+        locate = getattr(self.store, 'locate', None)
+        if locate is None:
+            blobs = self.store.load_many(part.data for part in item.content)
+            files = ( BufferReader(blob) for blob in blobs )
+        else:
+            files = ( _open_located(self.store, locate, part.data) for part in item.content )
+
+        for part, f in zip(item.content, files):
+            try:
+                blob = _DecryptReader(f, lock=part.lock, key=bytes.fromhex(part.key))
+                blob = decompress_reader(blob, piece_size)
+                # a decompressing read may come back short of the 5 bytes
+                prefix = b''
+                while len(prefix) < 5:
+                    data = blob.read(5 - len(prefix))
+                    if not data:
+                        break
+                    prefix += bytes(data)
+                if prefix != b'blob\n':
+                    raise TypeError('not a blob')
+                for data in iter(partial(blob.read, piece_size), b''):
+                    out.write(data)
+            finally:
+                f.close()
 
 
     def get_chunks(self, item):
-        for part in item.content:
-            yield self.get_chunk(part)
+        # the store may load the next blobs while this one is decoded
+        blobs = self.store.load_many(part.data for part in item.content)
+        for part, blob in zip(item.content, blobs):
+            yield self._decode_chunk(part, blob)
     
     def get_chunk(self, part):
-        blob = self.store.load(part.data)
+        return self._decode_chunk(part, self.store.load(part.data))
+
+    def _decode_chunk(self, part, blob):
+        '''
+        the data of a chunk from its blob, as a memoryview. a writable blob is decrypted in place.
+        '''
         key = bytes.fromhex(part.key)
         blob = _decrypt_blob(blob=blob, lock=part.lock, key=key)
-        blob = _decompress_blob(blob)
+        # the decompressed blob is the data after the 'blob\n' prefix
+        blob = _decompress_blob(blob, None if part.size is None else part.size + 5)
         data = _parse_blob(blob)
         return data
 
@@ -222,16 +476,104 @@ class _ToteConnection:
                 item.update(self.put_stream(f))
         return item
 
-    def put_stream(self, stream, chunk_size=2**24, lock='aes256ctr'):
+    def put_files(self, paths):
+        '''
+        put each of paths, reading several files at once, yields the items in the order of paths.
+        '''
+        def work():
+            for path in paths:
+                path = Path(path)
+                item = get_file_info(path)
+                if item.type == 'file':
+                    yield item, partial(_read_into, self, item, path)
+                else:
+                    yield item, None
+
+        return self._put_pipeline(work())
+
+    def _put_pipeline(self, work, max_items=4096):
+        '''
+        work is an iterable of (item, read) pairs, read is None or a function that fills in the item.
+
+        yields the items in the order of work, running up to two reads per file worker at once,
+        with at most max_items items waiting on the reads ahead of them.
+        '''
+        if self.put_files_workers <= 1:
+            for item, read in work:
+                if read is not None:
+                    read()
+                yield item
+            return
+
+        pending = deque()
+        reads = 0
+        max_reads = 2 * self.put_files_workers
+        try:
+            for item, read in work:
+                if read is None:
+                    if not pending:
+                        yield item
+                        continue
+                    pending.append((item, None))
+                else:
+                    pending.append((item, self._file_pool.submit(read)))
+                    reads += 1
+
+                while pending and (
+                    reads >= max_reads or len(pending) >= max_items
+                    or pending[0][1] is None or pending[0][1].done()
+                ):
+                    item, f = pending.popleft()
+                    if f is not None:
+                        f.result()
+                        reads -= 1
+                    yield item
+
+            while pending:
+                item, f = pending.popleft()
+                if f is not None:
+                    f.result()
+                yield item
+        finally:
+            for item, f in pending:
+                if f is not None:
+                    f.cancel()
+
+    def put_stream(self, stream, chunk_size=None, lock='aes256ctr'):
         content = list()
         h = sha256()
         size = 0
+
+        if chunk_size is None:
+            chunks = self.chunker(stream)
+        else:
+            chunks = iter(partial(stream.read, chunk_size), b'')
         
-        for chunk in iter(partial(stream.read, chunk_size), b''):
-            h.update(chunk)
-            size += len(chunk)
-            c = self._put_chunk(chunk, lock)
-            content.append(c)
+        # bound the chunks in flight so memory use does not grow with the file size
+        pending = deque()
+        max_pending = 2 * self.put_workers
+        try:
+            for chunk in chunks:
+                h.update(chunk)
+                size += len(chunk)
+                if self.put_workers <= 1:
+                    content.append(self._put_chunk(chunk, lock))
+                    continue
+                self._put_slots.acquire()
+                try:
+                    f = self._put_pool.submit(self._put_chunk, chunk, lock)
+                except:
+                    self._put_slots.release()
+                    raise
+                f.add_done_callback(lambda f: self._put_slots.release())
+                pending.append(f)
+                if len(pending) >= max_pending:
+                    content.append(pending.popleft().result())
+            while pending:
+                content.append(pending.popleft().result())
+        finally:
+            for f in pending:
+                f.cancel()
 
         return FileItem(
             content=content,
@@ -241,20 +583,117 @@ class _ToteConnection:
     
     
     def _put_chunk(self, chunk, lock='aes256ctr'):
-        blob = _format_blob(chunk)
-        blob = _compress_blob(blob)
-        key = sha256(blob)
-        blob = _encrypt_blob(blob, lock=lock, key=key.digest())
-        data = self.store.save(blob)
-        return Chunk(
+        chunk_sha256 = sha256(chunk).hexdigest()
+        if self.chunk_index is not None:
+            known = self.chunk_index.get(chunk_sha256, lock)
+            if known is not None:
+                size, chunk_sha256, lock, key, data = known
+                return Chunk(size=size, sha256=chunk_sha256, lock=lock, key=key, data=data)
+
+        # the blob is compressed and encrypted a piece at a time, never held whole
+        blob = BufferReader(b'blob\n', chunk)
+        blob = compress_stream(blob, codec=self.codec, level=self.level, check=self.compress_check)
+        try:
+            key = _hash_file(blob)
+            blob = _EncryptReader(blob, lock=lock, key=key.digest())
+            name = _hash_file(blob).hexdigest()
+            data = self.store.save_stream(name, blob)
+        finally:
+            blob.close()
+        c = Chunk(
             size=len(chunk),
-            sha256=sha256(chunk).hexdigest(),
+            sha256=chunk_sha256,
             lock=lock,
             key=key.hexdigest(),
             data=data,
         )
+        if self.chunk_index is not None:
+            self.chunk_index.add(c.size, c.sha256, c.lock, c.key, c.data)
+        return c
     
     
+    def _checkins(self):
+        '''
+        the paths of all the checkins of the workdir, oldest first.
+        '''
+        try:
+            paths = sorted((self.tote_path / 'checkin' / 'default').iterdir())
+        except FileNotFoundError:
+            return []
+        return [ path for path in paths if path.name.endswith('.tote') ]
+
+    def local_store(self):
+        '''
+        the store at the store path, a PackStore or a FileStore by the store type in the config.
+        '''
+        if self.store_type == 'pack':
+            return PackStore(self.store_path, pack_size=self.pack_size)
+        return FileStore(self.store_path)
+
+    def referenced_blobs(self, archives=None):
+        '''
+        the names of the blobs the archives use, default all the checkins, folds within folds included.
+
+        the versions of an archive saved in its .history file and the blobs they use count too.
+        '''
+        if archives is None:
+            archives = self._checkins()
+
+        names = set()
+        for arc in archives:
+            with self.read_file(arc, unfold=False) as items:
+                stack = [ list(items) ]
+            history = Path(str(arc) + '.history')
+            if history.is_file():
+                with self.read_file(history, unfold=False) as items:
+                    for item in items:
+                        names.update(c.data for c in item.content or () if c.data is not None)
+                        if item.type == 'file' and item.content:
+                            version = b''.join(self.get_chunks(item))
+                            stack.append(list(decode_items_bytes(version)))
+            while stack:
+                for item in stack.pop():
+                    names.update(c.data for c in item.content or () if c.data is not None)
+                    if item.type == 'fold':
+                        stack.append(self._fold_items(item))
+        return names
+
+    def rebuild_chunk_index(self, archives=None, check=False):
+        '''
+        refill the known chunk index from the chunks in archives, default all the checkins.
+
+        with check only chunks whose blobs are in the store are added.
+        '''
+        if archives is None:
+            archives = self._checkins()
+
+        self.chunk_index.clear()
+
+        def rows():
+            for arc in archives:
+                with self.read_file(arc, unfold=False) as items:
+                    items = list(items)
+                chunks = chain(
+                    chain.from_iterable(item.content or () for item in items if item.type == 'fold'),
+                    chain.from_iterable(item.content or () for item in self.unfold(items)),
+                )
+                chunks = ( c for c in chunks if None not in (c.size, c.sha256, c.lock, c.key, c.data) )
+                for batch in iter(lambda: list(islice(chunks, 1000)), []):
+                    if check:
+                        # the store is asked about a batch at once
+                        found = self.store.exists_many([ c.data for c in batch ])
+                        batch = [ c for c, ok in zip(batch, found) if ok ]
+                    for c in batch:
+                        yield c.size, c.sha256, c.lock, c.key, c.data
+
+        batch = []
+        for row in rows():
+            batch.append(row)
+            if len(batch) >= 10000:
+                self.chunk_index.add_many(batch)
+                batch.clear()
+        self.chunk_index.add_many(batch)
+
     def _most_recent_checkin(self):
         """
         find the most recent checkin for the workdir
@@ -285,6 +724,64 @@ class _ToteConnection:
             return self.unfold(list(items))
 
 
+class UnfoldStats:
+    '''
+    counts of the folds expanded by unfold and the time spent waiting for them.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.folds = 0
+        self.prefetched = 0
+        self.wait_seconds = 0.0
+
+    def add(self, **kwargs):
+        with self.lock:
+            for name, value in kwargs.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def __str__(self):
+        return 'unfold: folds %d, prefetched %d, waited %.2fs' % (self.folds, self.prefetched, self.wait_seconds)
+
+
+class _FoldPrefetch:
+    '''
+    loads and decodes folds on the connection's fold pool ahead of unfold, in the order they will be expanded.
+    '''
+    def __init__(self, conn, folds):
+        self.conn = conn
+        self.folds = iter(folds)
+        self.pending = {}
+        self.fill()
+
+    def fill(self):
+        while len(self.pending) < self.conn.unfold_prefetch:
+            fold = next(self.folds, None)
+            if fold is None:
+                return
+            self.pending[id(fold)] = self.conn._fold_pool.submit(self.conn._fold_items, fold)
+
+    def get(self, fold):
+        f = self.pending.pop(id(fold), None)
+        self.fill()
+
+        start = time.perf_counter()
+        if f is None:
+            items = self.conn._fold_items(fold)
+        else:
+            items = f.result()
+        self.conn.unfold_stats.add(
+            folds=1,
+            prefetched=0 if f is None else 1,
+            wait_seconds=time.perf_counter() - start,
+        )
+        return items
+
+    def close(self):
+        for f in self.pending.values():
+            f.cancel()
+        self.pending.clear()
+
+
 class ToteWriter:
     def __init__(self, fd=sys.stdout):
         self.fd = fd
@@ -299,53 +796,236 @@ class ToteWriter:
             self.write(item)
 
 
-def _compress_blob(data):
-    out = b'zlib\n' + zlib.compress(data, 9)
-    if len(out) < len(data):
-        return out    
-    else:
-        return data
+def _read_into(conn, item, path):
+    '''
+    put the content of the file at path and fill in item with it.
+    '''
+    with open(path, 'rb') as f:
+        item.update(conn.put_stream(f))
+
+
+def _read_into_or_error(conn, item, path):
+    '''
+    like _read_into, but record an OSError in the item.
+    '''
+    try:
+        _read_into(conn, item, path)
+    except OSError as e:
+        item.error = str(e)
+
+
+def _background(items, size=1024, batch=64):
+    '''
+    iterate items on a background thread, keeping up to size items ready ahead of the caller.
+    '''
+    q = queue.Queue(maxsize=max(size // batch, 1))
+    stop = threading.Event()
+    end = object()
+
+    def put(value):
+        while not stop.is_set():
+            try:
+                q.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run():
+        try:
+            part = []
+            for item in items:
+                part.append(item)
+                if len(part) >= batch:
+                    if not put(part):
+                        return
+                    part = []
+            if part and not put(part):
+                return
+            put(end)
+        except BaseException as e:
+            put(e)
+
+    t = threading.Thread(target=run, name='tote-background', daemon=True)
+    t.start()
+    try:
+        while True:
+            part = q.get()
+            if part is end:
+                return
+            if isinstance(part, BaseException):
+                raise part
+            yield from part
+    finally:
+        stop.set()
+
+
+def _compress_blob(data, codec='zlib', level=None, check=True):
+    return compress_blob(data, codec=codec, level=level, check=check)
 
     
-def _decompress_blob(blob):
-    if not blob.startswith(b'zlib\n'):
-        return blob
-    return zlib.decompress(blob[5:])
+def _decompress_blob(blob, size=None):
+    return decompress_blob(blob, size)
 
 
 def _format_blob(data):
     return b'blob\n' + data
 
 def _parse_blob(blob):
-    """unwrap a blob, raise TypeError if it is not a blob."""
-    if not blob.startswith(b'blob\n'):
+    """unwrap a blob as a memoryview of it, raise TypeError if it is not a blob."""
+    view = memoryview(blob)
+    if view[:5] != b'blob\n':
         raise TypeError('not a blob')
-    return blob[5:]
+    return view[5:]
 
 
-def _encrypt_blob(data, lock, key):
+def _new_cipher(lock, key):
     if lock == 'aes256ctr':
         c = Counter.new(nbits=128)
-        alg = AES.new(key, mode=AES.MODE_CTR, counter=c)
-    else:
-        raise TypeError('unknown lock type', lock)
+        return AES.new(key, mode=AES.MODE_CTR, counter=c)
+    raise TypeError('unknown lock type', lock)
+
+
+def _encrypt_blob(data, lock, key):
+    alg = _new_cipher(lock, key)
     return _format_blob(alg.encrypt(data))
 
 
 def _decrypt_blob(blob, lock, key):
-    if lock == 'aes256ctr':
-        ctr = Counter.new(nbits=128)
-        alg = AES.new(key, mode=AES.MODE_CTR, counter=ctr)
-    else:
-        raise TypeError('unknown lock type: ', lock)
+    alg = _new_cipher(lock, key)
     data = _parse_blob(blob)
-    return alg.decrypt(data)
+    # a blob the store read into a buffer of its own is decrypted in place
+    out = bytearray(len(data)) if data.readonly else data
+    alg.decrypt(data, output=out)
+    return out
+
+
+def _hash_file(f, piece_size=2**20):
+    """the sha256 of what is left to read in f, which is rewound after."""
+    h = sha256()
+    for data in iter(partial(f.read, piece_size), b''):
+        h.update(data)
+    f.seek(0)
+    return h
+
+
+class _EncryptReader:
+    """
+    a file of the blob _encrypt_blob makes of what is read from f, encrypted as it is read.
+    """
+    def __init__(self, f, lock, key):
+        self.f = f
+        self.lock = lock
+        self.key = key
+        self.seek(0)
+
+    def __len__(self):
+        return 5 + len(self.f)
+
+    def read(self, n=-1):
+        if self.pos == 0:
+            self.pos = 5
+            return b'blob\n'
+        data = self.cipher.encrypt(self.f.read(n))
+        self.pos += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        # read from the start again for a retried upload
+        if (offset, whence) != (0, 0):
+            raise ValueError('an encrypted blob only seeks to its start')
+        self.f.seek(0)
+        self.cipher = _new_cipher(self.lock, self.key)
+        self.pos = 0
+        return 0
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self.f.close()
+
+
+class _DecryptReader:
+    """
+    a file of the data _decrypt_blob gives for the blob in f, decrypted as it is read.
+    """
+    def __init__(self, f, lock, key):
+        self.f = f
+        self.cipher = _new_cipher(lock, key)
+        if f.read(5) != b'blob\n':
+            raise TypeError('not a blob')
+
+    def read(self, n=-1):
+        return self.cipher.decrypt(self.f.read(n))
+
+
+class _FileSlice:
+    def __init__(self, f, size):
+        self.f = f
+        self.left = size
+
+    def read(self, n=-1):
+        n = self.left if n is None or n < 0 else min(n, self.left)
+        data = self.f.read(n)
+        self.left -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+def _open_located(store, locate, name):
+    """a file of the blob name from where locate finds it, loaded whole if it is not in a local file."""
+    found = locate(name)
+    if found is None:
+        return BufferReader(store.load(name))
+    path, offset, size = found
+    f = open(path, 'rb')
+    f.seek(offset)
+    return _FileSlice(f, size)
+
+
+def _fold_id(fold):
+    """
+    32 bytes naming the page of a fold, from the hashes of its chunks.
+    """
+    h = sha256()
+    for chunk in fold.content or ():
+        h.update(str(chunk.sha256).encode())
+    return h.digest()
+
+
+def _index_page(items):
+    """
+    a binary page of items for a checkin index, without their content which stays in the store,
+    or None for a page with folds in it as those need their content.
+    """
+    w = _BinaryItemWriter()
+    for item in items:
+        if item.type == 'fold':
+            return None
+        if item.content is not None:
+            copy = FileItem.__new__(FileItem)
+            for slot in FileItem.__slots__:
+                setattr(copy, slot, getattr(item, slot))
+            copy.content = None
+            item = copy
+        w.write(item)
+    return w.getvalue()
+
+
+def _fold_boundary(item, items):
+    '''
+    true if a fold page should end after item, picked by a hash of the name alone so that on
+    average a page ends after one in every items items.
+    '''
+    h = int.from_bytes(sha256(item.sort_key.encode()).digest()[:8], 'big')
+    return h < (1 << 64) // max(items, 1)
 
 
 def _item_sort_key(item):
-    if item.type == 'fold':
-        return item.name_min
-    return item.name
+    return item.sort_key
 
 
 def format_timestamp(secs=None, safe=False):
@@ -360,25 +1040,180 @@ def format_timestamp(secs=None, safe=False):
     return t.strftime('%Y-%m-%dT%H:%M:%S.%f%z')
 
 
-@dataclass
-class Chunk:
-    size: int = None
-    sha256: str = None
-    lock: str = None
-    key: str = None
-    data: str = None
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_EPOCH_NAIVE = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
 
 
-@dataclass
-class FileItem:
-    name: str = None
-    type: str = None
-    mtime: datetime = None
-    size: int = None
-    content: list = None
-    sha256: str = None
-    target: str = None
-    error: str = None
+class _Record:
+    """
+    base of the item classes, kept small for archives with millions of items: slots instead of a __dict__,
+    interned type strings, raw bytes hashes, integer mtimes and names stored as their sort keys.
+
+    _fields are the public attributes in order, some are properties over the compact stored form.
+    """
+    __slots__ = ()
+    _fields = ()
+
+    def _state(self):
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self._state() == other._state()
+
+    __hash__ = None
+
+    def __repr__(self):
+        fields = ', '.join('%s=%r' % (field, getattr(self, field)) for field in self._fields)
+        return '%s(%s)' % (type(self).__name__, fields)
+
+
+def _name_key(name):
+    """
+    the sort key of a name, its parts joined by NUL, which sorts the same as the tuple of parts.
+
+    text names from an archive are cleaned up like _decode_name.
+    """
+    if name is None:
+        return None
+    if isinstance(name, PurePath):
+        return '\0'.join(name.parts)
+    if not name.startswith(('/', '.')) and '/.' not in name and '//' not in name and not name.endswith('/'):
+        return name.replace('/', '\0')
+    return '\0'.join(_decode_name(name).parts)
+
+
+def _key_text(key):
+    """
+    the posix text of a name from its sort key.
+    """
+    if key.startswith('/\0'):
+        return '/' + key[2:].replace('\0', '/')
+    return key.replace('\0', '/')
+
+
+def _key_name(key):
+    if key is None:
+        return None
+    return PurePosixPath(_key_text(key))
+
+
+def _pack_hash(value):
+    """
+    a hex sha256 as its 32 raw bytes, anything else as it is.
+    """
+    if value is None or value.__class__ is bytes:
+        return value
+    value = str(value)
+    if len(value) == 64:
+        try:
+            raw = bytes.fromhex(value)
+        except ValueError:
+            return value
+        if raw.hex() == value:
+            return raw
+    return value
+
+
+def _unpack_hash(value):
+    if value.__class__ is bytes:
+        return value.hex()
+    return value
+
+
+@lru_cache(maxsize=64)
+def _offset_zone(seconds):
+    if seconds == 0:
+        return timezone.utc
+    return timezone(timedelta(seconds=seconds))
+
+
+def _pack_time(t):
+    """
+    datetime -> (microseconds since the epoch, utc offset in seconds or None if naive)
+    """
+    if t is None:
+        return None, None
+    offset = t.utcoffset()
+    if offset is None:
+        return (t - _EPOCH_NAIVE) // _MICROSECOND, None
+    return (t - _EPOCH) // _MICROSECOND, offset // timedelta(seconds=1)
+
+
+def _unpack_time(us, offset):
+    if us is None:
+        return None
+    if offset is None:
+        return _EPOCH_NAIVE + timedelta(microseconds=us)
+    return (_EPOCH + timedelta(microseconds=us)).astimezone(_offset_zone(offset))
+
+
+def _intern(value):
+    if value.__class__ is str:
+        return sys.intern(value)
+    return value
+
+
+class Chunk(_Record):
+    __slots__ = ('size', '_sha256', 'lock', '_key', '_data')
+    _fields = ('size', 'sha256', 'lock', 'key', 'data')
+
+    def __init__(self, size=None, sha256=None, lock=None, key=None, data=None):
+        self.size = size
+        self._sha256 = _pack_hash(sha256)
+        self.lock = _intern(lock)
+        self._key = _pack_hash(key)
+        self._data = _pack_hash(data)
+
+    sha256 = property(lambda self: _unpack_hash(self._sha256), lambda self, v: setattr(self, '_sha256', _pack_hash(v)))
+    key = property(lambda self: _unpack_hash(self._key), lambda self, v: setattr(self, '_key', _pack_hash(v)))
+    data = property(lambda self: _unpack_hash(self._data), lambda self, v: setattr(self, '_data', _pack_hash(v)))
+
+
+class FileItem(_Record):
+    __slots__ = ('_name', 'type', '_mtime_us', '_mtime_offset', 'size', 'content', '_sha256', 'target', 'error')
+    _fields = ('name', 'type', 'mtime', 'size', 'content', 'sha256', 'target', 'error')
+
+    def __init__(self, name=None, type=None, mtime=None, size=None, content=None, sha256=None, target=None, error=None):
+        self._name = _name_key(name)
+        self.type = _intern(type)
+        self._mtime_us, self._mtime_offset = _pack_time(mtime)
+        self.size = size
+        self.content = content
+        self._sha256 = _pack_hash(sha256)
+        self.target = target
+        self.error = error
+
+    @property
+    def name(self):
+        return _key_name(self._name)
+
+    @name.setter
+    def name(self, value):
+        self._name = _name_key(value)
+
+    @property
+    def sort_key(self):
+        return self._name
+
+    @property
+    def mtime(self):
+        return _unpack_time(self._mtime_us, self._mtime_offset)
+
+    @mtime.setter
+    def mtime(self, value):
+        self._mtime_us, self._mtime_offset = _pack_time(value)
+
+    sha256 = property(lambda self: _unpack_hash(self._sha256), lambda self, v: setattr(self, '_sha256', _pack_hash(v)))
+
+    def _state(self):
+        # aware times are equal at the same instant whatever their offsets
+        return (
+            self._name, self.type, self._mtime_us, self._mtime_offset is None, self.size,
+            self.content, self._sha256, self.target, self.error,
+        )
 
     def update(self, item):
         for field in (
@@ -389,26 +1224,76 @@ class FileItem:
                 setattr(self, field, value)
 
 
-@dataclass
-class FoldItem:
-    name_min: str = None
-    name_max: str = None
-    type: str = None
-    content: list = None
-    count: int = None
+class FoldItem(_Record):
+    __slots__ = ('_name_min', '_name_max', 'type', 'content', 'count')
+    _fields = ('name_min', 'name_max', 'type', 'content', 'count')
+
+    def __init__(self, name_min=None, name_max=None, type=None, content=None, count=None):
+        self._name_min = _name_key(name_min)
+        self._name_max = _name_key(name_max)
+        self.type = _intern(type)
+        self.content = content
+        self.count = count
+
+    @property
+    def name_min(self):
+        return _key_name(self._name_min)
+
+    @name_min.setter
+    def name_min(self, value):
+        self._name_min = _name_key(value)
+
+    @property
+    def name_max(self):
+        return _key_name(self._name_max)
+
+    @name_max.setter
+    def name_max(self, value):
+        self._name_max = _name_key(value)
+
+    @property
+    def sort_key(self):
+        return self._name_min
+
+    @property
+    def max_key(self):
+        return self._name_max
 
 
 def decode_item_stream(stream):
     """
     text -> obj iterable
     """
-    for key, group in groupby(stream, key=lambda l: l.rstrip() == '---'):
-        if not key:
-            body = ''.join(group)
-            item = json.loads(body)
-            if not 'type' in item:
-                item['type'] = 'stream'
-            yield decode_item(item)
+    lines = []
+    for line in stream:
+        if line.startswith('---') and line.rstrip() == '---':
+            if lines:
+                yield _decode_item_text(''.join(lines))
+                lines.clear()
+        else:
+            lines.append(line)
+    if lines:
+        yield _decode_item_text(''.join(lines))
+
+
+# the document separator in a whole page of text
+_DOCUMENT_SEPARATOR = re.compile(r'^---[ \t\r]*$', re.MULTILINE)
+
+
+def decode_item_text(text):
+    """
+    a whole page of text -> obj iterable
+    """
+    for body in _DOCUMENT_SEPARATOR.split(text):
+        if body and not body.isspace():
+            yield _decode_item_text(body)
+
+
+def _decode_item_text(body):
+    item = json.loads(body)
+    if not 'type' in item:
+        item['type'] = 'stream'
+    return decode_item(item)
 
 
 def decode_item(obj):
@@ -422,42 +1307,43 @@ def decode_item(obj):
 
 
 def _decode_fold_item(obj):
-    fields = {
-        'name_min': _decode_name,
-        'name_max': _decode_name,
-        'type': _decode_str,
-        'content': _decode_content,
-        'count': _decode_int,
-    }
-    kwargs = { field: func(obj.get(field, None)) for field, func in fields.items() }
-    return FoldItem(**kwargs)
+    get = obj.get
+    content = get('content')
+    return FoldItem(
+        name_min=_decode_str(get('name_min')),
+        name_max=_decode_str(get('name_max')),
+        type=_decode_str(get('type')),
+        content=None if content is None else [ _decode_chunk(i) for i in content ],
+        count=_decode_int(get('count')),
+    )
 
 
 def _decode_str(obj):
-    if obj is None:
-        return None
+    if obj is None or obj.__class__ is str:
+        return obj
     return str(obj)
 
 
 def _decode_int(obj):
-    if obj is None:
-        return None
+    if obj is None or obj.__class__ is int:
+        return obj
     return int(obj)
 
 
 def _decode_file_item(obj):
-    fields = {
-        'name': _decode_name,
-        'type': _decode_str,
-        'mtime': _decode_timestamp,
-        'size': _decode_int,
-        'content': _decode_content,
-        'sha256': _decode_str,
-        'target': _decode_str,
-        'error': _decode_str,
-    }
-    kwargs = { field: func(obj.get(field, None)) for field, func in fields.items() }
-    return FileItem(**kwargs)
+    get = obj.get
+    content = get('content')
+    mtime = get('mtime')
+    return FileItem(
+        name=_decode_str(get('name')),
+        type=_decode_str(get('type')),
+        mtime=None if mtime is None else _decode_timestamp(mtime),
+        size=_decode_int(get('size')),
+        content=None if content is None else [ _decode_chunk(i) for i in content ],
+        sha256=_decode_str(get('sha256')),
+        target=_decode_str(get('target')),
+        error=_decode_str(get('error')),
+    )
 
 
 def _decode_content(content):
@@ -467,20 +1353,22 @@ def _decode_content(content):
 
 
 def _decode_chunk(obj):
-    fields = {
-        'size': _decode_int,
-        'sha256': _decode_str,
-        'lock': _decode_str,
-        'key': _decode_str,
-        'data': _decode_str,
-    }
-    kwargs = { field: func(obj.get(field, None)) for field, func in fields.items() }
-    return Chunk(**kwargs)
+    get = obj.get
+    return Chunk(
+        size=_decode_int(get('size')),
+        sha256=_decode_str(get('sha256')),
+        lock=_decode_str(get('lock')),
+        key=_decode_str(get('key')),
+        data=_decode_str(get('data')),
+    )
 
 
 def _decode_name(name):
     if name is None:
         return None
+    if not name.startswith(('/', '.')) and '/.' not in name:
+        # nothing to clean up
+        return PurePosixPath(name)
     path = PurePosixPath(name)
     if path.is_absolute():
         path = path.relative_to(path.root)
@@ -492,10 +1380,39 @@ def _encode_timestamp(timestamp):
     return datetime.strftime(timestamp, '%Y-%m-%dT%H:%M:%S.%f%z')
 
 
+@lru_cache(maxsize=64)
+def _decode_offset(text):
+    """
+    '+hhmm' -> timezone
+    """
+    offset = timedelta(hours=int(text[1:3]), minutes=int(text[3:5]))
+    if text[0] == '-':
+        offset = -offset
+    return timezone(offset)
+
+
 def _decode_timestamp(timestamp):
     if timestamp is None:
         return None
 
+    # the fixed formats written by _encode_timestamp, parsed without strptime
+    n = len(timestamp)
+    if (n == 31 or n == 27) and timestamp[4] + timestamp[7] + timestamp[10] + timestamp[13] + timestamp[16] + timestamp[19] == '--T::.':
+        try:
+            if n == 31 and timestamp[26] in '+-':
+                tz = _decode_offset(timestamp[26:])
+            elif n == 27 and timestamp[26] == 'Z':
+                tz = None
+            else:
+                raise ValueError(timestamp)
+            return datetime(
+                int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+                int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19]),
+                int(timestamp[20:26]), tz,
+            )
+        except ValueError:
+            pass
+
     try:
         return datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%fZ')
     except ValueError:
@@ -509,10 +1426,24 @@ def _decode_timestamp(timestamp):
     return datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%f%z')
 
 
-def encode_items_bytes(items):
+def encode_items_bytes(items, format='text'):
+    if format == 'binary':
+        w = _BinaryItemWriter()
+        for item in items:
+            w.write(item)
+        return w.getvalue()
     return b''.join(encode_item_text(item).encode() for item in items)
 
 
+def decode_items_bytes(blob):
+    '''
+    decode a page of items in either the text or the binary format.
+    '''
+    if blob[:len(_BINARY_MAGIC)] == _BINARY_MAGIC:
+        return decode_items_binary(blob)
+    return decode_item_text(bytes(blob).decode())
+
+
 def encode_item_text(item):
     body = json.dumps(item, default=encode_item, indent=4)
     return f'---\n{body}\n'
@@ -569,6 +1500,320 @@ def _encode_name(name):
 
 
 
+def _page_writer(format):
+    if format == 'binary':
+        return _BinaryItemWriter()
+    return _TextItemWriter()
+
+
+class _TextItemWriter:
+    """
+    collects the text of a fold page, encoding each item once.
+    """
+    # about the size of a file item with one chunk, for fold to aim its pages at a size
+    item_size = 512
+
+    def __init__(self):
+        self.items = []
+        self.parts = []
+        self.size = 0
+        self.sorted = True
+        self._next = None
+
+    def __len__(self):
+        return len(self.items)
+
+    def size_of(self, item):
+        # the text is kept for write, the page is not changed
+        self._next = (item, encode_item_text(item).encode())
+        return len(self._next[1])
+
+    def write(self, item, size=None):
+        if self._next is not None and self._next[0] is item:
+            part = self._next[1]
+        else:
+            part = encode_item_text(item).encode()
+        self._next = None
+        if self.items and _item_sort_key(item) < _item_sort_key(self.items[-1]):
+            self.sorted = False
+        self.items.append(item)
+        self.parts.append(part)
+        self.size += len(part)
+
+    def getvalue(self):
+        if not self.sorted:
+            self.items, self.parts = zip(*sorted(zip(self.items, self.parts), key=lambda p: _item_sort_key(p[0])))
+        return b''.join(self.parts)
+
+
+# the binary item format: the magic and a version byte, then the items one after another.
+# each item is a kind byte, a varint mask of the fields present, then the fields in order.
+# names share their prefix with the name before, hashes are raw bytes, numbers are varints.
+
+_BINARY_MAGIC = b'\x00tote items\n'
+_BINARY_VERSION = 1
+
+_FILE_FIELDS = (
+    ('name', 'name'), ('type', 'str'), ('mtime', 'time'), ('size', 'int'),
+    ('content', 'content'), ('sha256', 'hash'), ('target', 'str'), ('error', 'str'),
+)
+_FOLD_FIELDS = (
+    ('name_min', 'name'), ('name_max', 'name'), ('type', 'str'), ('content', 'content'), ('count', 'int'),
+)
+_CHUNK_FIELDS = (
+    ('size', 'int'), ('sha256', 'hash'), ('lock', 'str'), ('key', 'hash'), ('data', 'hash'),
+)
+
+# common strings are written as an index into this table, append only
+_BINARY_STRINGS = ('file', 'dir', 'link', 'other', 'missing', 'stream', 'fold', 'aes256ctr')
+_BINARY_STRING_CODES = { s: i for i, s in enumerate(_BINARY_STRINGS) }
+
+def _put_varint(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _get_varint(buf, pos):
+    n = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+def _zigzag(n):
+    return n * 2 if n >= 0 else -n * 2 - 1
+
+
+def _unzigzag(n):
+    return n // 2 if not n & 1 else -(n + 1) // 2
+
+
+class _BinaryItemWriter:
+    """
+    writes items in the binary format, tracking the name before for prefix sharing.
+    """
+    item_size = 128
+
+    def __init__(self):
+        self.out = bytearray(_BINARY_MAGIC)
+        self.out.append(_BINARY_VERSION)
+        self.last_name = b''
+        self.items = []
+        self._next = None
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def size(self):
+        return len(self.out)
+
+    def size_of(self, item):
+        # the item is encoded at the end of out to measure it, then cut off again so the page is not
+        # changed, write() puts the bytes back if it is given the same item next
+        start = len(self.out)
+        last_name = self.last_name
+        self._write(item)
+        self._next = (item, self.out[start:], self.last_name)
+        del self.out[start:]
+        self.last_name = last_name
+        return len(self._next[1])
+
+    def write(self, item, size=None):
+        if self._next is not None and self._next[0] is item:
+            _, data, self.last_name = self._next
+            self.out += data
+        else:
+            self._write(item)
+        self._next = None
+        if self.items and _item_sort_key(item) < _item_sort_key(self.items[-1]):
+            # out of order, write the page again sorted so names share their prefixes
+            self.items.append(item)
+            items = sorted(self.items, key=_item_sort_key)
+            self.__init__()
+            for i in items:
+                self._write(i)
+            self.items = items
+            return
+        self.items.append(item)
+
+    def getvalue(self):
+        return bytes(self.out)
+
+    def _write(self, item):
+        out = self.out
+        if isinstance(item, FoldItem):
+            out.append(2)
+            fields = _FOLD_FIELDS
+        else:
+            out.append(1)
+            fields = _FILE_FIELDS
+        self._put_fields(item, fields)
+
+    def _put_fields(self, obj, fields):
+        out = self.out
+        # names and hashes are read in their stored form, the sort key and raw bytes
+        values = [
+            getattr(obj, '_' + name if kind in ('name', 'hash') else name, None)
+            for name, kind in fields
+        ]
+        mask = 0
+        for i, value in enumerate(values):
+            if value is not None:
+                mask |= 1 << i
+        _put_varint(out, mask)
+        for (name, kind), value in zip(fields, values):
+            if value is None:
+                continue
+            if kind == 'name':
+                self._put_name(value)
+            elif kind == 'str':
+                self._put_str(value)
+            elif kind == 'int':
+                _put_varint(out, _zigzag(int(value)))
+            elif kind == 'hash':
+                self._put_hash(value)
+            elif kind == 'time':
+                self._put_time(value)
+            elif kind == 'content':
+                _put_varint(out, len(value))
+                for chunk in value:
+                    self._put_fields(chunk, _CHUNK_FIELDS)
+
+    def _put_name(self, key):
+        b = _key_text(key).encode()
+        shared = len(os.path.commonprefix([ self.last_name, b ]))
+        _put_varint(self.out, shared)
+        _put_varint(self.out, len(b) - shared)
+        self.out += b[shared:]
+        self.last_name = b
+
+    def _put_str(self, value):
+        code = _BINARY_STRING_CODES.get(value)
+        if code is not None:
+            _put_varint(self.out, code * 2 + 1)
+        else:
+            b = str(value).encode()
+            _put_varint(self.out, len(b) * 2)
+            self.out += b
+
+    def _put_hash(self, value):
+        if value.__class__ is bytes and len(value) == 32:
+            self.out.append(0)
+            self.out += value
+            return
+        self.out.append(1)
+        self._put_str(_unpack_hash(value))
+
+    def _put_time(self, value):
+        offset = value.utcoffset()
+        if offset is None:
+            us = (value - _EPOCH_NAIVE) // _MICROSECOND
+            tz = 0
+        else:
+            us = (value - _EPOCH) // _MICROSECOND
+            tz = _zigzag(offset // timedelta(seconds=1)) + 1
+        _put_varint(self.out, _zigzag(us))
+        _put_varint(self.out, tz)
+
+
+def decode_items_binary(buf):
+    """
+    bytes in the binary item format -> obj iterable
+    """
+    if buf[:len(_BINARY_MAGIC)] != _BINARY_MAGIC:
+        raise ValueError('not a binary item page')
+    pos = len(_BINARY_MAGIC)
+    version = buf[pos]
+    if version != _BINARY_VERSION:
+        raise ValueError('unknown binary item page version', version)
+    pos += 1
+
+    last_name = b''
+    end = len(buf)
+
+    def get_fields(pos, fields):
+        nonlocal last_name
+        mask, pos = _get_varint(buf, pos)
+        values = {}
+        for i, (name, kind) in enumerate(fields):
+            if not mask & (1 << i):
+                continue
+            if kind == 'name':
+                shared, pos = _get_varint(buf, pos)
+                n, pos = _get_varint(buf, pos)
+                last_name = last_name[:shared] + bytes(buf[pos:pos + n])
+                pos += n
+                value = last_name.decode()
+            elif kind == 'str':
+                value, pos = get_str(pos)
+            elif kind == 'int':
+                n, pos = _get_varint(buf, pos)
+                value = _unzigzag(n)
+            elif kind == 'hash':
+                if buf[pos] == 0:
+                    value = bytes(buf[pos + 1:pos + 33])
+                    pos += 33
+                else:
+                    value, pos = get_str(pos + 1)
+            elif kind == 'time':
+                # kept in the stored form of FileItem, microseconds and offset
+                n, pos = _get_varint(buf, pos)
+                tz, pos = _get_varint(buf, pos)
+                value = (_unzigzag(n), None if tz == 0 else _unzigzag(tz - 1))
+            elif kind == 'content':
+                count, pos = _get_varint(buf, pos)
+                value = []
+                for _ in range(count):
+                    chunk, pos = get_fields(pos, _CHUNK_FIELDS)
+                    value.append(Chunk(**chunk))
+            values[name] = value
+        return values, pos
+
+    def get_str(pos):
+        n, pos = _get_varint(buf, pos)
+        if n & 1:
+            return _BINARY_STRINGS[n // 2], pos
+        n //= 2
+        return bytes(buf[pos:pos + n]).decode(), pos + n
+
+    while pos < end:
+        kind = buf[pos]
+        pos += 1
+        if kind == 1:
+            values, pos = get_fields(pos, _FILE_FIELDS)
+            yield _binary_file_item(values)
+        elif kind == 2:
+            values, pos = get_fields(pos, _FOLD_FIELDS)
+            yield FoldItem(**values)
+        else:
+            raise ValueError('unknown binary item kind', kind)
+
+
+def _binary_file_item(values):
+    """
+    a FileItem from the fields of a binary page, set in their stored form without converting the times.
+    """
+    get = values.get
+    item = FileItem.__new__(FileItem)
+    item._name = _name_key(get('name'))
+    item.type = _intern(get('type'))
+    item._mtime_us, item._mtime_offset = get('mtime', (None, None))
+    item.size = get('size')
+    item.content = get('content')
+    item._sha256 = _pack_hash(get('sha256'))
+    item.target = get('target')
+    item.error = get('error')
+    return item
+
+
 class PathQueue:
     '''
     A priority queue of paths, the paths are returned in min-order, equal entries are collapsed.
@@ -608,34 +1853,29 @@ class _Ignore_Rule:
     anchored: bool = False
     pattern: tuple = ()
 
-    def matches(self, path):
-        if self.anchored and len(self.pattern) != len(path.parts):
-            return None
-        
-        for a, b in zip(path.parts[-len(self.pattern):], self.pattern):
-            if not fnmatch(a, b):
+    def last_pattern(self, prefix):
+        """
+        the pattern the name must match for the rule to match prefix / name, or None if it can
+        not match there whatever the name. prefix is a tuple of the parts above the name.
+        """
+        if self.anchored:
+            if len(self.pattern) != len(prefix) + 1:
                 return None
+            j = len(prefix)
         else:
-            if self.invert:
-                return False
-            else:
-                return True
-        
-        return None
+            # a name with fewer parts than the pattern is matched against the start of the pattern
+            j = min(len(self.pattern) - 1, len(prefix))
+
+        for a, b in zip(prefix[len(prefix) - j:], self.pattern):
+            if not fnmatch(a, b):
+                return None
+        return self.pattern[j]
 
 
 @dataclass
 class _Ignore_Rules:
     rules: list = field(default_factory=list)
     
-    def matches(self, path):
-        for rule in self.rules:
-            ignore = rule.matches(path)
-            if ignore is not None:
-                return ignore
-        else:
-            return None
-    
     def append(self, rule):
         self.rules.append(rule)
 
@@ -672,6 +1912,104 @@ def _load_ignore_rules(path):
     return rules
 
 
+_no_ignore_rules = _Ignore_Rules()
+
+
+def _glob_regex(pattern):
+    """
+    translate a shell pattern for one path part to a regex the way fnmatch does, except that
+    nothing in it matches a '/' so the parts can be joined.
+    """
+    out = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            if not out or out[-1] != '[^/]*':
+                out.append('[^/]*')
+        elif c == '?':
+            out.append('[^/]')
+        elif c == '[':
+            j = i
+            if j < n and pattern[j] == '!':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            while j < n and pattern[j] != ']':
+                j += 1
+            if j >= n:
+                out.append('\\[')
+                continue
+            out.append(_glob_class(pattern[i:j]))
+            i = j + 1
+        else:
+            out.append(re.escape(c))
+    return ''.join(out)
+
+
+def _glob_class(stuff):
+    stuff = stuff.replace('\\', '\\\\')
+    stuff = re.sub(r'([&~|])', r'\\\1', stuff)
+    if stuff[0] == '!':
+        stuff = '^' + stuff[1:]
+    elif stuff[0] in ('^', '['):
+        stuff = '\\' + stuff
+    regex = '(?!/)[%s]' % stuff
+    try:
+        re.compile(regex)
+    except re.error:
+        # only reversed ranges, fnmatch matches nothing for those too
+        return '(?!)'
+    return regex
+
+
+@lru_cache(maxsize=1024)
+def _compile_ignore(patterns):
+    """
+    compile (pattern, ignore) pairs into one regex, the group of the first pattern that matches
+    picks the answer.
+    """
+    regex = re.compile('|'.join('(%s)' % _glob_regex(pattern) for pattern, ignore in patterns), re.S)
+    return regex, (None,) + tuple(ignore for pattern, ignore in patterns)
+
+
+class _Ignore_Dir:
+    """
+    the ignore rules for the entries of one directory, compiled to a single regex on the entry name.
+
+    levels are the rules of this directory and the ones above it up to the base, nearest first,
+    each with the parts from its directory down to here. the child of a directory adds its own
+    rules and one more part, so the rules are only looked at once per directory.
+    """
+    __slots__ = ('levels', 'regex', 'results')
+
+    def __init__(self, levels):
+        self.levels = levels
+
+        patterns = []
+        for rules, prefix in levels:
+            for rule in rules.rules:
+                pattern = rule.last_pattern(prefix)
+                if pattern is not None:
+                    patterns.append((pattern, not rule.invert))
+        # .tote is ignored unless a rule says otherwise
+        patterns.append(('.tote', True))
+
+        self.regex, self.results = _compile_ignore(tuple(patterns))
+
+    def matches(self, name):
+        match = self.regex.fullmatch(name)
+        if match is None:
+            return None
+        return self.results[match.lastindex]
+
+    def child(self, name, rules):
+        levels = [ (rules, ()) ] if rules.rules else []
+        levels.extend((r, prefix + (name,)) for r, prefix in self.levels)
+        return _Ignore_Dir(levels)
+
+
 @dataclass
 class _Ignore_Manager:
     
@@ -679,27 +2017,21 @@ class _Ignore_Manager:
     base_path: Path = None
     
     def __post_init__(self):
-        self._rules_for = lru_cache()(_load_ignore_rules)
-        
-    def _check_rules(self, path):
-        check_path = path
-        check_name = Path()
-        
-        ignore = None
-        while ignore is None:
-            if check_path == self.base_path:
-                break # we hit the base
-            
-            # step up
-            last_path = check_path
-            check_path = last_path.parent
-            check_name = Path(last_path.name) / check_name
+        self._dir_for = lru_cache(maxsize=256)(self._load_dir)
 
-            if check_path == last_path:
-                break # we hit the root
-            
-            ignore = self._rules_for(check_path).matches(check_name)
-        return ignore
+    def _load_dir(self, path):
+        rules = _load_ignore_rules(path)
+        path = Path(path)
+        if path == self.base_path or path.parent == path:
+            # the rules above the base or the root do not count
+            return _Ignore_Dir([ (rules, ()) ] if rules.rules else [])
+        return self._dir_for(str(path.parent)).child(path.name, rules)
+
+    def rules_for(self, path):
+        """
+        the compiled rules for the entries of the directory path.
+        """
+        return self._dir_for(str(Path(path)))
 
     def matches(self, path):
         path = Path(path)
@@ -708,56 +2040,151 @@ class _Ignore_Manager:
             # check path is in base_path
             path.relative_to(self.base_path)
         
-        ignore = self._check_rules(path)
-        if ignore is not None:
-            return ignore
-        
-        if path.name == '.tote':
-            return True
+        if path == self.base_path or path.parent == path:
+            return True if path.name == '.tote' else None
 
-        return None
+        return self.rules_for(path.parent).matches(path.name)
 
 
-def list_trees(paths, recurse=True, one_filesystem=True, base_path=None):
-    paths = [ Path(path) for path in paths ]
+def _walk_trees(paths, recurse=True, one_filesystem=True, base_path=None, threads=0):
+    """
+    yield (path, stat) for paths and everything under them in sort order, path is a str and stat
+    is the lstat result, or None if the path does not exist.
+
+    each directory is listed once with scandir and each entry is stat'ed once, the entries are
+    sorted within their directory which gives the same order as sorting all the paths by parts.
+
+    with threads the directories coming up next are listed ahead on a pool, at most a few per
+    thread are held at once, the order is the same.
+    """
+    roots = sorted({ str(Path(path)) for path in paths }, key=lambda p: PurePosixPath(p).parts)
+    ignore_rules = _Ignore_Manager(base_path=base_path)
+    pool = None
+    if threads > 0 and recurse:
+        pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='tote-scan')
+
+    def walk(root):
+        if ignore_rules.matches(Path(root)):
+            return
 
-    def should_decend(path):
-        if not recurse:
-            return False
-        
         try:
-            if not path.is_dir():
-                return False
+            st = os.lstat(root)
+        except FileNotFoundError:
+            st = None
         except OSError as e:
             print(e)
-            return False
+            st = None
+        yield root, st
+
+        if not recurse or st is None or not S_ISDIR(st.st_mode):
+            return
+
+        # directories listed or being listed ahead, by path
+        ahead = {}
+        limit = 4 * threads
+
+        def descend(path, st, dev):
+            return S_ISDIR(st.st_mode) and not (one_filesystem and st.st_dev != dev)
+
+        def list_ahead():
+            # the next directories in walk order are the ones left in the deepest listings
+            if len(ahead) >= limit:
+                return
+            for level in reversed(stack):
+                entries, pos, dev, ignore = level
+                start = max(pos[0], pos[1])
+                for i in range(start, len(entries)):
+                    if len(ahead) >= limit:
+                        pos[1] = i
+                        return
+                    path, st = entries[i]
+                    if descend(path, st, dev) and not ignore.matches(_base_name(path)):
+                        ahead[path] = pool.submit(_list_dir, path)
+                pos[1] = len(entries)
+
+        # a stack of directory listings, the position of the next entry and of the next one to
+        # look at for listing ahead, the device they are on and the ignore rules for them
+        stack = [ (_list_dir(root), [0, 0], st.st_dev, ignore_rules.rules_for(root)) ]
+        while stack:
+            if pool is not None:
+                list_ahead()
+
+            entries, pos, dev, ignore = stack[-1]
+            if pos[0] >= len(entries):
+                stack.pop()
+                continue
+
+            path, st = entries[pos[0]]
+            pos[0] += 1
+            name = _base_name(path)
+
+            # ignored directories are never listed ahead, or listed at all
+            listing = ahead.pop(path, None)
+            if listing is None and ignore.matches(name):
+                continue
+            yield path, st
+
+            if descend(path, st, dev):
+                entries = _list_dir(path) if listing is None else listing.result()
+                rules = _no_ignore_rules
+                if any(_base_name(p) == '.toteignore' for p, _ in entries):
+                    rules = _load_ignore_rules(path)
+                stack.append((entries, [0, 0], st.st_dev, ignore.child(name, rules)))
 
+    try:
+        if len(roots) == 1:
+            yield from walk(roots[0])
+            return
+
+        # roots inside other roots are found twice, keep one of each
+        last = None
+        merged = heapq_merge(*(walk(root) for root in roots), key=lambda e: PurePosixPath(e[0]).parts)
+        for path, st in merged:
+            if path != last:
+                yield path, st
+            last = path
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _list_dir(path):
+    """
+    list (path, lstat) for the entries of a directory sorted by name, errors are printed.
+    """
+    try:
+        with os.scandir(path) as it:
+            entries = sorted(it, key=lambda e: e.name)
+    except OSError as e:
+        print(e)
+        return []
+
+    result = []
+    for entry in entries:
         try:
-            if one_filesystem and ismount(path) and path not in paths:
-                return False
-        except NotImplementedError:
-            pass
-        
-        if path.is_symlink():
-            return False
-        
-        return True
+            st = entry.stat(follow_symlinks=False)
+        except OSError as e:
+            print(e)
+            continue
+        result.append((_join(path, entry.name), st))
+    return result
 
-    ignore_rules = _Ignore_Manager(base_path=base_path)
-    
-    pq = PathQueue(paths)
 
-    for path in pq:
-        if ignore_rules.matches(path):
-            continue
-        
-        if should_decend(path):
-            try:
-                pq.update(path.iterdir())
-            except PermissionError as e:
-                print(e)
+def _base_name(path):
+    return path.rpartition('/')[2]
+
+
+def _join(path, name):
+    if path == '.':
+        return name
+    if path.endswith('/'):
+        return path + name
+    return path + '/' + name
 
-        yield path
+
+def list_trees(paths, recurse=True, one_filesystem=True, base_path=None, threads=0):
+    for path, st in _walk_trees(paths, recurse=recurse, one_filesystem=one_filesystem, base_path=base_path, threads=threads):
+        yield Path(path)
 
 
 def list_tree(path, **kwargs):
@@ -765,19 +2192,61 @@ def list_tree(path, **kwargs):
 
 
 def scan_trees(paths, relative_to=None, **kwargs):
-    for path in list_trees(paths, **kwargs):
+    if relative_to is not None:
+        relative_to = str(Path(relative_to))
+
+    for path, st in _walk_trees(paths, **kwargs):
         try:
-            item = get_file_info(path)
+            item = _file_info_from_stat(path, st)
         except OSError as e:
             print(e)
             continue
         
         if relative_to is not None:
-            item.name = PurePosixPath(path.relative_to(relative_to))
+            item.name = _relative_name(path, relative_to)
         
         yield item
 
 
+def _relative_name(path, base):
+    """
+    the name of path relative to base as posix text.
+    """
+    if path == base:
+        return ''
+    prefix = base if base.endswith('/') else base + '/'
+    if path.startswith(prefix) and base != '.':
+        return path[len(prefix):]
+    return PurePosixPath(Path(path).relative_to(base)).as_posix()
+
+
+def _file_info_from_stat(path, st):
+    """
+    make a file item for path from its lstat result, without more system calls except for links.
+    """
+    item = FileItem()
+    item.name = PurePosixPath(path)
+
+    if st is None:
+        item.type = 'missing'
+        return item
+
+    item.mtime = datetime.fromtimestamp(st.st_mtime, tz=timezone.utc)
+
+    mode = st.st_mode
+    if S_ISLNK(mode):
+        item.type = 'link'
+        item.target = os.readlink(path)
+    elif S_ISDIR(mode):
+        item.type = 'dir'
+    elif S_ISREG(mode):
+        item.type = 'file'
+        item.size = st.st_size
+    else:
+        item.type = 'other'
+    return item
+
+
 def get_file_info(path):
     path = Path(path)
     item = FileItem()
@@ -828,8 +2297,8 @@ def merge_sorted_name(a, b):
     itemb = next(iterb, None)
     
     while itema is not None and itemb is not None:
-        namea = itema.name
-        nameb = itemb.name
+        namea = itema.sort_key
+        nameb = itemb.sort_key
         
         if namea < nameb:
             yield (itema, None)
@@ -854,6 +2323,178 @@ def merge_sorted_name(a, b):
         itemb = next(iterb, None)
 
 
+def merge_sorted_folds(conn, a, b, delete=False, update=True, dirty=None, index=None, exact=True):
+    """
+    like merge_sorted_name, but a may hold folds which are only expanded when needed.
+
+    a fold with no items of b in its name range is passed through as the pair (fold, fold),
+    unless delete is set, then its items are paired with None.
+    a fold with items of b in its range is expanded and compared, if nothing in it changed
+    it is passed through as (fold, fold), otherwise the pairs of its items are yielded.
+
+    with dirty b only covers the DirtyRegions in it, items of a outside them are paired with
+    themselves, as they were not looked at they are taken to be unchanged.
+
+    with index, the CheckinIndex of a, folds are compared with their items from the index and only
+    loaded from the store if something in them changed. without exact the index items are paired
+    even then, they have no content so that is only good for showing the changes.
+    """
+    def pair_up(items, in_range):
+        pairs = list(merge_sorted_name(items, in_range))
+        if dirty is not None:
+            pairs = [ (x, x) if y is None and not dirty.covers(x.sort_key) else (x, y) for x, y in pairs ]
+        return pairs
+
+    def unchanged(pairs):
+        return all(_pair_unchanged(x, y, delete=delete, update=update) for x, y in pairs)
+
+    itema = deque(sorted(a, key=_item_sort_key))
+    iterb = iter(b)
+    itemb = next(iterb, None)
+
+    while itema:
+        item = itema.popleft()
+
+        if item.type != 'fold':
+            while itemb is not None and itemb.sort_key < item.sort_key:
+                yield (None, itemb)
+                itemb = next(iterb, None)
+            if itemb is not None and itemb.sort_key == item.sort_key:
+                yield (item, itemb)
+                itemb = next(iterb, None)
+            elif dirty is None or dirty.covers(item.sort_key):
+                yield (item, None)
+            else:
+                yield (item, item)
+            continue
+
+        while itemb is not None and itemb.sort_key < item.sort_key:
+            yield (None, itemb)
+            itemb = next(iterb, None)
+
+        in_range = []
+        while itemb is not None and itemb.sort_key <= item.max_key:
+            in_range.append(itemb)
+            itemb = next(iterb, None)
+
+        if itema and _item_sort_key(itema[0]) <= item.max_key:
+            # the fold overlaps the next item, put its items back in the queue and look again
+            itema = deque(sorted(chain(conn.unfold([item]), itema), key=_item_sort_key))
+            if itemb is not None:
+                in_range.append(itemb)
+            iterb = chain(in_range, iterb)
+            itemb = next(iterb, None)
+            continue
+
+        if not in_range and (not delete or dirty is not None and not dirty.intersects(item.sort_key, item.max_key)):
+            yield (item, item)
+            continue
+
+        pairs = None
+        indexed = None if index is None else conn._indexed_items(index, item)
+        if indexed is not None:
+            pairs = pair_up(indexed, in_range)
+            if unchanged(pairs):
+                yield (item, item)
+                continue
+            if exact:
+                pairs = None
+
+        if pairs is None:
+            pairs = pair_up(conn.unfold([item]), in_range)
+            if unchanged(pairs):
+                yield (item, item)
+                continue
+
+        yield from pairs
+
+    while itemb is not None:
+        yield (None, itemb)
+        itemb = next(iterb, None)
+
+
+class DirtyRegions:
+    """
+    the parts of a tree that changed, each a name relative to the top of the tree with
+    everything under it, or a name for just the entry itself.
+    """
+    def __init__(self, trees=(), entries=()):
+        # key ranges, everything under a name sorts before its key with the last NUL made \x01
+        regions = sorted(chain(
+            ((_name_key(PurePosixPath(name)), True) for name in trees),
+            ((_name_key(PurePosixPath(name)), False) for name in entries),
+        ), key=lambda r: (r[0], not r[1]))
+
+        self.regions = []
+        for key, recurse in regions:
+            end = key + ('\x01' if recurse else '\0')
+            if self.regions and key < self.regions[-1][1]:
+                continue # inside the last one
+            self.regions.append((key, end, recurse))
+
+        self.starts = [ r[0] for r in self.regions ]
+        self.ends = [ r[1] for r in self.regions ]
+
+    def __len__(self):
+        return len(self.regions)
+
+    @property
+    def everything(self):
+        return bool(self.regions) and self.regions[0][0] == '' and self.regions[0][2]
+
+    def covers(self, key):
+        if self.everything:
+            return True
+        i = bisect_right(self.starts, key) - 1
+        return i >= 0 and key < self.ends[i]
+
+    def intersects(self, first, last):
+        """
+        true if any key from first to last, both included, is in a region.
+        """
+        if self.everything:
+            return True
+        i = bisect_right(self.ends, first)
+        return i < len(self.regions) and self.starts[i] <= last
+
+    def scan(self, top, base_path=None, threads=0):
+        """
+        yield the items in the regions under top in sort order, like scan_trees on top would.
+        """
+        top = str(Path(top))
+        if self.everything:
+            yield from scan_trees([top], relative_to=top, base_path=base_path, threads=threads)
+            return
+
+        ignore_rules = _Ignore_Manager(base_path=base_path)
+        for key, end, recurse in self.regions:
+            name = _key_text(key)
+
+            # a region inside an ignored directory is not part of the tree
+            parents = list(PurePosixPath(name).parents)[:-1]
+            if any(ignore_rules.matches(Path(top, parent)) for parent in parents):
+                continue
+
+            for item in scan_trees([_join(top, name)], relative_to=top, base_path=base_path, recurse=recurse, threads=threads):
+                if item.type != 'missing':
+                    yield item
+
+
+def _pair_unchanged(a, b, delete=False, update=True):
+    """
+    true if tote_merge_update would keep a as it is for the pair.
+    """
+    if b is None:
+        return not delete
+    if a is None:
+        return False
+    if a == b:
+        return True
+    if update and b.type == 'file':
+        return all(getattr(a, f, None) == getattr(b, f, None) for f in ('type', 'size', 'mtime'))
+    return False
+
+
 def _filter_items_by_names(items, patterns):
     """
     Return a generator of items with names that start with any of patterns.
@@ -904,6 +2545,7 @@ def checkin_status(conn):
         paths=[conn.workdir_path], 
         relative_to=conn.workdir_path,
         base_path=conn.workdir_path,
+        threads=conn.scan_threads,
     )
     
     merged = merge_sorted_name(lista, listb)
@@ -928,6 +2570,28 @@ def checkin_save(conn, m):
 
 
 def tote_merge_update(conn, merged, relative_to=None, delete=False, update=True, verbose=True, filedata=True):
+    """
+    yields the items to keep from merged pairs, several changed files are read and stored at once,
+    the items come out in the order of merged.
+    """
+    work = _merge_update_work(
+        merged,
+        relative_to=relative_to,
+        delete=delete,
+        update=update,
+        verbose=verbose,
+        filedata=filedata,
+    )
+    return conn._put_pipeline(
+        (item, read and partial(read, conn, item, path))
+        for item, read, path in work
+    )
+
+
+def _merge_update_work(merged, relative_to=None, delete=False, update=True, verbose=True, filedata=True):
+    """
+    yields (item, read, path) for the items to keep, read is None or the function to fill in item from path.
+    """
     for a, b in merged:
 
         if b is None:
@@ -935,7 +2599,7 @@ def tote_merge_update(conn, merged, relative_to=None, delete=False, update=True,
                 if verbose:
                     print('d', a.name)
             else:
-                yield a
+                yield a, None, None
             continue
 
         if a is None:
@@ -948,14 +2612,14 @@ def tote_merge_update(conn, merged, relative_to=None, delete=False, update=True,
                     path = Path(relative_to) / path
 
                 if path.is_file():
-                    with open(path, 'rb') as file:
-                        b.update(conn.put_stream(file))
+                    yield b, _read_into, path
+                    continue
 
-            yield b
+            yield b, None, None
             continue
 
         if a == b:
-            yield b
+            yield b, None, None
             continue
 
         if b.type == 'file':
@@ -966,7 +2630,7 @@ def tote_merge_update(conn, merged, relative_to=None, delete=False, update=True,
             
             if update:
                 if not changes:
-                    yield a
+                    yield a, None, None
                     continue
 
             if verbose:
@@ -977,18 +2641,34 @@ def tote_merge_update(conn, merged, relative_to=None, delete=False, update=True,
                 if relative_to:
                     path = Path(relative_to) / path
 
-                try:
-                    with open(path, 'rb') as file:
-                        b.update(conn.put_stream(file))
-                except OSError as e:
-                    b.error = str(e)
+                yield b, _read_into_or_error, path
+                continue
 
-            yield b
+            yield b, None, None
             continue
 
         if verbose:
             print('u', b.name)
-        yield b
+        yield b, None, None
+
+
+def _index_folds(conn, items, index, index_out):
+    """
+    yield items, adding the folds passed through from the archive before to index_out from its index.
+
+    a fold the index before has no page for, or that came from an archive without an index, is
+    loaded once to make its page, so every later checkin finds it in the index.
+    """
+    for item in items:
+        if item.type == 'fold':
+            fold_id = _fold_id(item)
+            if fold_id not in index_out:
+                page = index.get(fold_id) if index is not None else None
+                if page is None:
+                    page = _index_page(conn._fold_items(item))
+                if page is not None:
+                    index_out.add(fold_id, page)
+        yield item
 
 
 def tote_update(
@@ -1014,9 +2694,20 @@ def tote_update(
     history=True,
     # read no file, make no output
     dryrun=False,
+    # only scan these parts of the tree, a DirtyRegions with names relative to relative_to
+    dirty=None,
+    # write a side index of the folds next to arc_output
+    write_index=False,
 ):
     if not conn:
-        conn = connect(arc)
+        # a connection made here is closed once the update is done
+        with connect(arc) as conn:
+            return tote_update(
+                arc, paths,
+                relative_to=relative_to, base_path=base_path, arc_output=arc_output, conn=conn,
+                delete=delete, update=update, verbose=verbose, history=history, dryrun=dryrun,
+                dirty=dirty, write_index=write_index,
+            )
     
     if not arc:
         items_in = []
@@ -1027,15 +2718,31 @@ def tote_update(
         except FileNotFoundError:
             items_in = []
     
-    items_in = conn.unfold(items_in)
+    # walk the tree on a background thread while the files are read and stored
+    if dirty is None:
+        scan_in = _background(scan_trees(
+            paths=paths,
+            base_path=base_path,
+            relative_to=relative_to,
+            threads=conn.scan_threads,
+        ))
+    else:
+        scan_in = _background(dirty.scan(
+            relative_to,
+            base_path=base_path,
+            threads=conn.scan_threads,
+        ))
     
-    scan_in = scan_trees(
-        paths=paths,
-        base_path=base_path,
-        relative_to=relative_to,
+    # the folds of arc are compared against its side index where there is one
+    index = None
+    if arc and items_in:
+        index = conn._open_checkin_index(arc)
+
+    # folds are only expanded where the scan finds items in their range
+    merged = merge_sorted_folds(
+        conn, items_in, scan_in,
+        delete=delete, update=update, dirty=dirty, index=index, exact=not dryrun,
     )
-    
-    merged = merge_sorted_name(items_in, scan_in)
 
     result = tote_merge_update(
         conn, merged, 
@@ -1051,13 +2758,18 @@ def tote_update(
             pass
         
     else:
-        result = conn.fold(result)
-
         if arc_output is None:
             arc_output = Path(arc)
         else:
             arc_output = Path(arc_output)
 
+        index_out = None
+        if write_index:
+            index_out = CheckinIndexWriter(arc_output.with_name(arc_output.name + '.index'))
+        result = conn.fold(result, index=index_out)
+        if index_out is not None:
+            result = _index_folds(conn, result, index, index_out)
+
         arc_output_part = arc_output.with_name(arc_output.name + '.part')
         with conn.write_file(arc_output_part) as w:
             w.writeall(result)
@@ -1070,4 +2782,10 @@ def tote_update(
 
         arc_output_part.rename(target=arc_output)
 
+        if index_out is not None:
+            index_out.finish(sha256(arc_output.read_bytes()).digest())
+
+    if index is not None:
+        index.close()
+
     
\ No newline at end of file
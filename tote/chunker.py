@@ -0,0 +1,111 @@
+'''
+Ways of cutting a stream of bytes into chunks.
+
+A chunker, made by make_chunker, is a function that takes a binary stream and yields the chunks as bytes objects.
+'''
+from functools import partial
+from hashlib import sha256
+from math import log2
+
+
+def fixed_chunks(stream, size=2**24):
+    '''
+    cut the stream every size bytes.
+    '''
+    return iter(partial(stream.read, size), b'')
+
+
+def _gear_table():
+    '''
+    256 pseudo random 64 bit numbers, fixed so that the chunk boundaries are the same on every run.
+    '''
+    return tuple(
+        int.from_bytes(sha256(b'tote gear %d' % i).digest()[:8], 'big')
+        for i in range(256)
+    )
+
+_GEAR = _gear_table()
+
+
+def _mask(bits):
+    '''
+    a mask of the top bits of a 64 bit gear hash, the top bits depend on the most input bytes.
+    '''
+    bits = max(1, min(bits, 63))
+    return ((1 << bits) - 1) << (64 - bits)
+
+
+def _cut_point(buf, min_size, normal_size, max_size, mask_s, mask_l):
+    '''
+    find the length of the first chunk in buf using the FastCDC gear hash with normalized chunking.
+    '''
+    n = len(buf)
+    if n <= min_size:
+        return n
+    if n > max_size:
+        n = max_size
+    if normal_size > n:
+        normal_size = n
+
+    gear = _GEAR
+    h = 0
+    i = min_size
+    # walk a view of buf, a slice of the bytearray would copy it first
+    view = memoryview(buf)
+    # a harder mask before the normal size and an easier one after pulls the chunk sizes towards normal_size
+    for b in view[min_size:normal_size]:
+        h = ((h << 1) + gear[b]) & 0xFFFFFFFFFFFFFFFF
+        i += 1
+        if not h & mask_s:
+            return i
+    for b in view[normal_size:n]:
+        h = ((h << 1) + gear[b]) & 0xFFFFFFFFFFFFFFFF
+        i += 1
+        if not h & mask_l:
+            return i
+    return n
+
+
+def cdc_chunks(stream, min_size=2**19, avg_size=2**21, max_size=2**23):
+    '''
+    cut the stream at content defined boundaries (FastCDC).
+
+    Inserting or removing bytes only moves the boundaries near the change, so the
+    rest of the chunks stay the same and dedup in the store.
+    '''
+    if not 0 < min_size <= avg_size <= max_size:
+        raise ValueError('chunk sizes must be 0 < min_size <= avg_size <= max_size', min_size, avg_size, max_size)
+
+    bits = round(log2(avg_size))
+    mask_s = _mask(bits + 2)
+    mask_l = _mask(bits - 2)
+
+    buf = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buf) < max_size:
+            data = stream.read(max_size)
+            if not data:
+                eof = True
+            buf += data
+
+        if not buf:
+            return
+
+        cut = _cut_point(buf, min_size, avg_size, max_size, mask_s, mask_l)
+        # one copy out of buf, the view has to be gone before buf is resized
+        with memoryview(buf) as view:
+            chunk = view[:cut].tobytes()
+        yield chunk
+        del buf[:cut]
+
+
+def make_chunker(method='fixed', size=2**24, min_size=2**19, avg_size=2**21, max_size=2**23):
+    '''
+    make a chunker function for the given method, 'fixed' or 'cdc'.
+    '''
+    if method == 'fixed':
+        return partial(fixed_chunks, size=size)
+    if method == 'cdc':
+        return partial(cdc_chunks, min_size=min_size, avg_size=avg_size, max_size=max_size)
+    raise ValueError('unknown chunk method', method)
@@ -0,0 +1,363 @@
+'''
+Compression codecs for blobs.
+
+A compressed blob starts with the name of its codec and a newline, followed by the compressed data.
+A blob that is not compressed starts with 'blob\n' instead.
+'''
+import tempfile
+import threading
+import time
+import zlib
+
+from collections import namedtuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+Codec = namedtuple('Codec', ['name', 'level', 'compress', 'decompress', 'package', 'compressobj', 'reader'])
+
+
+def _zstd_compress(data, level):
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def _zlib_compressobj(level, size):
+    return zlib.compressobj(level)
+
+
+class _ZlibReader:
+    '''
+    a file of the data decompressed from the zlib stream in f, at most n bytes a read.
+    '''
+    def __init__(self, f, read_size):
+        self.f = f
+        self.read_size = read_size
+        self.d = zlib.decompressobj()
+
+    def read(self, n):
+        while True:
+            data = self.d.unconsumed_tail
+            if not data and not self.d.eof:
+                data = self.f.read(self.read_size)
+                if not data:
+                    raise zlib.error('compressed data is cut short')
+            out = self.d.decompress(data, n)
+            if out or self.d.eof:
+                return out
+
+
+def _zstd_reader(f, read_size):
+    return zstandard.ZstdDecompressor().stream_reader(f, read_size=read_size, closefd=False)
+
+
+def _lz4_reader(f, read_size):
+    return lz4.frame.LZ4FrameFile(f, 'rb')
+
+
+def _zlib_decompress(data, size=None):
+    # knowing the size saves growing the output as it is decompressed
+    return zlib.decompress(data, bufsize=size or zlib.DEF_BUF_SIZE)
+
+
+def _zstd_decompress(data, size=None):
+    # a decompressobj also reads frames that do not record their content size
+    return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+
+def _lz4_compress(data, level):
+    return lz4.frame.compress(data, compression_level=level)
+
+
+def _lz4_decompress(data, size=None):
+    return lz4.frame.decompress(data)
+
+
+# only zlib has a compressobj, the streaming compressors of zstd and lz4 do not give the same
+# bytes as compress once the data is longer than a block or window, which would change the blobs
+codecs = {
+    'zlib': Codec('zlib', 9, zlib.compress, _zlib_decompress, 'zlib', _zlib_compressobj, _ZlibReader),
+    'zstd': Codec('zstd', 3, _zstd_compress, _zstd_decompress, 'zstandard', None, _zstd_reader),
+    'lz4': Codec('lz4', 0, _lz4_compress, _lz4_decompress, 'lz4', None, _lz4_reader),
+}
+
+
+def get_codec(name):
+    '''
+    find a codec by name, None for 'none', raise ValueError if it is unknown or its package is not installed.
+    '''
+    if name == 'none':
+        return None
+
+    try:
+        codec = codecs[name]
+    except KeyError:
+        raise ValueError('unknown compression codec', name)
+
+    available = {
+        'zlib': True,
+        'zstd': zstandard is not None,
+        'lz4': lz4 is not None,
+    }
+    if not available.get(name, True):
+        raise ValueError('compression codec needs a package that is not installed', name, codec.package)
+
+    return codec
+
+
+class CompressStats:
+    '''
+    counts of the compression work done and skipped, safe to update from several threads.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checked = 0
+        self.check_seconds = 0.0
+        self.skipped = 0
+        self.skipped_bytes = 0
+        self.compressed = 0
+        self.compressed_bytes = 0
+        self.compress_seconds = 0.0
+
+    def add(self, **kwargs):
+        with self.lock:
+            for name, value in kwargs.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def saved_seconds(self):
+        '''
+        estimate the cpu time the check saved, the time to compress the skipped bytes less the time spent checking.
+        '''
+        if not self.compressed_bytes:
+            return 0.0
+        rate = self.compress_seconds / self.compressed_bytes
+        return self.skipped_bytes * rate - self.check_seconds
+
+    def __str__(self):
+        return 'compress: checked %d, skipped %d (%.1f MiB), compressed %d (%.1f MiB), saved about %.2fs cpu' % (
+            self.checked, self.skipped, self.skipped_bytes / 2**20,
+            self.compressed, self.compressed_bytes / 2**20, self.saved_seconds(),
+        )
+
+stats = CompressStats()
+
+
+def looks_incompressible(data, sample_size=2**14, samples=4, ratio=0.97):
+    '''
+    guess if data will not compress by trial compressing a few samples from across it at the fastest zlib level.
+
+    data smaller than the samples is never skipped, trying it is cheap enough.
+    '''
+    if len(data) < samples * sample_size * 4:
+        return False
+
+    view = data if isinstance(data, BufferReader) else memoryview(data)
+    step = (len(data) - sample_size) // (samples - 1)
+    sample = b''.join(view[i * step:i * step + sample_size] for i in range(samples))
+    return len(zlib.compress(sample, 1)) >= len(sample) * ratio
+
+
+def compress_blob(data, codec='zlib', level=None, check=True):
+    '''
+    compress data with the codec, returns data as is if it does not get smaller.
+
+    with check the data is returned as is without compressing if a sample of it does not compress.
+    '''
+    codec = get_codec(codec)
+    if codec is None:
+        return data
+
+    if level is None:
+        level = codec.level
+
+    if check:
+        start = time.perf_counter()
+        skip = looks_incompressible(data)
+        stats.add(checked=1, check_seconds=time.perf_counter() - start)
+        if skip:
+            stats.add(skipped=1, skipped_bytes=len(data))
+            return data
+
+    start = time.perf_counter()
+    out = codec.name.encode() + b'\n' + codec.compress(data, level)
+    stats.add(compressed=1, compressed_bytes=len(data), compress_seconds=time.perf_counter() - start)
+    if len(out) < len(data):
+        return out
+    else:
+        return data
+
+
+def decompress_blob(blob, size=None):
+    '''
+    decompress a blob with the codec named by its prefix, blobs without a codec prefix are returned as is.
+
+    blob may be any buffer, the compressed data is passed on as a slice of it without a copy. size
+    is the decompressed size if it is known.
+    '''
+    end = bytes(blob[:16]).find(b'\n')
+    if end < 0:
+        return blob
+
+    name = bytes(blob[:end]).decode('ascii', errors='replace')
+    if name not in codecs:
+        return blob
+
+    codec = get_codec(name)
+    return codec.decompress(memoryview(blob)[end + 1:], size)
+
+
+class BufferReader:
+    '''
+    a read only file over buffers taken one after the other, without joining them.
+
+    reads that fall inside one buffer return a memoryview of it, slices of the reader give bytes.
+    '''
+    def __init__(self, *buffers):
+        self.buffers = [ memoryview(b).cast('B') for b in buffers ]
+        self.size = sum(len(b) for b in self.buffers)
+        self.pos = 0
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        start, stop, _ = index.indices(self.size)
+        return bytes(self._read(start, stop))
+
+    def _read(self, start, stop):
+        parts = []
+        offset = 0
+        for b in self.buffers:
+            if start < offset + len(b) and stop > offset:
+                parts.append(b[max(start - offset, 0):stop - offset])
+            offset += len(b)
+        if len(parts) == 1:
+            return parts[0]
+        return b''.join(parts)
+
+    def read(self, n=-1):
+        stop = self.size if n is None or n < 0 else min(self.pos + n, self.size)
+        data = self._read(self.pos, stop)
+        self.pos = max(stop, self.pos)
+        return data
+
+    def seek(self, offset, whence=0):
+        self.pos = [ 0, self.pos, self.size ][whence] + offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        pass
+
+
+class SpoolReader:
+    '''
+    a read only file of size bytes written to a spooled temporary file.
+    '''
+    def __init__(self, f, size):
+        self.f = f
+        self.size = size
+        f.seek(0)
+
+    def __len__(self):
+        return self.size
+
+    def read(self, n=-1):
+        return self.f.read(n)
+
+    def seek(self, offset, whence=0):
+        return self.f.seek(offset, whence)
+
+    def tell(self):
+        return self.f.tell()
+
+    def close(self):
+        self.f.close()
+
+
+class _PrependReader:
+    def __init__(self, head, f):
+        self.head = head
+        self.f = f
+
+    def read(self, n):
+        if self.head:
+            data, self.head = self.head[:n], self.head[n:]
+            return data
+        return self.f.read(n)
+
+
+def _compress_spooled(data, prefix, c, piece_size, spool_size):
+    # given up as soon as the output is no smaller than data
+    f = tempfile.SpooledTemporaryFile(max_size=spool_size)
+    f.write(prefix)
+    written = len(prefix)
+    while True:
+        piece = data.read(piece_size)
+        out = c.compress(piece) if piece else c.flush()
+        written += len(out)
+        if written >= len(data):
+            f.close()
+            return None
+        f.write(out)
+        if not piece:
+            return SpoolReader(f, written)
+
+
+def compress_stream(data, codec='zlib', level=None, check=True, piece_size=2**20, spool_size=2**22):
+    '''
+    compress_blob for data in a BufferReader, returns a file of the same bytes compress_blob returns.
+
+    the data is compressed piece_size bytes at a time into a file that stays in memory up to
+    spool_size bytes, data itself comes back rewound if it is not compressed.
+    '''
+    codec = get_codec(codec)
+    if codec is None:
+        return data
+
+    if level is None:
+        level = codec.level
+
+    if check:
+        start = time.perf_counter()
+        skip = looks_incompressible(data)
+        stats.add(checked=1, check_seconds=time.perf_counter() - start)
+        if skip:
+            stats.add(skipped=1, skipped_bytes=len(data))
+            return data
+
+    start = time.perf_counter()
+    prefix = codec.name.encode() + b'\n'
+    data.seek(0)
+    if codec.compressobj is None:
+        out = BufferReader(prefix, codec.compress(data.read(), level))
+        if len(out) >= len(data):
+            out = None
+    else:
+        out = _compress_spooled(data, prefix, codec.compressobj(level, len(data)), piece_size, spool_size)
+    stats.add(compressed=1, compressed_bytes=len(data), compress_seconds=time.perf_counter() - start)
+    data.seek(0)
+    return data if out is None else out
+
+
+def decompress_reader(f, read_size=2**20):
+    '''
+    decompress_blob for a blob read from the file f, returns a file of the decompressed blob.
+    '''
+    head = f.read(16)
+    end = bytes(head).find(b'\n')
+    name = bytes(head[:end]).decode('ascii', errors='replace') if end >= 0 else None
+    if name not in codecs:
+        return _PrependReader(head, f)
+
+    codec = get_codec(name)
+    return codec.reader(_PrependReader(head[end + 1:], f), read_size)
@@ -0,0 +1,179 @@
+'''
+Local indexes kept next to the workdir to avoid repeating work.
+'''
+import mmap
+import shutil
+import sqlite3
+import struct
+import tempfile
+import threading
+
+from pathlib import Path
+
+
+class ChunkIndex:
+    '''
+    A persistent map from the sha256 of a plain chunk to the chunk record that stores it.
+
+    Chunk records are derived from the content, so a chunk seen before does not need to be
+    compressed, encrypted and stored again, the old record is just as good.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(path), timeout=60, isolation_level=None, check_same_thread=False)
+        self.db.execute('pragma journal_mode=wal')
+        self.db.execute('pragma synchronous=normal')
+        self.db.execute('''
+            create table if not exists chunks (
+                sha256 blob not null,
+                lock text not null,
+                size integer not null,
+                key blob not null,
+                data blob not null,
+                primary key (sha256, lock)
+            ) without rowid
+        ''')
+
+    def get(self, sha256, lock):
+        '''
+        find the record for a chunk, returns (size, sha256, lock, key, data) with hex strings, or None.
+        '''
+        with self.lock:
+            row = self.db.execute(
+                'select size, key, data from chunks where sha256 = ? and lock = ?',
+                (bytes.fromhex(sha256), lock),
+            ).fetchone()
+        if row is None:
+            return None
+        size, key, data = row
+        return size, sha256, lock, key.hex(), data.hex()
+
+    def add(self, size, sha256, lock, key, data):
+        with self.lock:
+            self.db.execute(
+                'insert or replace into chunks (sha256, lock, size, key, data) values (?, ?, ?, ?, ?)',
+                (bytes.fromhex(sha256), lock, size, bytes.fromhex(key), bytes.fromhex(data)),
+            )
+
+    def add_many(self, rows):
+        '''
+        add many (size, sha256, lock, key, data) records in one transaction.
+        '''
+        with self.lock:
+            self.db.execute('begin')
+            try:
+                self.db.executemany(
+                    'insert or replace into chunks (sha256, lock, size, key, data) values (?, ?, ?, ?, ?)',
+                    (
+                        (bytes.fromhex(sha256), lock, size, bytes.fromhex(key), bytes.fromhex(data))
+                        for size, sha256, lock, key, data in rows
+                    ),
+                )
+            except:
+                self.db.execute('rollback')
+                raise
+            self.db.execute('commit')
+
+    def clear(self):
+        with self.lock:
+            self.db.execute('delete from chunks')
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('select count(*) from chunks').fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class CheckinIndex:
+    '''
+    A side file next to an archive with the items of each of its folds, so they can be compared
+    without loading the folds from the store.
+
+    The file is a header with the sha256 of the archive, a table of (fold id, offset, length) sorted
+    by fold id, then the pages of items. It is memory mapped and the table is searched in place.
+    '''
+    magic = b'\x00tote index\n'
+    version = 1
+    header = struct.Struct('<12sB3x32sQ')
+    entry = struct.Struct('<32sQQ')
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, self.arc_sha256, self.count = self.header.unpack_from(self.map, 0)
+            if magic != self.magic or version != self.version:
+                raise ValueError('not a checkin index', str(path))
+            self.data_start = self.header.size + self.count * self.entry.size
+            if len(self.map) < self.data_start:
+                raise ValueError('checkin index is cut short', str(path))
+        except:
+            self.map.close()
+            raise
+
+    def get(self, fold_id):
+        '''
+        the page of items for a fold, or None if it is not in the index.
+        '''
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key, offset, length = self.entry.unpack_from(self.map, self.header.size + mid * self.entry.size)
+            if key < fold_id:
+                lo = mid + 1
+            elif key > fold_id:
+                hi = mid
+            else:
+                start = self.data_start + offset
+                return self.map[start:start + length]
+        return None
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.map.close()
+
+
+class CheckinIndexWriter:
+    '''
+    collects the pages for a CheckinIndex in a temporary file as the archive is written.
+    '''
+    def __init__(self, path):
+        self.path = Path(path)
+        self.pages = tempfile.TemporaryFile(dir=self.path.parent)
+        self.table = {}
+        self.size = 0
+
+    def __contains__(self, fold_id):
+        return fold_id in self.table
+
+    def add(self, fold_id, page):
+        if fold_id in self.table:
+            return
+        self.table[fold_id] = (self.size, len(page))
+        self.pages.write(page)
+        self.size += len(page)
+
+    def finish(self, arc_sha256):
+        '''
+        write the index for the archive with the sha256 arc_sha256.
+        '''
+        part = self.path.with_name(self.path.name + '.part')
+        with open(part, 'wb') as f:
+            f.write(CheckinIndex.header.pack(CheckinIndex.magic, CheckinIndex.version, arc_sha256, len(self.table)))
+            for fold_id in sorted(self.table):
+                offset, length = self.table[fold_id]
+                f.write(CheckinIndex.entry.pack(fold_id, offset, length))
+            self.pages.seek(0)
+            shutil.copyfileobj(self.pages, f)
+        part.rename(self.path)
+        self.close()
+
+    def close(self):
+        self.pages.close()
@@ -1,53 +1,79 @@
 import argparse
 import sys
 import os
+import time
 
+from contextlib import contextmanager
 from pathlib import Path
 
 import tote
+import tote.server
+import tote.watch
 
 
 def cmd_blob_cat(args):
-    conn = tote.connect()
-    blob = conn.store.load_blob(args.data)
-    sys.stdout.buffer.write(blob)
+    with tote.connect() as conn:
+        out = sys.stdout.buffer
+
+        # a blob in a local file is copied to stdout by the kernel
+        locate = getattr(conn.store, 'locate', None)
+        found = locate(args.data) if locate is not None else None
+        if found is None:
+            out.write(conn.store.load(args.data))
+            return
+
+        path, offset, length = found
+        out.flush()
+        with open(path, 'rb') as f:
+            try:
+                while length:
+                    n = os.sendfile(out.fileno(), f.fileno(), offset, length)
+                    if not n:
+                        break
+                    offset += n
+                    length -= n
+            except OSError:
+                # stdout does not take sendfile
+                f.seek(offset)
+                while length:
+                    data = f.read(min(length, 2**20))
+                    if not data:
+                        break
+                    out.write(data)
+                    length -= len(data)
 
 
 def cmd_show_workdir(args):
-    conn = tote.connect(args.path)
-    print('workdir_path =', conn.workdir_path)
-    print('store_path =', conn.store_path)
-    print('store =', conn.store)
+    with tote.connect(args.path) as conn:
+        print('workdir_path =', conn.workdir_path)
+        print('store_path =', conn.store_path)
+        print('store =', conn.store)
     
 
 def cmd_put(args):
-    conn = tote.connect()
-
-    out = conn.write_stream(sys.stdout)
+    with tote.connect() as conn:
+        out = conn.write_stream(sys.stdout)
     
-    if args.path:
-        paths = [ Path(path) for path in args.path ]
-        for path in tote.list_trees(paths, recurse=args.recursive):
-            out.write(conn.put_file(path))
-    else:
-        out.write(conn.put_stream(sys.stdin.buffer))
+        if args.path:
+            paths = [ Path(path) for path in args.path ]
+            for item in conn.put_files(tote.list_trees(paths, recurse=args.recursive)):
+                out.write(item)
+        else:
+            out.write(conn.put_stream(sys.stdin.buffer))
 
 
 def cmd_cat(args):
-    conn = tote.connect()
-    
-    out = sys.stdout.buffer
+    with tote.connect() as conn:
+        out = sys.stdout.buffer
     
-    if args.tote:
-        for file in args.tote:
-            with conn.read_file(file) as items_in:
-                for item in items_in:
-                    for chunk in conn.get_chunks(item):
-                        out.write(chunk)
-    else:
-        for item in conn.read_stream(sys.stdin):
-            for chunk in conn.get_chunks(item):
-                out.write(chunk)
+        if args.tote:
+            for file in args.tote:
+                with conn.read_file(file) as items_in:
+                    for item in items_in:
+                        conn.get_stream(item, out)
+        else:
+            for item in conn.read_stream(sys.stdin):
+                conn.get_stream(item, out)
 
 
 def cmd_scan(args):
@@ -66,135 +92,200 @@ def cmd_append(args):
     recursive = args.recursive
     u = sys.stdout
 
-    conn = tote.connect()
-    with conn.append_file(arc) as o:
-        for file in tote.list_trees(files, recurse=recursive):
-            print('append', file, file=u)
-            f = conn.put_file(file)
-            o.write(f)
+    with tote.connect() as conn:
+        with conn.append_file(arc) as o:
+            for f in conn.put_files(tote.list_trees(files, recurse=recursive)):
+                print('append', f.name, file=u)
+                o.write(f)
 
 
 def cmd_list(args):
     arc = args.tote
     files = args.file
     
-    conn = tote.connect(arc)
-    with conn.read_file(arc) as items:
+    with tote.connect(arc) as conn:
+        with conn.read_file(arc) as items:
         
-        if files:
-            items = tote._filter_items_by_names(items, files)
+            if files:
+                items = tote._filter_items_by_names(items, files)
         
-        for item in items:
-            print(item.type, item.size, item.name)
+            for item in items:
+                print(item.type, item.size, item.name)
+
+        if args.stats:
+            print(conn.unfold_stats, file=sys.stderr)
+            if isinstance(conn.store, tote.CachedStore):
+                print(conn.store.stats, file=sys.stderr)
             
             
 def cmd_fold_pipe(args):
     arc = args.tote
     out = sys.stdout.buffer
 
-    conn = tote.connect()
-    with conn.read_file(arc, unfold=False) as i:
-        with conn.write_stream(out) as o:
-            f = conn.fold(i)
-            o.writeall(f)
+    with tote.connect() as conn:
+        with conn.read_file(arc, unfold=False) as i:
+            with conn.write_stream(out) as o:
+                f = conn.fold(i)
+                o.writeall(f)
 
 
 def cmd_refold_pipe(args):
     arc = args.tote
     out = sys.stdout
     
-    conn = tote.connect(arc)
-    with conn.read_file(arc) as items_in:
-        with conn.write_stream(out) as items_out:
-            items = conn.fold(items_in)
-            items_out.writeall(items)
+    with tote.connect(arc) as conn:
+        with conn.read_file(arc) as items_in:
+            with conn.write_stream(out) as items_out:
+                items = conn.fold(items_in)
+                items_out.writeall(items)
 
 def cmd_refold(args):
     arc = args.tote
 
-    conn = tote.connect(arc)
-
-    with conn.read_file(arc) as items_in:
-        with conn.write_file(arc + '.part') as items_out:
-            items = conn.fold(items_in)
-            items_out.writeall(items)
+    with tote.connect(arc) as conn:
+        with conn.read_file(arc) as items_in:
+            with conn.write_file(arc + '.part') as items_out:
+                items = conn.fold(items_in)
+                items_out.writeall(items)
 
-    with conn.append_file(arc + '.history') as items_out:
-        items_out.write(conn.put_file(arc))
+        with conn.append_file(arc + '.history') as items_out:
+            items_out.write(conn.put_file(arc))
 
-    os.rename(arc + '.part', arc)
+        os.rename(arc + '.part', arc)
 
 
 def cmd_unfold_pipe(args):
     arc = args.tote
     out = sys.stdout
     
-    conn = tote.connect(arc)
-    with conn.read_file(arc) as items_in:
-        with conn.write_stream(out) as items_out:
-            items_out.writeall(items_in)
+    with tote.connect(arc) as conn:
+        with conn.read_file(arc) as items_in:
+            with conn.write_stream(out) as items_out:
+                items_out.writeall(items_in)
 
 def cmd_unfold(args):
     arc = args.tote
     
-    conn = tote.connect(arc)
+    with tote.connect(arc) as conn:
+        with conn.read_file(arc) as items_in:
+            with conn.write_file(arc + '.part') as items_out:
+                items_out.writeall(items_in)
 
-    with conn.read_file(arc) as items_in:
-        with conn.write_file(arc + '.part') as items_out:
-            items_out.writeall(items_in)
+        with conn.append_file(arc + '.history') as items_out:
+            items_out.write(conn.put_file(arc))
 
-    with conn.append_file(arc + '.history') as items_out:
-        items_out.write(conn.put_file(arc))
-
-    os.rename(arc + '.part', arc)
+        os.rename(arc + '.part', arc)
 
     
+def _dirty_regions(args, conn, last_checkin):
+    """
+    read the watch journal, returns its state and the regions changed since last_checkin or None to scan it all.
+    """
+    state = tote.watch.Journal(conn.tote_path).read()
+    if args.full:
+        return state, None
+    dirty = state.dirty_regions(last_checkin)
+    if dirty is not None and args.verbose:
+        print('scanning %d changed regions' % len(dirty))
+    return state, dirty
+
+
 def cmd_status(args):
-    conn = tote.connect()
-    
-    last_checkin = conn._most_recent_checkin()
-    
-    tote.tote_update(
-        arc=last_checkin,
-        paths=[conn.workdir_path], 
-        relative_to=conn.workdir_path,
-        base_path=conn.workdir_path,
-        conn=conn,
-        dryrun=True,
-        verbose=True,
-    )
+    with tote.connect() as conn:
+        last_checkin = conn._most_recent_checkin()
+        state, dirty = _dirty_regions(args, conn, last_checkin)
+    
+        tote.tote_update(
+            arc=last_checkin,
+            paths=[conn.workdir_path], 
+            relative_to=conn.workdir_path,
+            base_path=conn.workdir_path,
+            conn=conn,
+            dryrun=True,
+            verbose=True,
+            dirty=dirty,
+        )
 
 
 import subprocess
 
 def cmd_checkin(args):
-    conn = tote.connect()
-    timestamp = tote.format_timestamp(safe=True)
-    
-    # pre checkin hook
-    pre_hook = conn.tote_path / "checkin-pre"
-    if pre_hook.exists():
-        subprocess.run([pre_hook, timestamp], check=True, cwd=conn.workdir_path)
-    
-    arc_output = conn.tote_path / 'checkin' / 'default' / (timestamp + '.tote')
-    arc_output.parent.mkdir(parents=True, exist_ok=True)
-    
-    last_checkin = conn._most_recent_checkin()
-    
-    tote.tote_update(
-        arc=last_checkin,
-        arc_output=arc_output,
-        paths=[conn.workdir_path], 
-        relative_to=conn.workdir_path,
-        base_path=conn.workdir_path,
-        conn=conn,
-        verbose=args.verbose,
-    )
-    
-    # post checkin hook (arc_output)
-    post_hook = conn.tote_path / "checkin-post"
-    if post_hook.exists():
-        subprocess.run([post_hook, arc_output], check=True, cwd=conn.workdir_path)
+    with tote.connect() as conn:
+        timestamp = tote.format_timestamp(safe=True)
+    
+        # pre checkin hook
+        pre_hook = conn.tote_path / "checkin-pre"
+        if pre_hook.exists():
+            subprocess.run([pre_hook, timestamp], check=True, cwd=conn.workdir_path)
+    
+        arc_output = conn.tote_path / 'checkin' / 'default' / (timestamp + '.tote')
+        arc_output.parent.mkdir(parents=True, exist_ok=True)
+    
+        last_checkin = conn._most_recent_checkin()
+        journal = tote.watch.Journal(conn.tote_path)
+        state, dirty = _dirty_regions(args, conn, last_checkin)
+    
+        tote.tote_update(
+            arc=last_checkin,
+            arc_output=arc_output,
+            paths=[conn.workdir_path], 
+            relative_to=conn.workdir_path,
+            base_path=conn.workdir_path,
+            conn=conn,
+            verbose=args.verbose,
+            dirty=dirty,
+            write_index=conn.checkin_index,
+        )
+
+        # the changes up to the journal read are in the checkin now
+        journal.advance(state, arc_output)
+
+        if args.verbose:
+            print(tote.compress.stats)
+            print(conn.unfold_stats)
+            if isinstance(conn.store, tote.CachedStore):
+                print(conn.store.stats)
+    
+        # upload what the checkin staged without waiting for it
+        if conn.staging is not None and conn.staging_flush == 'background':
+            with open(conn.staging.path / 'flush.log', 'ab') as log:
+                subprocess.Popen(
+                    [sys.executable, '-m', 'tote', 'flush', '--no-wait'],
+                    cwd=conn.workdir_path, stdin=subprocess.DEVNULL, stdout=log, stderr=log,
+                    start_new_session=True,
+                )
+
+        # post checkin hook (arc_output)
+        post_hook = conn.tote_path / "checkin-post"
+        if post_hook.exists():
+            subprocess.run([post_hook, arc_output], check=True, cwd=conn.workdir_path)
+
+
+def cmd_watch(args):
+    with tote.connect() as conn:
+        tote.watch.Watcher(conn, verbose=args.verbose).run()
+
+
+def cmd_flush(args):
+    with tote.connect() as conn:
+        if conn.staging is None:
+            print('no staging area, set enabled in [staging] of the config', file=sys.stderr)
+            return
+
+        if args.list:
+            for name in conn.staging.pending():
+                print(name)
+            return
+
+        start = time.time()
+        flushed = conn.staging.flush(wait=not args.no_wait)
+        if flushed is None:
+            if args.verbose:
+                print('another flush is running')
+            return
+        count, size = flushed
+        if args.verbose:
+            print('uploaded %d blobs, %.1f MiB in %.2fs' % (count, size / 2**20, time.time() - start))
 
 
 def cmd_add(args):
@@ -219,23 +310,364 @@ def cmd_extract(args):
     files = args.file
     to = args.to
 
-    conn = tote.connect(arc)
-    with conn.read_file(arc) as items_in:
-        if files:
-            items_in = tote._filter_items_by_names(items_in, files)
-
+    with tote.connect(arc) as conn:
+        with conn.read_file(arc) as items_in:
+            if files:
+                items_in = tote._filter_items_by_names(items_in, files)
+
+            for item in items_in:
+                print(item.name)
+                conn.get_file(item, out_base=to)
+
+def cmd_chunk_stats(args):
+    '''compare the dedup and speed of the chunk methods on some files'''
+    from hashlib import sha256
+    from tote.chunker import make_chunker
+
+    for method in ('fixed', 'cdc'):
+        chunk = make_chunker(
+            method=method,
+            size=tote._parse_size(args.size),
+            min_size=tote._parse_size(args.min_size),
+            avg_size=tote._parse_size(args.avg_size),
+            max_size=tote._parse_size(args.max_size),
+        )
+
+        seen = set()
+        count = total = unique = 0
+        elapsed = 0.0
+        for f in args.file:
+            with open(f, 'rb') as i:
+                start = time.perf_counter()
+                for data in chunk(i):
+                    elapsed += time.perf_counter() - start
+                    count += 1
+                    total += len(data)
+                    h = sha256(data).digest()
+                    if h not in seen:
+                        seen.add(h)
+                        unique += len(data)
+                    start = time.perf_counter()
+                elapsed += time.perf_counter() - start
+
+        # the time is the chunker's alone, hashing the chunks for the dedup count is left out
+        print(method, 'chunks', count, 'bytes', total, 'unique', unique,
+            'dedup %.3f' % (total / unique if unique else 1.0),
+            'throughput %.1f MiB/s' % (total / elapsed / 2**20 if elapsed else 0.0),
+        )
+
+
+def _bench_items(n):
+    '''n file items with one chunk each in name order, like the checkin of a large tree'''
+    from datetime import datetime, timezone
+    from hashlib import sha256
+
+    for i in range(n):
+        h = sha256(b'%d' % i).hexdigest()
+        yield tote.FileItem(
+            name='dir%04d/sub%02d/file%07d.txt' % (i // 10000, i // 1000 % 10, i),
+            type='file',
+            mtime=datetime.fromtimestamp(1500000000 + i * 7.25, tz=timezone.utc),
+            size=1000 + i % 50000,
+            sha256=h,
+            content=[tote.Chunk(size=1000 + i % 50000, sha256=h, lock='aes256ctr', key=h[::-1], data=h[1:] + h[0])],
+        )
+
+
+def cmd_decode_bench(args):
+    '''time decoding a text archive and fold pages of many items'''
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as path:
+        arc = os.path.join(path, 'bench.tote')
+        start = time.perf_counter()
+        with open(arc, 'wt') as f, tote.ToteWriter(fd=f) as w:
+            w.writeall(_bench_items(args.items))
+        print('archive encode %d items in %.2fs' % (args.items, time.perf_counter() - start))
+
+        start = time.perf_counter()
+        with open(arc, 'rt') as f:
+            count = sum(1 for item in tote.decode_item_stream(f))
+        elapsed = time.perf_counter() - start
+        print('archive decode %d items in %.2fs, %.0f items/s, %.1f MiB' % (
+            count, elapsed, count / elapsed, os.path.getsize(arc) / 2**20,
+        ))
+
+    page_size = tote._parse_size(args.page_size)
+    for format in ('text', 'binary'):
+        # the pages are made and decoded one at a time so a million items fit in memory,
+        # only the decoding is timed
+        count = pages = size = 0
+        elapsed = 0.0
+        page = tote._page_writer(format)
+        items = _bench_items(args.items)
+        while True:
+            for item in items:
+                page.write(item)
+                if page.size >= page_size:
+                    break
+            if not len(page):
+                break
+            blob = page.getvalue()
+            start = time.perf_counter()
+            count += sum(1 for item in tote.decode_items_bytes(blob))
+            elapsed += time.perf_counter() - start
+            pages += 1
+            size += len(blob)
+            page = tote._page_writer(format)
+        print('%s pages decode %d items in %.2fs, %.0f items/s, %d pages, %.1f MiB' % (
+            format, count, elapsed, count / elapsed if elapsed else 0.0, pages, size / 2**20,
+        ))
+
+
+def cmd_memory_bench(args):
+    '''measure the memory of many decoded items and the time to sort them'''
+    import gc
+    import random
+    import tracemalloc
+
+    page_size = tote._parse_size(args.page_size)
+    items_in = _bench_items(args.items)
+    items = []
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    # decoded from fold pages like unfold does, the pages are made one at a time and dropped
+    while True:
+        page = tote._page_writer(args.format)
         for item in items_in:
-            print(item.name)
-            conn.get_file(item, out_base=to)
+            page.write(item)
+            if page.size >= page_size:
+                break
+        if not len(page):
+            break
+        blob = page.getvalue()
+        del page
+        items.extend(tote.decode_items_bytes(blob))
+        del blob
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('%d %s decoded items: %.0f bytes per item, %.1f MiB, peak %.1f MiB' % (
+        len(items), args.format, (current - base) / len(items), (current - base) / 2**20, (peak - base) / 2**20,
+    ))
+
+    random.Random(0).shuffle(items)
+    start = time.perf_counter()
+    items.sort(key=tote._item_sort_key)
+    print('sort %d items in %.2fs' % (len(items), time.perf_counter() - start))
+
+
+class _CountedEntry:
+    '''a scandir entry that counts its stat calls, the rest comes from the listing'''
+    def __init__(self, entry, counts):
+        self._entry = entry
+        self._counts = counts
+        self.name = entry.name
+        self.path = entry.path
+
+    def stat(self, follow_symlinks=True):
+        self._counts['entry.stat'] += 1
+        return self._entry.stat(follow_symlinks=follow_symlinks)
+
+    def __getattr__(self, name):
+        return getattr(self._entry, name)
+
+
+class _CountedScandir:
+    def __init__(self, it, counts):
+        self._it = it
+        self._counts = counts
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._it.close()
+
+    def __iter__(self):
+        for entry in self._it:
+            yield _CountedEntry(entry, self._counts)
+
+
+@contextmanager
+def _count_os_calls():
+    '''
+    count the calls into os that reach the kernel while in the block, in place of strace.
+    a scandir counts once however many reads the listing takes.
+    '''
+    from collections import Counter
+
+    counts = Counter()
+    saved = { name: getattr(os, name) for name in ('scandir', 'stat', 'lstat', 'readlink', 'listdir') }
+
+    def counted(name):
+        def call(*args, **kwargs):
+            counts[name] += 1
+            return saved[name](*args, **kwargs)
+        return call
+
+    for name in saved:
+        setattr(os, name, counted(name))
+    scandir = os.scandir
+    os.scandir = lambda *args: _CountedScandir(scandir(*args), counts)
+    try:
+        yield counts
+    finally:
+        for name, f in saved.items():
+            setattr(os, name, f)
+
+
+def _make_bench_tree(path, files, per_dir):
+    '''make files empty files in directories of per_dir, every 100th of them a link'''
+    for i in range(0, files, per_dir):
+        d = os.path.join(path, 'd%04d' % (i // per_dir // 1000), 's%03d' % (i // per_dir % 1000))
+        os.makedirs(d, exist_ok=True)
+        for j in range(i, min(i + per_dir, files)):
+            name = os.path.join(d, 'f%07d' % j)
+            if j % 100 == 99:
+                os.symlink('f%07d' % (j - 1), name)
+            else:
+                open(name, 'wb').close()
+
+
+def cmd_scan_bench(args):
+    '''count the system calls and time of scanning a large tree, made first if needed'''
+    import shutil
+    import tempfile
+
+    path = args.path or tempfile.mkdtemp(prefix='tote-scan-bench-')
+    try:
+        marker = os.path.join(path, '.scan-bench-%d-%d' % (args.files, args.per_dir))
+        if not os.path.exists(marker):
+            start = time.perf_counter()
+            _make_bench_tree(path, args.files, args.per_dir)
+            open(marker, 'wb').close()
+            print('made %d files in %s in %.1fs' % (args.files, path, time.perf_counter() - start))
+
+        # once to warm the cache, once for the time, once for the count
+        for item in tote.scan_trees([path], threads=args.threads):
+            pass
+        start = time.perf_counter()
+        count = sum(1 for item in tote.scan_trees([path], threads=args.threads))
+        elapsed = time.perf_counter() - start
+        with _count_os_calls() as counts:
+            for item in tote.scan_trees([path], threads=args.threads):
+                pass
+        print('scan_trees %d entries in %.2fs, %.0f entries/s, %.2f calls per entry: %s' % (
+            count, elapsed, count / elapsed, sum(counts.values()) / count,
+            ' '.join('%s %d' % c for c in sorted(counts.items())),
+        ))
+
+        if args.per_path:
+            # the way a path at a time costs, for comparing
+            paths = list(tote.list_trees([path]))
+            start = time.perf_counter()
+            for p in paths:
+                tote.get_file_info(p)
+            elapsed = time.perf_counter() - start
+            with _count_os_calls() as counts:
+                for p in paths:
+                    tote.get_file_info(p)
+            print('get_file_info %d paths in %.2fs, %.0f paths/s, %.2f calls per path: %s' % (
+                len(paths), elapsed, len(paths) / elapsed, sum(counts.values()) / len(paths),
+                ' '.join('%s %d' % c for c in sorted(counts.items())),
+            ))
+    finally:
+        if args.path is None:
+            shutil.rmtree(path)
+
+
+def cmd_serve(args):
+    try:
+        conn = tote.connect()
+    except FileNotFoundError:
+        if args.path is None:
+            raise
+        conn = None
+
+    if args.path is not None:
+        path = Path(args.path)
+        store = tote.PackStore(path) if (path / 'packs').is_dir() else tote.FileStore(path)
+    else:
+        store = conn.local_store()
+    auth = None
+    if conn is not None:
+        username = conn.config.get('store', 'username', fallback=None)
+        if username is not None:
+            auth = (username, conn.config.get('store', 'password', fallback=''))
+
+    try:
+        tote.server.serve(store, host=args.host, port=args.port, auth=auth, verbose=args.verbose)
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+def cmd_serve_bench(args):
+    for line in tote.server.benchmark(
+        connections=args.connections,
+        blobs=args.blobs,
+        size=tote._parse_size(args.size),
+        store_type=tote.PackStore if args.type == 'pack' else tote.FileStore,
+    ):
+        print(line)
+
+
+def cmd_repack(args):
+    with tote.connect() as conn:
+        if conn.store_type != 'pack':
+            print('the store is not a pack store, set type = pack in [store] of the config', file=sys.stderr)
+            return
+
+        if args.prune and not args.force:
+            print('--prune drops every blob that no checkin of this workdir uses, list other archives '
+                'whose blobs are in the store with --keep and add --force', file=sys.stderr)
+            return
+
+        store = conn.local_store()
+        try:
+            keep = None
+            if args.prune:
+                archives = conn._checkins() + [ Path(arc) for arc in args.keep ]
+                keep = conn.referenced_blobs(archives)
+            start = time.time()
+            (kept, kept_bytes), (removed, removed_bytes) = store.repack(keep=keep)
+        finally:
+            store.close()
+        if args.verbose:
+            print('kept %d blobs, %.1f MiB, removed %d blobs, %.1f MiB in %.2fs' % (
+                kept, kept_bytes / 2**20, removed, removed_bytes / 2**20, time.time() - start,
+            ))
+
+    if args.prune:
+        # the index must not point at the blobs just dropped, a new connection sees the new packs
+        with tote.connect() as conn:
+            if conn.chunk_index is not None:
+                conn.rebuild_chunk_index(archives=archives, check=True)
+
+
+def cmd_chunk_index(args):
+    '''show or rebuild the known chunk index'''
+    with tote.connect() as conn:
+        if conn.chunk_index is None:
+            print('the chunk index is turned off in the config')
+            return
+
+        if args.rebuild:
+            conn.rebuild_chunk_index(archives=args.tote or None, check=args.check)
+
+        print('chunks', len(conn.chunk_index))
+
 
 def cmd_import_blobs(args):
-    conn = tote.connect()
-    for f in args.file:
-        print(f, '...')
-        p = Path(f)
-        with open(p, 'rb') as i:
-            b = i.read()
-        conn.store.save(b)
+    with tote.connect() as conn:
+        for f in args.file:
+            print(f, '...')
+            p = Path(f)
+            with open(p, 'rb') as i:
+                b = i.read()
+            conn.store.save(b)
     
     
 def main(argv=None):
@@ -278,6 +710,7 @@ def main(argv=None):
     c = s.add_parser('list', help='list files in list')
     c.add_argument('tote')
     c.add_argument('file', nargs='*')
+    c.add_argument('--stats', action='store_true', help='print how long reading the folds took to stderr')
     c.set_defaults(func=cmd_list)
     
     c = s.add_parser('fold-pipe', help='fold list to stdout')
@@ -301,12 +734,25 @@ def main(argv=None):
     c.set_defaults(func=cmd_unfold)
     
     c = s.add_parser('status', help='show what changed since the last checkin')
+    c.add_argument('--full', action='store_true', help='scan the whole workdir even if tote watch is running')
+    c.add_argument('--verbose', action='store_true', help='verbose output')
     c.set_defaults(func=cmd_status)
 
     c = s.add_parser('checkin', help='checkin the current state')
+    c.add_argument('--full', action='store_true', help='scan the whole workdir even if tote watch is running')
     c.add_argument('--verbose', action='store_true', help='verbose output')
     c.set_defaults(func=cmd_checkin)
+
+    c = s.add_parser('watch', help='keep a journal of changes so checkin and status only scan those')
+    c.add_argument('--verbose', action='store_true', help='print the changes')
+    c.set_defaults(func=cmd_watch)
     
+    c = s.add_parser('flush', help='upload the blobs in the staging area to the store')
+    c.add_argument('--no-wait', action='store_true', help='return at once if another flush is running')
+    c.add_argument('--list', action='store_true', help='print the blobs waiting to be uploaded')
+    c.add_argument('--verbose', action='store_true', help='print what was uploaded')
+    c.set_defaults(func=cmd_flush)
+
     c = s.add_parser('add', help='add and updates files in list')
     c.add_argument('tote')
     c.add_argument('file', nargs='+')
@@ -330,6 +776,60 @@ def main(argv=None):
 #     c.add_argument('--recursive', action='store_true', help='recursively decend into directories')
     c.set_defaults(func=cmd_import_blobs)
     
+    c = s.add_parser('serve', help='serve a store over http for the url store of other workdirs')
+    c.add_argument('path', nargs='?', help='the store, defaults to the store of the workdir')
+    c.add_argument('--host', default='127.0.0.1')
+    c.add_argument('--port', type=int, default=8080)
+    c.add_argument('--verbose', action='store_true', help='print each request')
+    c.set_defaults(func=cmd_serve)
+
+    c = s.add_parser('serve-bench', help='measure put, head and get through tote serve on localhost')
+    c.add_argument('--connections', type=int, default=8)
+    c.add_argument('--blobs', type=int, default=256)
+    c.add_argument('--size', default='1M')
+    c.add_argument('--type', choices=['file', 'pack'], default='file', help='the kind of store served')
+    c.set_defaults(func=cmd_serve_bench)
+
+    c = s.add_parser('repack', help='copy the blobs of a pack store into new full packs')
+    c.add_argument('--prune', action='store_true', help='drop the blobs no checkin of this workdir uses')
+    c.add_argument('--keep', action='append', default=[], metavar='ARCHIVE', help='with --prune also keep the blobs of this archive')
+    c.add_argument('--force', action='store_true', help='needed with --prune, as blobs not kept are gone')
+    c.add_argument('--verbose', action='store_true', help='print what was kept and removed')
+    c.set_defaults(func=cmd_repack)
+
+    c = s.add_parser('chunk-index', help='show or rebuild the index of chunks already in the store')
+    c.add_argument('tote', nargs='*', help='archives to rebuild from, default all the checkins')
+    c.add_argument('--rebuild', action='store_true', help='clear the index and refill it from the archives')
+    c.add_argument('--check', action='store_true', help='only add chunks whose blobs are in the store')
+    c.set_defaults(func=cmd_chunk_index)
+
+    c = s.add_parser('decode-bench', help='measure decoding an archive and fold pages of many items')
+    c.add_argument('--items', type=int, default=1000000)
+    c.add_argument('--page-size', default='4M', help='size of the fold pages')
+    c.set_defaults(func=cmd_decode_bench)
+
+    c = s.add_parser('memory-bench', help='measure the memory of many decoded items and sorting them')
+    c.add_argument('--items', type=int, default=1000000)
+    c.add_argument('--format', choices=['text', 'binary'], default='binary', help='the format of the fold pages')
+    c.add_argument('--page-size', default='4M', help='size of the fold pages')
+    c.set_defaults(func=cmd_memory_bench)
+
+    c = s.add_parser('scan-bench', help='count the system calls and time of scanning a large tree')
+    c.add_argument('path', nargs='?', help='where to make the tree and keep it, defaults to a temporary directory')
+    c.add_argument('--files', type=int, default=1000000)
+    c.add_argument('--per-dir', type=int, default=1000, help='files in each directory')
+    c.add_argument('--threads', type=int, default=0, help='threads listing directories ahead')
+    c.add_argument('--per-path', action='store_true', help='also time get_file_info on each path')
+    c.set_defaults(func=cmd_scan_bench)
+
+    c = s.add_parser('chunk-stats', help='compare dedup and speed of the chunk methods on files')
+    c.add_argument('file', nargs='+', help='files to chunk, versions of the same file show the dedup')
+    c.add_argument('--size', default='16M', help='fixed chunk size')
+    c.add_argument('--min-size', default='512K', help='smallest content defined chunk')
+    c.add_argument('--avg-size', default='2M', help='target content defined chunk size')
+    c.add_argument('--max-size', default='8M', help='largest content defined chunk')
+    c.set_defaults(func=cmd_chunk_stats)
+    
     args = p.parse_args(argv)
     if 'func' not in args:
         p.print_usage()
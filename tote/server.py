@@ -0,0 +1,286 @@
+'''
+An http server for a FileStore that answers the requests of UrlStore.
+
+    GET /<name>     the blob, sent from the file with sendfile
+    HEAD /<name>    200 if the blob is there, 404 if not
+    PUT /<name>     save the body as the blob, it has to hash to name
+
+names are sha256 hex digests. Anything before the last / of the path is ignored, so the server
+can sit behind a proxy at any url prefix.
+'''
+import asyncio
+import base64
+import hmac
+import os
+import re
+import tempfile
+import threading
+import time
+
+from contextlib import suppress
+from hashlib import sha256
+from http import HTTPStatus
+from itertools import count
+from os.path import join
+from pathlib import Path
+
+from .store import FileStore, UrlStore
+
+
+_blob_name = re.compile(r'[0-9a-f]{64}\Z')
+
+
+class BlobServer:
+    '''
+    serves the blobs of a FileStore or PackStore, with auth as (username, password) requests need basic auth.
+
+    request bodies are read read_size bytes at a time and hashed and written to a file on the
+    default executor, so uploads are checked in parallel and never held in memory whole.
+    '''
+    def __init__(self, store, auth=None, read_size=2**20, max_size=2**32, verbose=False):
+        self.store = store
+        self.incoming = Path(store.path) / 'incoming'
+        self.incoming.mkdir(parents=True, exist_ok=True)
+        self.authorization = None
+        if auth is not None:
+            token = base64.b64encode(('%s:%s' % auth).encode()).decode('ascii')
+            self.authorization = ('Basic ' + token).encode()
+        self.read_size = read_size
+        self.max_size = max_size
+        self.verbose = verbose
+        self._parts = count()
+
+    async def start(self, host='127.0.0.1', port=8080):
+        return await asyncio.start_server(self.handle, host, port, limit=self.read_size, reuse_address=True)
+
+    async def handle(self, reader, writer):
+        try:
+            while await self._request(reader, writer):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            with suppress(ConnectionError):
+                await writer.wait_closed()
+
+    async def _respond(self, writer, status, length=0, close=False, headers=()):
+        lines = [ 'HTTP/1.1 %d %s' % (status, HTTPStatus(status).phrase), 'Content-Length: %d' % length ]
+        lines.extend(headers)
+        if close:
+            lines.append('Connection: close')
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+
+    async def _request(self, reader, writer):
+        '''
+        answer one request, returns False when the connection should be closed.
+        '''
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except asyncio.IncompleteReadError:
+            return False
+        except asyncio.LimitOverrunError:
+            await self._respond(writer, 431, close=True)
+            return False
+
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ')
+        except ValueError:
+            await self._respond(writer, 400, close=True)
+            return False
+
+        headers = {}
+        for line in lines[1:]:
+            if line:
+                key, _, value = line.partition(':')
+                headers[key.strip().lower()] = value.strip()
+
+        connection = headers.get('connection', '').lower()
+        keep = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            await self._respond(writer, 400, close=True)
+            return False
+        if 'transfer-encoding' in headers:
+            # a body of unknown length can not be skipped over, so it ends the connection
+            await self._respond(writer, 411, close=True)
+            return False
+
+        if self.authorization is not None:
+            given = headers.get('authorization', '').encode('latin-1')
+            if not hmac.compare_digest(given, self.authorization):
+                await self._respond(writer, 401, close=True, headers=['WWW-Authenticate: Basic realm="tote"'])
+                return False
+
+        name = target.partition('?')[0].rpartition('/')[2]
+        if not _blob_name.match(name):
+            status = 404
+        elif method in ('GET', 'HEAD'):
+            status = await self._get(writer, name, method == 'GET', keep)
+        elif method == 'PUT':
+            if length > self.max_size:
+                await self._respond(writer, 413, close=True)
+                return False
+            if headers.get('expect', '').lower() == '100-continue':
+                writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+            status = await self._put(reader, name, length)
+            length = 0
+        else:
+            status = 405
+
+        while length:
+            # skip the body of a request that did not use it
+            length -= len(await reader.readexactly(min(length, self.read_size)))
+        if status is not None:
+            await self._respond(writer, status, close=not keep)
+        if self.verbose:
+            print(method, name, status or 200)
+        return keep
+
+    async def _get(self, writer, name, send, keep):
+        '''
+        send the blob, returns None once it is sent or the status to respond with.
+        '''
+        # a pack store may wait on its lock while another blob is appended, so the lookup and the
+        # open run off the loop like the writes
+        found = await asyncio.get_running_loop().run_in_executor(None, self._open, name)
+        if found is None:
+            return 404
+        f, offset, size = found
+
+        with f:
+            await self._respond(writer, 200, length=size, close=not keep, headers=['Content-Type: application/octet-stream'])
+            if send and size:
+                # zero copy from the page cache to the socket where the platform allows it
+                await asyncio.get_running_loop().sendfile(writer.transport, f, offset, size)
+        return None
+
+    def _open(self, name):
+        '''
+        the (file, offset, size) of the blob, or None.
+        '''
+        found = self.store.locate(name)
+        if found is None:
+            return None
+        path, offset, size = found
+        try:
+            return open(path, 'rb'), offset, size
+        except FileNotFoundError:
+            return None
+
+    def _write(self, h, f, data):
+        h.update(data)
+        if f is not None:
+            f.write(data)
+
+    async def _put(self, reader, name, length):
+        '''
+        read a body of length bytes into the blob name, returns the status to respond with.
+        '''
+        loop = asyncio.get_running_loop()
+        exists = await loop.run_in_executor(None, self.store.exists, name)
+
+        h = sha256()
+        f = None
+        part = None
+        try:
+            if not exists:
+                part = str(self.incoming / ('%s.%d.%d.part' % (name, os.getpid(), next(self._parts))))
+                f = open(part, 'wb')
+
+            remaining = length
+            while remaining:
+                data = await reader.read(min(remaining, self.read_size))
+                if not data:
+                    raise asyncio.IncompleteReadError(b'', remaining)
+                remaining -= len(data)
+                await loop.run_in_executor(None, self._write, h, f, data)
+
+            if h.hexdigest() != name:
+                return 400
+            if f is not None:
+                f.close()
+                await loop.run_in_executor(None, self.store.save_file, name, part)
+                part = None
+                return 201
+            return 204
+        finally:
+            if f is not None:
+                f.close()
+            if part is not None:
+                with suppress(FileNotFoundError):
+                    os.unlink(part)
+
+
+def serve(store, host='127.0.0.1', port=8080, auth=None, verbose=False):
+    '''
+    serve the store until interrupted.
+    '''
+    async def run():
+        server = await BlobServer(store, auth=auth, verbose=verbose).start(host, port)
+        if verbose:
+            for sock in server.sockets:
+                print('serving %s on %s port %d' % (store, *sock.getsockname()[:2]))
+        async with server:
+            await server.serve_forever()
+
+    with suppress(KeyboardInterrupt):
+        asyncio.run(run())
+
+
+async def _stop(server, timeout=5):
+    server.close()
+    # the connections end once the client closes them, the ones left after timeout are cancelled
+    tasks = [ task for task in asyncio.all_tasks() if task is not asyncio.current_task() ]
+    if tasks:
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+def benchmark(connections=8, blobs=256, size=2**20, store_type=FileStore):
+    '''
+    put, check and get blobs random blobs of size bytes through a UrlStore to a server on localhost, yields lines of results.
+    '''
+    with tempfile.TemporaryDirectory() as path:
+        os.mkdir(join(path, 'blobs'))
+        loop = asyncio.new_event_loop()
+        server = loop.run_until_complete(BlobServer(store_type(path)).start('127.0.0.1', 0))
+        thread = threading.Thread(target=loop.run_forever, name='tote-serve', daemon=True)
+        thread.start()
+        try:
+            port = server.sockets[0].getsockname()[1]
+            store = UrlStore('http://127.0.0.1:%d/' % port, None, connections=connections, retries=0)
+            data = [ os.urandom(size) for _ in range(blobs) ]
+            total = blobs * size / 2**20
+
+            start = time.perf_counter()
+            names = list(store._pool.map(store.save, data))
+            elapsed = time.perf_counter() - start
+            yield 'put %d x %d bytes: %.1f MiB/s, %.0f blobs/s' % (blobs, size, total / elapsed, blobs / elapsed)
+
+            start = time.perf_counter()
+            found = store.exists_many(names * 4)
+            elapsed = time.perf_counter() - start
+            if not all(found):
+                raise IOError('blobs put are missing')
+            yield 'head %d: %.0f requests/s' % (len(found), len(found) / elapsed)
+
+            start = time.perf_counter()
+            for name, blob in zip(names, store.load_many(names)):
+                if sha256(blob).hexdigest() != name:
+                    raise IOError('blob got back does not match', name)
+            elapsed = time.perf_counter() - start
+            yield 'get %d x %d bytes: %.1f MiB/s, %.0f blobs/s' % (blobs, size, total / elapsed, blobs / elapsed)
+
+            store.session.close()
+        finally:
+            asyncio.run_coroutine_threadsafe(_stop(server), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
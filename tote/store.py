@@ -1,7 +1,13 @@
+import fcntl
+import mmap
 import os
 import os.path
+import struct
+import sys
+import threading
 
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from contextlib import contextmanager, suppress
 from functools import partial
 from hashlib import sha256
 from os.path import isdir, isfile, join
@@ -23,19 +29,45 @@ def file_path(path, name, suffix=''):
     return join(bucket, name + suffix) 
 
 
-def save_blob(path, name, blob, suffix='', overwrite=False):
+def _write_blob(f, blob, piece_size=2**20):
+    # a blob may be a file to copy it from a piece at a time
+    if not hasattr(blob, 'read'):
+        f.write(blob)
+        return
+    for data in iter(partial(blob.read, piece_size), b''):
+        f.write(data)
+
+
+def save_blob(path, name, blob, suffix='', overwrite=False, sync=False):
     bp = bucket_path(path, name)
     if not isdir(bp):
         if not isdir(path):
             raise ValueError("path does not exist", path)
-        os.makedirs(bp)
+        # another thread or process may make it first
+        os.makedirs(bp, exist_ok=True)
 
     fn = file_path(path, name, suffix)
     create = not isfile(fn)
     if overwrite or create:
-        with open(fn + '.part', 'wb') as f:
-            f.write(blob)
-        os.rename(fn + '.part', fn)
+        # the same blob may be saved by several threads or processes at once
+        part = '%s.%d.%d.part' % (fn, os.getpid(), threading.get_ident())
+        with open(part, 'wb') as f:
+            _write_blob(f, blob)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.rename(part, fn)
+        if sync:
+            _fsync(bp)
+
+
+def _fsync(path):
+    # a directory too, so the names in it are on disk
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
 
 def load_blob(path, name, suffix=''):
@@ -43,6 +75,22 @@ def load_blob(path, name, suffix=''):
     with open(fn, 'rb') as f:
         return f.read()
 
+
+def read_buffer(fn):
+    '''
+    read a whole file into a new bytearray, with no copies past the one from the kernel.
+    '''
+    with open(fn, 'rb', buffering=0) as f:
+        buf = bytearray(os.fstat(f.fileno()).st_size)
+        view = memoryview(buf)
+        pos = 0
+        while pos < len(buf):
+            n = f.readinto(view[pos:])
+            if not n:
+                raise IOError('file is shorter than its size', fn)
+            pos += n
+    return buf
+
     
 def save_chunk(store, chunk, **kwargs):
     name = sha256(chunk).hexdigest()
@@ -69,11 +117,22 @@ class FileStore:
         name = sha256(blob).hexdigest()
         store.save_blob(name, blob, **kwargs)
         return name
+
+    def save_stream(self, name, f):
+        '''
+        save the blob name read from the file f, which has to have the blob's length, returns name.
+        '''
+        self.save_blob(name, f)
+        return name
         
     def load_blob(self, name, *args, **kwargs):
         base = join(self.path, 'blobs')
         return load_blob(base, name, *args, **kwargs)
     
+    def exists(self, name):
+        base = join(self.path, 'blobs')
+        return isfile(file_path(base, name))
+
     def getsize(self, name, *args, **kwargs):
         base = join(self.path, 'blobs')
         fn = file_path(base, name, *args, **kwargs)
@@ -82,6 +141,35 @@ class FileStore:
     def load(self, name, *args, **kwargs):
         base = join(self.path, 'blobs')
         return load_blob(base, name, *args, **kwargs)
+
+    def load_many(self, names):
+        '''
+        yield the blobs for names in order, each in a bytearray of its own that the caller may change.
+        '''
+        base = join(self.path, 'blobs')
+        for name in names:
+            yield read_buffer(file_path(base, name))
+
+    def exists_many(self, names):
+        return [ self.exists(name) for name in names ]
+
+    def save_file(self, name, path):
+        '''
+        save the blob name from the file at path, which is moved into the store.
+        '''
+        base = join(self.path, 'blobs')
+        os.makedirs(bucket_path(base, name), exist_ok=True)
+        os.rename(path, file_path(base, name))
+
+    def locate(self, name):
+        '''
+        the (path, offset, length) of the blob in a file, or None.
+        '''
+        fn = file_path(join(self.path, 'blobs'), name)
+        try:
+            return fn, 0, os.path.getsize(fn)
+        except FileNotFoundError:
+            return None
         
     def __repr__(self):
         return "[Store: %s]"%(self.path)
@@ -89,30 +177,868 @@ class FileStore:
     pass
 
 
+class PackIndex:
+    '''
+    the index of a full pack, a header then (sha256, offset, length) entries sorted by sha256.
+
+    it is memory mapped and searched in place.
+    '''
+    magic = b'\x00tote pidx\n'
+    version = 1
+    header = struct.Struct('<11sB4xQ')
+    entry = struct.Struct('<32sQQ')
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < self.header.size:
+                raise ValueError('pack index is cut short', str(path))
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, self.count = self.header.unpack_from(self.map, 0)
+            if magic != self.magic or version != self.version:
+                raise ValueError('not a pack index', str(path))
+            if len(self.map) != self.header.size + self.count * self.entry.size:
+                raise ValueError('pack index is the wrong size', str(path))
+        except:
+            self.map.close()
+            raise
+
+    def get(self, key):
+        '''
+        the (offset, length) of the blob with the raw sha256 key, or None.
+        '''
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            k, offset, length = self.entry.unpack_from(self.map, self.header.size + mid * self.entry.size)
+            if k < key:
+                lo = mid + 1
+            elif k > key:
+                hi = mid
+            else:
+                return offset, length
+        return None
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.entry.unpack_from(self.map, self.header.size + i * self.entry.size)
+
+    def __len__(self):
+        return self.count
+
+    @classmethod
+    def write(cls, path, entries):
+        '''
+        write an index of the (key, offset, length) entries at path.
+        '''
+        entries = sorted(entries)
+        part = '%s.%d.part' % (path, os.getpid())
+        with open(part, 'wb') as f:
+            f.write(cls.header.pack(cls.magic, cls.version, len(entries)))
+            f.write(b''.join(cls.entry.pack(*e) for e in entries))
+        os.rename(part, path)
+
+    def close(self):
+        self.map.close()
+
+
+class PackStore:
+    '''
+    a blob store that appends blobs to large pack files instead of saving a file for each.
+
+    a pack is a header then records of the sha256 of a blob, its length and the blob itself. a
+    pack that is full gets a PackIndex next to it. the last pack is the one appended to, its
+    index is kept in memory and brought up to date from the records other processes appended.
+    appends take a lock on the packs, so several processes can share the store.
+
+    blobs saved loose by a FileStore at the same path are still read, repack moves them into packs.
+    '''
+    magic = b'\x00tote pack\n'
+    version = 1
+    header = struct.Struct('<11sB4x')
+    record = struct.Struct('<32sQ')
+
+    def __init__(self, path, pack_size=2**30):
+        self.path = Path(path)
+        self.packs_path = self.path / 'packs'
+        self.packs_path.mkdir(parents=True, exist_ok=True)
+        self.pack_size = pack_size
+        self.loose = FileStore(self.path)
+
+        self._lock = threading.RLock()
+        self._write_lock = threading.Lock()
+        # full packs by number, newest first when searched
+        self._sealed = {}
+        self._active = None
+        self._active_index = {}
+        self._active_end = 0
+        self._files = {}
+        self._retired = []
+        self._refresh()
+
+    def _pack_path(self, number, suffix='.pack'):
+        return self.packs_path / ('pack-%08d%s' % (number, suffix))
+
+    @contextmanager
+    def _locked(self, flags=fcntl.LOCK_EX):
+        with open(self.packs_path / 'lock', 'a') as f:
+            fcntl.flock(f, flags)
+            yield
+
+    def _numbers(self):
+        numbers = set()
+        indexed = set()
+        for entry in os.scandir(self.packs_path):
+            name = entry.name
+            if not name.startswith('pack-'):
+                continue
+            if name.endswith('.pack'):
+                numbers.add(int(name[5:-5]))
+            elif name.endswith('.idx'):
+                indexed.add(int(name[5:-4]))
+        return numbers, indexed
+
+    def _scan(self, number, start=None):
+        '''
+        the (key, offset, length) records of a pack from start and the offset after the last whole one.
+        '''
+        fd = self._fd(number)
+        size = os.fstat(fd).st_size
+        pos = self.header.size if start is None else start
+        if start is None:
+            head = os.pread(fd, self.header.size, 0)
+            if len(head) < self.header.size:
+                return [], self.header.size
+            magic, version = self.header.unpack(head)
+            if magic != self.magic or version != self.version:
+                raise ValueError('not a pack', str(self._pack_path(number)))
+
+        records = []
+        while pos + self.record.size <= size:
+            key, length = self.record.unpack(os.pread(fd, self.record.size, pos))
+            if pos + self.record.size + length > size:
+                # being appended by another process, or cut short by a crash
+                break
+            records.append((key, pos + self.record.size, length))
+            pos += self.record.size + length
+        return records, pos
+
+    def _fd(self, number):
+        fd = self._files.get(number)
+        if fd is None:
+            fd = os.open(self._pack_path(number), os.O_RDONLY)
+            self._files[number] = fd
+        return fd
+
+    def _refresh(self, locked=False):
+        '''
+        pick up packs added, filled or removed by other processes and the records appended to the last one.
+
+        locked is true when the caller holds the lock on the packs already.
+        '''
+        with self._lock:
+            numbers, indexed = self._numbers()
+            for number in list(self._sealed):
+                if number not in numbers or number not in indexed:
+                    self._forget(number)
+
+            unindexed = sorted(numbers - indexed)
+            if len(unindexed) > 1:
+                # a pack filled by a process that stopped before writing its index
+                with self._locked() if not locked else suppress():
+                    for number in unindexed[:-1]:
+                        if not self._pack_path(number, '.idx').exists():
+                            records, end = self._scan(number)
+                            PackIndex.write(self._pack_path(number, '.idx'), records)
+                        indexed.add(number)
+
+            for number in sorted(indexed & numbers):
+                if number not in self._sealed:
+                    self._sealed[number] = PackIndex(self._pack_path(number, '.idx'))
+
+            active = max(numbers - indexed, default=None)
+            if active != self._active:
+                self._active = active
+                self._active_index = {}
+                self._active_end = None
+            if active is not None:
+                records, self._active_end = self._scan(active, self._active_end)
+                for key, offset, length in records:
+                    self._active_index[key] = (offset, length)
+
+    def _forget(self, number):
+        index = self._sealed.pop(number, None)
+        if index is not None:
+            index.close()
+        fd = self._files.pop(number, None)
+        if fd is not None:
+            # another thread may be reading from it, so it is closed with the store
+            self._retired.append(fd)
+
+    def _find(self, key):
+        '''
+        the (pack number, offset, length) of a blob, None if it is not in a pack.
+        '''
+        with self._lock:
+            found = self._active_index.get(key)
+            if found is not None:
+                return (self._active,) + found
+            for number in sorted(self._sealed, reverse=True):
+                found = self._sealed[number].get(key)
+                if found is not None:
+                    return (number,) + found
+        return None
+
+    def _locate(self, name):
+        key = bytes.fromhex(name)
+        found = self._find(key)
+        if found is None:
+            self._refresh()
+            found = self._find(key)
+        return found
+
+    def _seal(self):
+        PackIndex.write(
+            self._pack_path(self._active, '.idx'),
+            ((key, offset, length) for key, (offset, length) in self._active_index.items()),
+        )
+        self._sealed[self._active] = PackIndex(self._pack_path(self._active, '.idx'))
+        self._active = None
+        self._active_index = {}
+        self._active_end = None
+
+    def _append(self, key, blob):
+        '''
+        append a blob to the last pack, starting a new one when it is full, with the packs locked.
+        '''
+        size = self.record.size + len(blob)
+        if self._active is not None and self._active_end > self.header.size and self._active_end + size > self.pack_size:
+            self._seal()
+        if self._active is None:
+            numbers, _ = self._numbers()
+            self._active = max(numbers, default=0) + 1
+            with open(self._pack_path(self._active), 'xb') as f:
+                f.write(self.header.pack(self.magic, self.version))
+            self._active_end = self.header.size
+
+        path = self._pack_path(self._active)
+        with open(path, 'r+b') as f:
+            # drop what a crashed append left at the end
+            f.truncate(self._active_end)
+            f.seek(self._active_end)
+            f.write(self.record.pack(key, len(blob)))
+            _write_blob(f, blob)
+        self._active_index[key] = (self._active_end + self.record.size, len(blob))
+        self._active_end += size
+
+    def save(self, blob):
+        return self.save_stream(sha256(blob).hexdigest(), blob)
+
+    def save_stream(self, name, f):
+        '''
+        save the blob name read from the file f, which has to have the blob's length, returns name.
+        '''
+        key = bytes.fromhex(name)
+        if self._find(key) is not None:
+            return name
+
+        with self._write_lock, self._locked(), self._lock:
+            self._refresh(locked=True)
+            if self._find(key) is None:
+                self._append(key, f)
+        return name
+
+    def save_file(self, name, path):
+        '''
+        save the blob name from the file at path, which is removed.
+        '''
+        with open(path, 'rb') as f:
+            blob = f.read()
+        os.unlink(path)
+        if self.save(blob) != name:
+            raise ValueError('blob does not match its name', name)
+
+    def locate(self, name):
+        '''
+        the (path, offset, length) of the blob in a file, or None.
+        '''
+        found = self._locate(name)
+        if found is None:
+            fn = file_path(join(self.path, 'blobs'), name)
+            try:
+                return fn, 0, os.path.getsize(fn)
+            except FileNotFoundError:
+                return None
+        number, offset, length = found
+        return str(self._pack_path(number)), offset, length
+
+    def _read(self, name, buffer=False):
+        for retry in (False, True):
+            found = self._locate(name)
+            if found is None:
+                if buffer:
+                    return read_buffer(file_path(join(self.path, 'blobs'), name))
+                return self.loose.load(name)
+            number, offset, length = found
+            try:
+                with self._lock:
+                    fd = self._fd(number)
+            except FileNotFoundError:
+                # repacked by another process since
+                if retry:
+                    raise
+                self._refresh()
+                continue
+            if buffer:
+                blob = bytearray(length)
+                n = os.preadv(fd, [blob], offset)
+            else:
+                blob = os.pread(fd, length, offset)
+                n = len(blob)
+            if n != length:
+                raise IOError('pack is cut short', str(self._pack_path(number)))
+            return blob
+
+    def load(self, name):
+        return self._read(name)
+
+    load_blob = load
+
+    def load_many(self, names):
+        '''
+        yield the blobs for names in order, each in a bytearray of its own that the caller may change.
+        '''
+        for name in names:
+            yield self._read(name, buffer=True)
+
+    def exists(self, name):
+        return self._locate(name) is not None or self.loose.exists(name)
+
+    def exists_many(self, names):
+        return [ self.exists(name) for name in names ]
+
+    def _loose_names(self):
+        base = join(self.path, 'blobs')
+        for root, dirs, files in os.walk(base):
+            for fn in files:
+                if len(fn) == 64 and not fn.endswith('.part'):
+                    yield fn, join(root, fn)
+
+    def repack(self, keep=None):
+        '''
+        copy the blobs into new full packs, with keep only the names in it, then remove the old packs.
+
+        loose blobs are moved into the packs too. returns (blobs, bytes) kept and (blobs, bytes) removed.
+        '''
+        kept = [0, 0]
+        removed = [0, 0]
+        keys = None if keep is None else { bytes.fromhex(name) for name in keep }
+
+        with self._write_lock, self._locked(), self._lock:
+            self._refresh(locked=True)
+            old = sorted(self._sealed)
+            if self._active is not None:
+                old.append(self._active)
+                self._seal()
+            seen = set()
+
+            for number in old:
+                fd = self._fd(number)
+                for key, offset, length in sorted(self._sealed[number], key=lambda e: e[1]):
+                    if key in seen or (keys is not None and key not in keys):
+                        removed[0] += 1
+                        removed[1] += length
+                        continue
+                    self._append(key, os.pread(fd, length, offset))
+                    seen.add(key)
+                    kept[0] += 1
+                    kept[1] += length
+
+            loose = []
+            for name, path in self._loose_names():
+                key = bytes.fromhex(name)
+                with open(path, 'rb') as f:
+                    blob = f.read()
+                if key in seen or (keys is not None and key not in keys) or sha256(blob).digest() != key:
+                    removed[0] += 1
+                    removed[1] += len(blob)
+                else:
+                    self._append(key, blob)
+                    seen.add(key)
+                    kept[0] += 1
+                    kept[1] += len(blob)
+                loose.append(path)
+
+            # the copies are on disk before anything they were copied from is removed
+            numbers, indexed = self._numbers()
+            for number in sorted(numbers - set(old)):
+                _fsync(self._pack_path(number))
+                if number in indexed:
+                    _fsync(self._pack_path(number, '.idx'))
+            _fsync(self.packs_path)
+
+            for number in old:
+                self._forget(number)
+                os.unlink(self._pack_path(number, '.idx'))
+                os.unlink(self._pack_path(number))
+            for path in loose:
+                os.unlink(path)
+
+        return tuple(kept), tuple(removed)
+
+    def close(self):
+        with self._lock:
+            for number in list(self._sealed):
+                self._forget(number)
+            for fd in list(self._files.values()) + self._retired:
+                os.close(fd)
+            self._files = {}
+            self._retired = []
+
+    def __repr__(self):
+        return "[PackStore: %s]"%(self.path)
+
+
 import requests
 
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
 class UrlStore:
-    def __init__(self, url, auth):
+    '''
+    a blob store over http, blobs are at url + name and are put with PUT.
+
+    the connections are kept open and shared by the threads using the store, up to connections of
+    them. failed requests and busy or failing servers are retried with a backoff.
+    '''
+    def __init__(self, url, auth, connections=8, retries=3, backoff=0.5):
         self.url = url
         self.auth = auth
+        self.connections = max(connections, 1)
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            # blobs are named by their hash, so putting one again is harmless
+            allowed_methods=frozenset(['GET', 'HEAD', 'PUT']),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.connections, pool_block=True, max_retries=retry)
+        self.session = requests.Session()
+        self.session.auth = auth
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._pool = ThreadPoolExecutor(max_workers=self.connections, thread_name_prefix='tote-http')
         
     def load(self, name):
-        resp = requests.get(self.url + name, auth=self.auth)
+        resp = self.session.get(self.url + name)
         if resp.status_code != 200:
             raise IOError(resp)
 
         return resp.content
+
+    def load_many(self, names):
+        '''
+        yield the blobs for names in order, loading several at once.
+        '''
+        window = deque()
+        for name in names:
+            window.append(self._pool.submit(self.load, name))
+            if len(window) >= 2 * self.connections:
+                yield window.popleft().result()
+        while window:
+            yield window.popleft().result()
     
+    def exists(self, name):
+        resp = self.session.head(self.url + name)
+        return resp.status_code == 200
+
+    def exists_many(self, names):
+        '''
+        a list of whether each of names is in the store, asked several at once.
+        '''
+        return list(self._pool.map(self.exists, names))
+
     def save(self, blob):
-        name = sha256(blob).hexdigest()
-        
-        resp = requests.head(self.url + name, auth=self.auth)
-        if resp.status_code == 200:
+        return self.save_stream(sha256(blob).hexdigest(), blob)
+
+    def save_stream(self, name, f):
+        '''
+        save the blob name read from the file f, which has to have the blob's length, returns name.
+
+        the body is sent from f as it is read, a retried request seeks f back to its start.
+        '''
+        if self.exists(name):
             return name
                 
         headers = { 'content-type': 'application/octet-stream' }
-        resp = requests.put(self.url + name, data=blob, headers=headers, auth=self.auth)
-        if resp.status_code != 200:
+        resp = self.session.put(self.url + name, data=f, headers=headers)
+        if resp.status_code not in (200, 201, 204):
             raise IOError(resp)
         
         return name
+
+    def close(self):
+        self._pool.shutdown()
+        self.session.close()
+
+    def __repr__(self):
+        return "[UrlStore: %s]"%(self.url)
+
+
+class CacheStats:
+    '''
+    counts of the blob cache hits, misses and evictions, safe to update from several threads.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.hit_bytes = 0
+        self.misses = 0
+        self.miss_bytes = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+
+    def add(self, **kwargs):
+        with self.lock:
+            for name, value in kwargs.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def __str__(self):
+        return 'cache: hits %d (%.1f MiB), misses %d (%.1f MiB), evictions %d (%.1f MiB)' % (
+            self.hits, self.hit_bytes / 2**20, self.misses, self.miss_bytes / 2**20,
+            self.evictions, self.evicted_bytes / 2**20,
+        )
+
+
+class CachedStore:
+    '''
+    a size capped cache of blobs on local disk in front of another store.
+
+    blobs are named by their sha256, so a cached blob is never stale, and one that does not match
+    its name is dropped and loaded again. the least recently used blobs, by file time, are evicted
+    under a lock on the cache, so several processes can share it.
+    '''
+    def __init__(self, store, path, size):
+        self.store = store
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.size = size
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        # bytes added since the size was last checked, the first add checks it
+        self._added = size
+
+    def _cached(self, name):
+        return isfile(file_path(self.path, name))
+
+    def _read(self, name):
+        fn = file_path(self.path, name)
+        try:
+            blob = read_buffer(fn)
+        except FileNotFoundError:
+            return None
+
+        if sha256(blob).hexdigest() != name:
+            try:
+                os.unlink(fn)
+            except FileNotFoundError:
+                pass
+            return None
+
+        try:
+            # the file time orders the blobs for eviction
+            os.utime(fn)
+        except FileNotFoundError:
+            pass
+        self.stats.add(hits=1, hit_bytes=len(blob))
+        return blob
+
+    def _add(self, name, blob):
+        self.stats.add(misses=1, miss_bytes=len(blob))
+        try:
+            save_blob(str(self.path), name, blob)
+        except OSError as e:
+            # not stdout, which may be carrying the data of the blobs
+            print('cache:', e, file=sys.stderr)
+            return
+
+        with self._lock:
+            self._added += len(blob)
+            due = self._added >= self.size // 8
+            if due:
+                self._added = 0
+        if due:
+            self.evict()
+
+    def evict(self):
+        '''
+        if the cache is over its size remove the least recently used blobs until it is under 7/8 of it.
+        '''
+        with open(self.path / 'lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            entries = []
+            total = 0
+            for root, dirs, files in os.walk(self.path):
+                for fn in files:
+                    if fn == 'lock' or fn.endswith('.part'):
+                        continue
+                    path = join(root, fn)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, path))
+                    total += st.st_size
+
+            if total <= self.size:
+                return
+
+            entries.sort()
+            for mtime, size, path in entries:
+                if total <= self.size * 7 // 8:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    continue
+                total -= size
+                self.stats.add(evictions=1, evicted_bytes=size)
+
+    def load(self, name):
+        blob = self._read(name)
+        if blob is None:
+            blob = self.store.load(name)
+            self._add(name, blob)
+        return blob
+
+    def load_many(self, names):
+        '''
+        yield the blobs for names in order, the ones not cached are loaded by the store together.
+        '''
+        names = list(names)
+        cached = [ self._cached(name) for name in names ]
+        loaded = self.store.load_many([ name for name, c in zip(names, cached) if not c ])
+        for name, c in zip(names, cached):
+            if c:
+                blob = self._read(name)
+                if blob is None:
+                    # evicted or damaged since
+                    blob = self.store.load(name)
+                    self._add(name, blob)
+            else:
+                blob = next(loaded)
+                self._add(name, blob)
+            yield blob
+
+    def exists(self, name):
+        return self._cached(name) or self.store.exists(name)
+
+    def exists_many(self, names):
+        names = list(names)
+        cached = [ self._cached(name) for name in names ]
+        found = iter(self.store.exists_many([ name for name, c in zip(names, cached) if not c ]))
+        return [ c or next(found) for c in cached ]
+
+    def save(self, blob):
+        return self.store.save(blob)
+
+    def save_stream(self, name, f):
+        return self.store.save_stream(name, f)
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def __repr__(self):
+        return "[CachedStore: %s in %s]"%(self.store, self.path)
+
+
+class StagedStore:
+    '''
+    a store that saves blobs to a local staging area and uploads them to another store later.
+
+    the journal in the staging area gets a '+ name' line once a blob is staged and a '- name'
+    line once the other store has it, then the staged copy is removed. until then the blob is
+    read from the staging area. blobs and journal lines are synced to disk before save returns,
+    so a crash loses no blob that an archive can point to, and a blob staged by a save cut short
+    before its line is found by the next flush.
+    '''
+    def __init__(self, store, path, workers=8):
+        self.store = store
+        self.path = Path(path)
+        self.blobs_path = self.path / 'blobs'
+        self.blobs_path.mkdir(parents=True, exist_ok=True)
+        self.journal_path = self.path / 'journal'
+        self.workers = max(workers, 1)
+
+    def _staged_path(self, name):
+        return file_path(str(self.blobs_path), name)
+
+    @contextmanager
+    def _locked(self, name, flags):
+        with open(self.path / name, 'a') as f:
+            fcntl.flock(f, flags)
+            yield f
+
+    def _log(self, line, sync=True):
+        # appends share the lock, only rewriting the journal needs it alone
+        with self._locked('journal.lock', fcntl.LOCK_SH):
+            fd = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, (line + '\n').encode())
+                if sync:
+                    os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _read_journal(self):
+        '''
+        the names staged and not yet uploaded, in the order they were staged.
+        '''
+        pending = OrderedDict()
+        try:
+            with open(self.journal_path, 'rt') as f:
+                for line in f:
+                    # a line cut short by a crash has no newline
+                    if not line.endswith('\n'):
+                        continue
+                    op, _, name = line.rstrip('\n').partition(' ')
+                    if op == '+':
+                        pending[name] = None
+                    elif op == '-':
+                        pending.pop(name, None)
+        except FileNotFoundError:
+            pass
+        return list(pending)
+
+    def pending(self):
+        return self._read_journal()
+
+    def save(self, blob):
+        return self.save_stream(sha256(blob).hexdigest(), blob)
+
+    def save_stream(self, name, f):
+        if isfile(self._staged_path(name)):
+            return name
+        # the blob is on disk before the line, so a flush never finds a line without its blob
+        save_blob(str(self.blobs_path), name, f, sync=True)
+        self._log('+ ' + name)
+        return name
+
+    def load(self, name):
+        try:
+            return load_blob(str(self.blobs_path), name)
+        except FileNotFoundError:
+            return self.store.load(name)
+
+    def load_many(self, names):
+        names = list(names)
+        staged = [ isfile(self._staged_path(name)) for name in names ]
+        loaded = self.store.load_many([ name for name, s in zip(names, staged) if not s ])
+        for name, s in zip(names, staged):
+            yield self.load(name) if s else next(loaded)
+
+    def exists(self, name):
+        return isfile(self._staged_path(name)) or self.store.exists(name)
+
+    def exists_many(self, names):
+        names = list(names)
+        staged = [ isfile(self._staged_path(name)) for name in names ]
+        found = iter(self.store.exists_many([ name for name, s in zip(names, staged) if not s ]))
+        return [ s or next(found) for s in staged ]
+
+    def _upload(self, name):
+        try:
+            blob = load_blob(str(self.blobs_path), name)
+        except FileNotFoundError:
+            # uploaded and removed by a flush before, and staged again while it ran, or the '-'
+            # line of an upload was lost. otherwise the blob is left pending, never dropped
+            if self.store.exists(name):
+                self._log('- ' + name, sync=False)
+            return None
+
+        try:
+            if self.store.save(blob) != name:
+                raise IOError('staged blob does not match its name', name)
+        except Exception as e:
+            # the rest of the round goes on, this one is left pending
+            print('flush:', name, e, file=sys.stderr)
+            return None
+        self._log('- ' + name, sync=False)
+        return len(blob)
+
+    def _recover(self):
+        '''
+        journal the staged blobs that have no '+' line, left by a save cut short by a crash.
+        '''
+        pending = set(self._read_journal())
+        for dirpath, dirnames, filenames in os.walk(self.blobs_path):
+            for name in filenames:
+                if not name.endswith('.part') and name not in pending:
+                    self._log('+ ' + name)
+
+    def _compact(self):
+        with self._locked('journal.lock', fcntl.LOCK_EX):
+            pending = self._read_journal()
+            part = self.journal_path.with_name('journal.part')
+            with open(part, 'wt') as f:
+                f.write(''.join('+ %s\n' % name for name in pending))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(part, self.journal_path)
+
+    def flush(self, wait=True):
+        '''
+        upload the staged blobs to the other store several at once, returns (blobs, bytes) uploaded.
+
+        only one flush runs at a time, without wait it returns None if another one is running.
+        '''
+        flags = fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            lock = self._locked('flush.lock', flags)
+            lock.__enter__()
+        except BlockingIOError:
+            return None
+
+        try:
+            self._recover()
+            count = 0
+            size = 0
+            # blobs staged while uploading are picked up by the next round, a blob that could
+            # not be uploaded is left for the next flush
+            tried = set()
+            while True:
+                pending = [ name for name in self._read_journal() if name not in tried ]
+                if not pending:
+                    break
+                tried.update(pending)
+                uploaded = []
+                with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='tote-flush') as pool:
+                    for name, n in zip(pending, pool.map(self._upload, pending)):
+                        if n is not None:
+                            uploaded.append(name)
+                            count += 1
+                            size += n
+                self._compact()
+                # removing a blob can wait on the disk, so it is left until the round is uploaded
+                for name in uploaded:
+                    try:
+                        os.unlink(self._staged_path(name))
+                    except FileNotFoundError:
+                        pass
+            return count, size
+        finally:
+            lock.__exit__(None, None, None)
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def __repr__(self):
+        return "[StagedStore: %s in %s]"%(self.store, self.path)
@@ -0,0 +1,364 @@
+'''
+Watch a workdir with inotify and keep a journal of the parts that changed, so that checkin and
+status only have to scan those.
+
+The journal is .tote/watch/journal, one line per change:
+
+    session <id> <checkin>  the first line, the changes are since checkin, - if not known yet
+    ready                   every directory is watched, changes before this may be missing
+    r <name>                the name and everything under it changed
+    d <name>                the directory entry itself changed
+    !overflow               changes were lost, the whole workdir has to be scanned
+
+names are json strings relative to the workdir. The watcher holds a lock on
+.tote/watch/daemon.lock while it runs, a journal nobody is watching for is stale.
+
+A checkin moves the journal on to itself, keeping the changes after the point it read.
+'''
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import json
+import os
+import select
+import struct
+import time
+import uuid
+
+from contextlib import contextmanager
+from pathlib import Path
+from stat import S_ISDIR
+
+from . import DirtyRegions, _Ignore_Manager, _join, _walk_trees
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK
+)
+
+# changes to the entries of a directory that change the directory too
+DIR_CHANGES = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+_event = struct.Struct('iIII')
+
+
+class Inotify:
+    '''
+    a thin wrapper of the inotify system calls.
+    '''
+    def __init__(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            self._init = libc.inotify_init1
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+        except (OSError, AttributeError):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+        self.fd = self._init(IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._rm_watch(self.fd, wd)
+
+    def read(self, timeout=None):
+        '''
+        read the waiting events as (wd, mask, cookie, name), wait up to timeout seconds for one, forever with None.
+        '''
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+
+        buf = os.read(self.fd, 2**16)
+        events = []
+        pos = 0
+        while pos < len(buf):
+            wd, mask, cookie, size = _event.unpack_from(buf, pos)
+            pos += _event.size
+            name = os.fsdecode(buf[pos:pos + size].rstrip(b'\0'))
+            pos += size
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class JournalState:
+    '''
+    what a journal said when it was read.
+    '''
+    def __init__(self, data, watching):
+        self.size = len(data)
+        self.watching = watching
+        self.session = None
+        self.checkin = None
+        self.ready = False
+        self.overflow = False
+        self.trees = set()
+        self.entries = set()
+
+        lines = data.decode('utf-8', errors='replace').split('\n')
+        if lines and lines[0].startswith('session '):
+            fields = lines[0].split(' ')
+            self.session = fields[1]
+            if len(fields) > 2 and fields[2] != '-':
+                self.checkin = fields[2]
+
+        for line in lines[1:]:
+            try:
+                if line == 'ready':
+                    self.ready = True
+                elif line == '!overflow':
+                    self.overflow = True
+                elif line.startswith('r '):
+                    self.trees.add(json.loads(line[2:]))
+                elif line.startswith('d '):
+                    self.entries.add(json.loads(line[2:]))
+            except ValueError:
+                self.overflow = True
+
+    def dirty_regions(self, checkin):
+        '''
+        the DirtyRegions changed since the checkin at path checkin, None if the journal can not tell.
+        '''
+        if checkin is None or not self.watching or not self.ready or self.overflow:
+            return None
+        if self.checkin != Path(checkin).name:
+            return None
+        return DirtyRegions(trees=self.trees, entries=self.entries)
+
+
+class Journal:
+    def __init__(self, tote_path):
+        self.path = Path(tote_path) / 'watch'
+        self.journal_path = self.path / 'journal'
+
+    @contextmanager
+    def _locked(self, name='journal.lock', flags=fcntl.LOCK_EX):
+        self.path.mkdir(parents=True, exist_ok=True)
+        with open(self.path / name, 'a') as f:
+            fcntl.flock(f, flags)
+            yield f
+
+    @contextmanager
+    def watcher_lock(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+        with open(self.path / 'daemon.lock', 'a') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise OSError(errno.EBUSY, 'a watcher is already running', str(self.path))
+            yield
+
+    def watching(self):
+        '''
+        true if a watcher is running.
+        '''
+        try:
+            with self._locked('daemon.lock', fcntl.LOCK_SH | fcntl.LOCK_NB):
+                return False
+        except BlockingIOError:
+            return True
+
+    def read(self):
+        '''
+        read the journal as a JournalState.
+        '''
+        with self._locked():
+            try:
+                data = self.journal_path.read_bytes()
+            except FileNotFoundError:
+                data = b''
+        return JournalState(data, self.watching())
+
+    def _replace(self, text):
+        part = self.journal_path.with_name('journal.part')
+        part.write_bytes(text)
+        part.rename(self.journal_path)
+
+    def start(self):
+        '''
+        start a new journal for a new watcher, it is not tied to any checkin yet.
+        '''
+        session = uuid.uuid4().hex
+        with self._locked():
+            self._replace(('session %s -\n' % session).encode())
+        return session
+
+    def append(self, lines):
+        with self._locked():
+            with self.journal_path.open('a') as f:
+                f.write(''.join(line + '\n' for line in lines))
+
+    def advance(self, state, checkin):
+        '''
+        tie the journal to checkin, which was made from a scan that started after state was read.
+
+        the changes after state are kept, they may have happened after the scan saw them.
+        '''
+        if state.session is None or not state.ready:
+            return
+
+        with self._locked():
+            try:
+                data = self.journal_path.read_bytes()
+            except FileNotFoundError:
+                return
+            if JournalState(data.partition(b'\n')[0], False).session != state.session:
+                return # another watcher started since
+            head = 'session %s %s\nready\n' % (state.session, Path(checkin).name)
+            self._replace(head.encode() + data[state.size:])
+
+
+class Watcher:
+    '''
+    keeps inotify watches on every directory of the workdir and writes what changes to the journal.
+    '''
+    def __init__(self, conn, verbose=False):
+        self.top = str(conn.workdir_path)
+        self.journal = Journal(conn.tote_path)
+        self.verbose = verbose
+        self.inotify = None
+        # relative names of the watched directories by watch descriptor, and the other way round
+        self.names = {}
+        self.wds = {}
+        self.ignore_rules = _Ignore_Manager(base_path=Path(self.top))
+
+    def add_tree(self, name):
+        '''
+        watch the directory name and the directories under it.
+        '''
+        path = _join(self.top, name) if name else self.top
+        for p, st in _walk_trees([path], base_path=Path(self.top)):
+            if st is None or not S_ISDIR(st.st_mode):
+                continue
+            try:
+                wd = self.inotify.add_watch(p)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    raise OSError(e.errno, 'out of inotify watches, raise fs.inotify.max_user_watches', p)
+                raise
+            rel = p[len(self.top) + 1:] if p != self.top else ''
+            old = self.names.get(wd)
+            if old is not None:
+                self.wds.pop(old, None)
+            self.names[wd] = rel
+            self.wds[rel] = wd
+
+    def remove_tree(self, name):
+        prefix = name + '/'
+        for rel in [ rel for rel in self.wds if rel == name or rel.startswith(prefix) ]:
+            wd = self.wds.pop(rel)
+            self.names.pop(wd, None)
+            self.inotify.rm_watch(wd)
+
+    def changes(self, events):
+        '''
+        the journal lines for a batch of events, new directories are watched before they are returned.
+        '''
+        lines = {}
+        for wd, mask, cookie, name in events:
+            if mask & IN_Q_OVERFLOW:
+                # events were lost and new directories might not be watched, the second mark
+                # keeps the journal useless until a scan that started after they all are
+                self.journal.append(['!overflow'])
+                self.add_tree('')
+                lines['!overflow'] = None
+                continue
+
+            parent = self.names.get(wd)
+            if mask & IN_IGNORED:
+                if parent is not None:
+                    self.names.pop(wd, None)
+                    self.wds.pop(parent, None)
+                continue
+            if parent is None:
+                continue
+
+            if not name:
+                if parent == '' and mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    raise OSError(errno.ENOENT, 'the workdir went away', self.top)
+                if mask & IN_ATTRIB:
+                    lines['d ' + json.dumps(parent)] = None
+                continue
+
+            rel = parent + '/' + name if parent else name
+
+            if name == '.toteignore':
+                # what is ignored under parent may have changed
+                self.ignore_rules = _Ignore_Manager(base_path=Path(self.top))
+                self.add_tree(parent)
+                lines['r ' + json.dumps(parent)] = None
+                continue
+
+            if self.ignore_rules.matches(Path(self.top, rel)):
+                continue
+
+            if mask & IN_ISDIR and mask & IN_MOVED_FROM:
+                self.remove_tree(rel)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_tree(rel)
+
+            lines['r ' + json.dumps(rel)] = None
+            if mask & DIR_CHANGES:
+                lines['d ' + json.dumps(parent)] = None
+
+        return list(lines)
+
+    def run(self, batch_delay=0.05):
+        '''
+        watch until interrupted, only one watcher runs per workdir.
+        '''
+        with self.journal.watcher_lock():
+            self.inotify = Inotify()
+            try:
+                self.journal.start()
+                self.add_tree('')
+                self.journal.append(['ready'])
+                if self.verbose:
+                    print('watching %d directories' % len(self.wds))
+
+                while True:
+                    events = self.inotify.read()
+                    # let the events of a burst of changes come in, to write them together
+                    time.sleep(batch_delay)
+                    events.extend(self.inotify.read(0))
+
+                    lines = self.changes(events)
+                    if lines:
+                        self.journal.append(lines)
+                        if self.verbose:
+                            for line in lines:
+                                print(line)
+            finally:
+                self.inotify.close()